@@ -1,17 +1,43 @@
+import argparse
 import json
+import os
 import re
 import time
 from geopy.geocoders import Nominatim
 from geopy.extra.rate_limiter import RateLimiter
 
+from gazetteer import Gazetteer
+from geocode_cache import GeocodeCache, GEOCODE_CACHE_FILE
+
 ROUTES_FILE = 'mpk_viewer/data/routes.json'
 
+# routes.json is rewritten after this many newly geocoded stops (and at the end)
+SAVE_EVERY = 25
+
 def clean_stop_name(name):
     return re.sub(r'NŻPrzystanek na życzenie$', '', name).strip()
 
 def save_routes(routes_data):
-    with open(ROUTES_FILE, 'w', encoding='utf-8') as f:
+    # write to a temporary file and swap it in, so an interrupted run never leaves a broken file
+    tmp_file = ROUTES_FILE + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
         json.dump(routes_data, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_file, ROUTES_FILE)
+
+def build_stop_index(routes_data):
+    # (cleaned name, street) -> every stop dict with that name and street
+    index = {}
+    for route in routes_data.values():
+        for direction in route['directions']:
+            for stop in direction['stops']:
+                key = (clean_stop_name(stop['name']), stop.get('street'))
+                index.setdefault(key, []).append(stop)
+    return index
+
+def apply_coordinates(stops, coords):
+    for stop in stops:
+        stop['lat'] = coords['lat']
+        stop['lon'] = coords['lon']
 
 def get_coordinates(geolocator, stop_name, street):
     if street and street != 'N/A':
@@ -22,65 +48,130 @@ def get_coordinates(geolocator, stop_name, street):
     for i in range(3):
         try:
             location = geolocator(query, timeout=10)
-            if location:
-                return {
-                    'lat': location.latitude,
-                    'lon': location.longitude
-                }
         except Exception as e:
             print(f"Error fetching {query} ({i+1}/3): {e}")
+            if i == 2:
+                raise
             time.sleep(2)
-
-    return None
-
-def add_coordinates_to_routes():
+            continue
+        if location:
+            return {
+                'lat': location.latitude,
+                'lon': location.longitude
+            }
+        return None
+
+def resolve_from_gazetteers(gazetteer_files, stops):
+    # stops still unresolved are passed on to the next gazetteer
+    found = {}
+    for path in gazetteer_files:
+        started = time.perf_counter()
+        gazetteer = Gazetteer.load(path)
+        matches = gazetteer.lookup_many(key for key in stops if key not in found)
+        found.update(matches)
+        print(f"Gazetteer {path}: {len(gazetteer)} names, matched {len(matches)} stops "
+              f"in {time.perf_counter() - started:.2f}s")
+    return found
+
+def add_coordinates_to_routes(retry_missing=False, cache_file=GEOCODE_CACHE_FILE,
+                              gazetteer_files=(), use_nominatim=True):
     with open(ROUTES_FILE, 'r', encoding='utf-8') as f:
         routes_data = json.load(f)
 
-    geolocator = Nominatim(user_agent="mpk_viewer_geocoder")
-    geocode = RateLimiter(
-        geolocator.geocode,
-        min_delay_seconds=1,
-        error_wait_seconds=5
-    )
-
-    stops_to_process = []
-
-    for route in routes_data.values():
-        for direction in route['directions']:
-            for stop in direction['stops']:
-                if 'lat' not in stop or 'lon' not in stop:
-                    stop_name = clean_stop_name(stop['name'])
-                    street = stop.get('street')
-                    stops_to_process.append((stop_name, street))
-
-    stops_to_process = list(dict.fromkeys(stops_to_process))  # unique
+    index = build_stop_index(routes_data)
+    stops_to_process = [
+        key for key, stops in index.items()
+        if any('lat' not in stop or 'lon' not in stop for stop in stops)
+    ]
 
     print(f"Found {len(stops_to_process)} stops without coordinates")
 
-    for i, (stop_name, street) in enumerate(stops_to_process, start=1):
-        coords = get_coordinates(geocode, stop_name, street)
-
-        if not coords:
-            print(f"[{i}/{len(stops_to_process)}] ❌ {stop_name}")
+    cache = GeocodeCache(cache_file)
+    to_geocode = []
+    from_cache = 0
+    for stop_name, street in stops_to_process:
+        try:
+            coords = cache.get(stop_name, street)
+        except KeyError:
+            to_geocode.append((stop_name, street))
             continue
+        if coords:
+            apply_coordinates(index[(stop_name, street)], coords)
+            from_cache += 1
+        elif retry_missing:
+            to_geocode.append((stop_name, street))
+
+    print(f"{from_cache} stops filled from the geocode cache, {len(to_geocode)} to geocode")
+
+    from_gazetteer = resolve_from_gazetteers(gazetteer_files, to_geocode) if to_geocode else {}
+    if from_gazetteer:
+        for key, coords in from_gazetteer.items():
+            apply_coordinates(index[key], coords)
+        cache.put_many(
+            [(stop_name, street, coords) for (stop_name, street), coords in from_gazetteer.items()],
+            'gazetteer'
+        )
+        to_geocode = [key for key in to_geocode if key not in from_gazetteer]
+
+    if from_cache or from_gazetteer:
+        save_routes(routes_data)
 
-        # update ALL matching stops immediately
-        for route in routes_data.values():
-            for direction in route['directions']:
-                for stop in direction['stops']:
-                    if (
-                        clean_stop_name(stop['name']) == stop_name
-                        and stop.get('street') == street
-                    ):
-                        stop['lat'] = coords['lat']
-                        stop['lon'] = coords['lon']
+    if not to_geocode or not use_nominatim:
+        cache.close()
+        if to_geocode:
+            print(f"Done. {len(to_geocode)} stops left without coordinates (Nominatim disabled).")
+        else:
+            print("Done. routes.json is up to date.")
+        return
 
-        save_routes(routes_data)
+    print(f"{len(to_geocode)} stops left for Nominatim")
+
+    geolocator = Nominatim(user_agent="mpk_viewer_geocoder")
+    geocode = RateLimiter(
+        geolocator.geocode,
+        min_delay_seconds=1,
+        error_wait_seconds=5
+    )
 
-        print(f"[{i}/{len(stops_to_process)}] ✅ {stop_name} saved")
+    pending = []
+    try:
+        for i, (stop_name, street) in enumerate(to_geocode, start=1):
+            try:
+                coords = get_coordinates(geocode, stop_name, street)
+            except Exception:
+                # network trouble - leave it uncached so the next run tries again
+                print(f"[{i}/{len(to_geocode)}] ❌ {stop_name} (error)")
+                continue
+
+            pending.append((stop_name, street, coords))
+            if not coords:
+                print(f"[{i}/{len(to_geocode)}] ❌ {stop_name}")
+            else:
+                apply_coordinates(index[(stop_name, street)], coords)
+                print(f"[{i}/{len(to_geocode)}] ✅ {stop_name}")
+
+            if len(pending) >= SAVE_EVERY:
+                cache.put_many(pending, 'nominatim')
+                save_routes(routes_data)
+                pending = []
+    finally:
+        if pending:
+            cache.put_many(pending, 'nominatim')
+            save_routes(routes_data)
+        cache.close()
 
     print("Done. routes.json updated incrementally.")
 
 if __name__ == '__main__':
-    add_coordinates_to_routes()
+    parser = argparse.ArgumentParser(description="Adds stop coordinates to routes.json")
+    parser.add_argument('--retry-missing', action='store_true',
+                        help="geocode again stops that were not found before")
+    parser.add_argument('--cache', default=GEOCODE_CACHE_FILE,
+                        help=f"geocode cache (default: {GEOCODE_CACHE_FILE})")
+    parser.add_argument('--gazetteer', action='append', default=[], metavar='PATH',
+                        help="local gazetteer tried before Nominatim: GTFS stops.txt / feed .zip "
+                             "or a routes .json with coordinates (can be repeated)")
+    parser.add_argument('--no-nominatim', action='store_true',
+                        help="only use the cache and gazetteers, never query Nominatim")
+    args = parser.parse_args()
+    add_coordinates_to_routes(args.retry_missing, args.cache, args.gazetteer, not args.no_nominatim)
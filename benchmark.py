@@ -0,0 +1,544 @@
+"""
+Benchmark suite for the viewer and the data pipeline.
+
+Runs everything against synthetic data, so it needs neither the MPK API nor
+real vehicle logs or OSM downloads:
+
+* the app is imported from a scratch copy of mpk_viewer/ with routes.json
+  (or routes_old.json) as its fixture and MPK_CLIENT=fake, i.e. a simulated
+  fleet on every line (see mpk_viewer/fake_client.py);
+* /api/logged_routes reads days generated by mpk_viewer/synthetic_logs.py;
+* path_solver runs on a synthetic street/tram grid around the stops, unless
+  real graphs are given with --drive-graph/--tram-graph;
+* add_coordinates resolves the fixture with its coordinates stripped from a
+  gazetteer built from the same fixture (no Nominatim).
+
+Every case is run `--warmup` times, then timed `--repeat` times (min / median /
+p95 / mean in ms), then once more under tracemalloc for its peak Python heap.
+Results go to benchmark_results/<timestamp>.json; --compare sets them against
+an earlier run:
+
+    python benchmark.py
+    python benchmark.py --suite vehicles,routes --repeat 20
+    python benchmark.py --compare benchmark_results/20261017-101500.json
+    python benchmark.py --compare OLD.json NEW.json      # only compare two saved runs
+"""
+import argparse
+import contextlib
+import copy
+import gc
+import importlib
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(REPO_DIR, 'mpk_viewer')
+RESULTS_DIR = 'benchmark_results'
+SUITES = ('vehicles', 'routes', 'logged_routes', 'path_solver', 'add_coordinates')
+
+
+def load_fixture(path=None):
+    """The routes fixture: routes.json, or routes_old.json if there is none yet."""
+    if path is None:
+        path = os.path.join(APP_DIR, 'data', 'routes.json')
+        if not os.path.exists(path):
+            path = os.path.join(APP_DIR, 'data', 'routes_old.json')
+    with open(path, 'r', encoding='utf-8') as f:
+        return path, json.load(f)
+
+
+@contextlib.contextmanager
+def working_dir(path):
+    previous = os.getcwd()
+    os.makedirs(path, exist_ok=True)
+    os.chdir(path)
+    try:
+        yield path
+    finally:
+        os.chdir(previous)
+
+
+@contextlib.contextmanager
+def quiet():
+    """Silences the progress output (prints, tqdm) of the code under test."""
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        yield
+
+
+class Bench:
+    """Runs cases and collects their results, keyed by case name."""
+
+    def __init__(self, repeat=5, warmup=1, memory=True):
+        self.repeat = repeat
+        self.warmup = warmup
+        self.memory = memory
+        self.results = {}
+        self._header = False
+
+    def run(self, name, fn, setup=None, repeat=None, warmup=None, **info):
+        """
+        Times fn(). setup() runs untimed before every call (e.g. to drop a
+        cache). Extra keyword arguments are stored with the result.
+        """
+        repeat = self.repeat if repeat is None else repeat
+        warmup = self.warmup if warmup is None else warmup
+
+        def call():
+            if setup is not None:
+                with quiet():
+                    setup()
+            gc.collect()
+            with quiet():
+                t0 = time.perf_counter()
+                fn()
+                return time.perf_counter() - t0
+
+        for _ in range(warmup):
+            call()
+        times_ms = np.array([call() for _ in range(repeat)]) * 1000
+        result = {
+            "runs": repeat,
+            "min_ms": round(float(times_ms.min()), 3),
+            "median_ms": round(float(np.median(times_ms)), 3),
+            "p95_ms": round(float(np.percentile(times_ms, 95)), 3),
+            "mean_ms": round(float(times_ms.mean()), 3),
+        }
+        if self.memory:
+            if setup is not None:
+                with quiet():
+                    setup()
+            gc.collect()
+            tracemalloc.start()
+            try:
+                with quiet():
+                    fn()
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            result["peak_kib"] = round(peak / 1024, 1)
+        result.update(info)
+        self.results[name] = result
+        if not self._header:
+            print(f"  {'case':<44}{'median':>15}{'p95':>15}{'peak heap' if self.memory else '':>16}")
+            self._header = True
+        memory = f"{result['peak_kib']:>12.1f} KiB" if self.memory else ""
+        print(f"  {name:<44}{result['median_ms']:>12.3f} ms{result['p95_ms']:>12.3f} ms{memory}")
+        return result
+
+
+def fetch(client, url, status=200, **headers):
+    """GETs url through the Flask test client, reading the whole body."""
+    response = client.get(url, headers=headers)
+    body = response.get_data()
+    if response.status_code != status:
+        raise RuntimeError(f"GET {url}: expected {status}, got {response.status_code}: {body[:200]!r}")
+    return body
+
+
+# --- App suites -----------------------------------------------------------
+
+def prepare_app(scratch, args):
+    """
+    Copies mpk_viewer/ (code, templates, static) into scratch with the fixture
+    as data/routes.json, generates the synthetic log days and imports the app
+    from there. Returns (app module, [log dates]).
+    """
+    app_dir = os.path.join(scratch, 'app')
+    shutil.copytree(APP_DIR, app_dir, ignore=shutil.ignore_patterns('data', '__pycache__', 'vehicle_logs',
+                                                                     'vehicle_trips', 'logs'))
+    os.makedirs(os.path.join(app_dir, 'data'))
+    shutil.copyfile(args.fixture, os.path.join(app_dir, 'data', 'routes.json'))
+
+    os.environ.update({
+        'MPK_CLIENT': 'fake',
+        'MPK_FAKE_VEHICLES': str(args.vehicles_per_direction),
+        'MPK_FAKE_SEED': str(args.seed),
+        'MPK_FAKE_LAYOVER_S': '900',
+        'MPK_FAKE_NOISE_M': '3',
+        # The cases poll explicitly; keep the background poller out of the timings.
+        'VEHICLE_POLL_INTERVAL': '3600',
+        'VEHICLE_LOG_FORMAT': args.log_format,
+    })
+    sys.path.insert(0, app_dir)
+    os.chdir(app_dir)
+
+    synthetic_logs = importlib.import_module('synthetic_logs')
+    dates = synthetic_logs.day_range(args.log_days)
+    first, last = (int(hour) for hour in args.log_hours.split('-'))
+    t0 = time.perf_counter()
+    stats = synthetic_logs.generate(
+        synthetic_logs.load_routes_fixture(os.path.join('data', 'routes.json')), dates, 'vehicle_logs',
+        service_hours=(first, last), vehicles_per_direction=args.vehicles_per_direction,
+        log_format=args.log_format, seed=args.seed,
+    )
+    print(f"Generated {len(dates)} log days ({stats['written_records']} records) "
+          f"in {time.perf_counter() - t0:.1f}s")
+
+    with quiet():
+        app = importlib.import_module('app')
+    return app, dates
+
+
+def bench_vehicles(bench, app, client):
+    poller = app.vehicle_poller
+    snapshot = poller.refresh()
+    bench.run('vehicles.poll', poller.refresh, vehicles=len(snapshot.vehicles))
+
+    snapshot = poller.get_snapshot()
+    lines = [p.line for p in snapshot.positions]
+    line = max(set(lines), key=lines.count)
+    lat = float(np.median([p.lat for p in snapshot.positions]))
+    lon = float(np.median([p.lon for p in snapshot.positions]))
+    bbox = f"{lon - 0.015},{lat - 0.01},{lon + 0.015},{lat + 0.01}"
+    etag = client.get('/api/vehicles').headers['ETag']
+
+    bench.run('api.vehicles', lambda: fetch(client, '/api/vehicles'), vehicles=len(snapshot.vehicles))
+    bench.run('api.vehicles.not_modified',
+              lambda: fetch(client, '/api/vehicles', 304, **{'If-None-Match': etag}))
+    bench.run('api.vehicles.line', lambda: fetch(client, f'/api/vehicles?line={line}'), line=line)
+    bench.run('api.vehicles.type', lambda: fetch(client, '/api/vehicles?type=tram'))
+    bench.run('api.vehicles.bbox', lambda: fetch(client, f'/api/vehicles?bbox={bbox}'), bbox=bbox)
+
+
+def bench_routes(bench, app, client):
+    lines = sorted(app.routes_data.keys())
+    longest = max(lines, key=lambda line: sum(
+        len(direction.get('stops', [])) for direction in app.routes_data[line].get('directions', [])))
+
+    bench.run('api.routes.index', lambda: fetch(client, '/api/routes'), lines=len(lines))
+    bench.run('api.routes.line', lambda: fetch(client, f'/api/routes/{longest}'), line=longest)
+    bench.run('api.routes.line_gzip',
+              lambda: fetch(client, f'/api/routes/{longest}', **{'Accept-Encoding': 'gzip'}), line=longest)
+    bench.run('api.routes.line_full_geometry',
+              lambda: fetch(client, f'/api/routes/{longest}?geometry=full'), line=longest)
+
+    def all_lines():
+        for line in lines:
+            fetch(client, f'/api/routes/{line}', **{'Accept-Encoding': 'gzip'})
+    bench.run('api.routes.all_lines', all_lines, lines=len(lines))
+
+
+def bench_logged_routes(bench, app, client, dates):
+    from logged_routes_cache import LoggedRoutesCache
+    from trips import backfill_day
+
+    date = dates[-1]
+    cache_dir = app.logged_routes_cache.cache_dir
+    lines = app.vehicle_log_store.list_lines(date, app.VEHICLE_LOG_DIR)
+    line = lines[len(lines) // 2]
+    url = f'/api/logged_routes?date={date}'
+
+    def restart(drop_artifacts):
+        # A new cache object is what the app starts with; without its artifacts it re-segments the logs.
+        if drop_artifacts:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        app.logged_routes_cache = LoggedRoutesCache(
+            app.VEHICLE_LOG_DIR, cache_dir, app.build_line_routes, version=app.SEGMENTATION_PARAMS.key())
+
+    bench.run('api.logged_routes.dates', lambda: fetch(client, '/api/logged_routes/dates'), dates=len(dates))
+    bench.run('api.logged_routes.cold', lambda: fetch(client, url), setup=lambda: restart(True), date=date)
+    bench.run('api.logged_routes.persisted', lambda: fetch(client, url), setup=lambda: restart(False))
+    bench.run('api.logged_routes.memory', lambda: fetch(client, url))
+    bench.run('api.logged_routes.ndjson', lambda: fetch(client, url + '&format=ndjson'))
+    bench.run('api.logged_routes.line_cold', lambda: fetch(client, f'{url}&line={line}'),
+              setup=lambda: restart(True), line=line)
+
+    trip_count = [0]
+
+    def backfill():
+        trip_count[0] = backfill_day(date, app.VEHICLE_LOG_DIR, app.trip_store)
+    bench.run('trips.backfill_day', backfill)
+    bench.results['trips.backfill_day']['trips'] = trip_count[0]
+    bench.run('api.trips', lambda: fetch(client, f'/api/trips?date={date}'))
+
+    # Compaction rewrites the day, so it is timed once; the reads after it hit the archives.
+    sizes = {}
+
+    def compact():
+        sizes['before'], sizes['after'] = app.vehicle_log_store.compact_day(date, app.VEHICLE_LOG_DIR)
+    bench.run('logs.compact_day', compact, repeat=1, warmup=0)
+    bench.results['logs.compact_day'].update(bytes_before=sizes['before'], bytes_after=sizes['after'])
+    bench.run('api.logged_routes.archive_cold', lambda: fetch(client, url), setup=lambda: restart(True))
+
+
+# --- Pipeline suites ------------------------------------------------------
+
+def synthetic_grid(routes_data, directory, spacing_m=250.0, seed=0):
+    """
+    Writes drive.graphml and tram.graphml: a jittered street grid over the
+    stops' bounding box with a few missing links, and a sparser tram grid on
+    every fifth street. Returns their paths.
+    """
+    import networkx as nx
+    import osmnx as ox
+
+    rng = random.Random(seed)
+    coords = [(stop['lat'], stop['lon']) for data in routes_data.values()
+              for direction in data.get('directions', []) for stop in direction.get('stops', [])
+              if stop.get('lat') is not None and stop.get('lon') is not None]
+    lats, lons = zip(*coords)
+    lat0, lat1 = min(lats) - 0.005, max(lats) + 0.005
+    lon0, lon1 = min(lons) - 0.005, max(lons) + 0.005
+    dlat = spacing_m / 111_320
+    dlon = dlat / np.cos(np.radians((lat0 + lat1) / 2))
+    rows, cols = int((lat1 - lat0) / dlat) + 1, int((lon1 - lon0) / dlon) + 1
+
+    def build(base_id, step, drop):
+        G = nx.MultiDiGraph(crs='epsg:4326')
+        for r in range(0, rows, step):
+            for c in range(0, cols, step):
+                G.add_node(base_id + r * cols + c,
+                           y=lat0 + (r + rng.uniform(-0.2, 0.2)) * dlat,
+                           x=lon0 + (c + rng.uniform(-0.2, 0.2)) * dlon)
+        for r in range(0, rows, step):
+            for c in range(0, cols, step):
+                u = base_id + r * cols + c
+                for v in (u + step, u + step * cols):
+                    if v not in G or (v == u + step and c + step >= cols) or rng.random() < drop:
+                        continue
+                    a, b = G.nodes[u], G.nodes[v]
+                    length = float(111_320 * np.hypot(a['y'] - b['y'], (a['x'] - b['x']) * np.cos(np.radians(a['y']))))
+                    G.add_edge(u, v, length=round(length, 3))
+                    G.add_edge(v, u, length=round(length, 3))
+        return G
+
+    paths = (os.path.join(directory, 'drive.graphml'), os.path.join(directory, 'tram.graphml'))
+    os.makedirs(directory, exist_ok=True)
+    ox.save_graphml(build(1_000_000_000, 1, 0.08), paths[0])
+    ox.save_graphml(build(2_000_000_000, 5, 0.0), paths[1])
+    return paths
+
+
+def bench_path_solver(bench, routes_data, args):
+    from graph_store import load_graphs
+    from path_cache import PathCache
+    from path_solver import calculate_paths, prefetch_pairs
+    from routing import make_engine
+    from stop_snapping import snap_stops, unique_stops
+
+    if args.drive_graph and args.tram_graph:
+        drive_path, tram_path = args.drive_graph, args.tram_graph
+    else:
+        t0 = time.perf_counter()
+        drive_path, tram_path = synthetic_grid(routes_data, 'osm', args.grid_spacing, args.seed)
+        print(f"Generated synthetic street/tram grid in {time.perf_counter() - t0:.1f}s")
+    os.makedirs(os.path.join('mpk_viewer', 'data'), exist_ok=True)
+
+    cache_dir = os.path.join('osm', 'cache')
+    load = lambda: load_graphs(drive_path, tram_path, cache_dir, offline=True, log=lambda message: None)
+    bench.run('path_solver.load_graphs.parse', load, setup=lambda: shutil.rmtree(cache_dir, ignore_errors=True))
+    bench.run('path_solver.load_graphs.cached', load)
+    G_combined, G_drive, G_tram = load()
+    graphs = {"drive": G_drive, "tram": G_tram}
+    bench.results['path_solver.load_graphs.parse'].update(
+        nodes=G_combined.number_of_nodes(), edges=G_combined.number_of_edges())
+
+    stops = unique_stops(routes_data)
+    bench.run('path_solver.snap_stops', lambda: snap_stops(stops, graphs),
+              stops=sum(len(mode_stops) for mode_stops in stops.values()))
+    stop_nodes = snap_stops(stops, graphs)
+
+    bench.run('path_solver.make_engine', lambda: make_engine(args.engine, G_combined), engine=args.engine)
+    router = make_engine(args.engine, G_combined)
+    fingerprint = G_combined.graph['fingerprint']
+    cache_path = 'path_cache.sqlite'
+    state = {}
+
+    def fresh_cache():
+        if state.get('cache') is not None:
+            state['cache'].close()
+        for suffix in ('', '-wal', '-shm', '-journal'):
+            if os.path.exists(cache_path + suffix):
+                os.remove(cache_path + suffix)
+        state['cache'] = PathCache(cache_path, fingerprint)
+
+    if router.batched:
+        lines = list(routes_data.values())
+        bench.run('path_solver.prefetch_pairs', lambda: prefetch_pairs(router, lines, stop_nodes, state['cache']),
+                  setup=fresh_cache, engine=args.engine)
+
+    def solve():
+        calculate_paths(G_combined, G_drive, state['routes'], state['cache'], workers=1,
+                        journal_path='routes_solved.journal.jsonl', resume=False,
+                        fingerprint=fingerprint, G_tram=G_tram, stop_nodes=stop_nodes, engine=args.engine)
+
+    def cold():
+        fresh_cache()
+        state['routes'] = copy.deepcopy(routes_data)
+
+    def warm():
+        state['routes'] = copy.deepcopy(routes_data)
+
+    bench.run('path_solver.calculate_paths.cold', solve, setup=cold, engine=args.engine)
+    bench.run('path_solver.calculate_paths.cached', solve, setup=warm, engine=args.engine,
+              pairs=len(state['cache']))
+    state['cache'].close()
+
+
+def bench_add_coordinates(bench, routes_data, args):
+    import add_coordinates
+
+    stripped = copy.deepcopy(routes_data)
+    for data in stripped.values():
+        for direction in data.get('directions', []):
+            for stop in direction.get('stops', []):
+                stop.pop('lat', None)
+                stop.pop('lon', None)
+    stripped_json = json.dumps(stripped, ensure_ascii=False)
+    gazetteer_path = os.path.abspath('gazetteer.json')
+    shutil.copyfile(args.fixture, gazetteer_path)
+    cache_path = 'geocode_cache.sqlite'
+    os.makedirs(os.path.dirname(add_coordinates.ROUTES_FILE), exist_ok=True)
+
+    def reset_routes():
+        with open(add_coordinates.ROUTES_FILE, 'w', encoding='utf-8') as f:
+            f.write(stripped_json)
+
+    def reset_all():
+        reset_routes()
+        for suffix in ('', '-wal', '-shm', '-journal'):
+            if os.path.exists(cache_path + suffix):
+                os.remove(cache_path + suffix)
+
+    run = lambda: add_coordinates.add_coordinates_to_routes(
+        cache_file=cache_path, gazetteer_files=[gazetteer_path], use_nominatim=False)
+    bench.run('add_coordinates.gazetteer', run, setup=reset_all)
+
+    with open(add_coordinates.ROUTES_FILE, 'r', encoding='utf-8') as f:
+        resolved = json.load(f)
+    stops = [stop for data in resolved.values() for direction in data.get('directions', [])
+             for stop in direction.get('stops', [])]
+    bench.results['add_coordinates.gazetteer'].update(
+        stops=len(stops), resolved=sum(1 for stop in stops if 'lat' in stop))
+    bench.run('add_coordinates.cached', run, setup=reset_routes)
+
+
+# --- Results --------------------------------------------------------------
+
+def metadata(args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "started_at": datetime.now().isoformat(timespec='seconds'),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "numpy": np.__version__,
+        "args": {key: value for key, value in vars(args).items() if key != 'compare'},
+    }
+
+
+def compare(baseline, current):
+    """Prints the median time and peak memory of every case against the baseline."""
+    print(f"\n{'case':<44}{'base ms':>12}{'now ms':>12}{'ratio':>8}{'base KiB':>12}{'now KiB':>12}")
+    for name, now in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None or "median_ms" not in base or "median_ms" not in now:
+            print(f"{name:<44}{'-':>12}{now.get('median_ms', '-'):>12}")
+            continue
+        ratio = now["median_ms"] / base["median_ms"] if base["median_ms"] else float('inf')
+        print(f"{name:<44}{base['median_ms']:>12.3f}{now['median_ms']:>12.3f}{ratio:>7.2f}x"
+              f"{base.get('peak_kib', '-'):>12}{now.get('peak_kib', '-'):>12}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks on a synthetic MPK feed and synthetic log days")
+    parser.add_argument('--suite', default=','.join(SUITES),
+                        help=f"comma-separated suites (default: all of {','.join(SUITES)})")
+    parser.add_argument('--repeat', type=int, default=5, help="timed runs per case")
+    parser.add_argument('--warmup', type=int, default=1, help="untimed runs per case")
+    parser.add_argument('--no-memory', action='store_true', help="skip the tracemalloc run")
+    parser.add_argument('--fixture', help="routes JSON used as fixture (default: routes.json / routes_old.json)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--vehicles-per-direction', type=int, default=1)
+    parser.add_argument('--log-days', type=int, default=2, help="synthetic log days to generate")
+    parser.add_argument('--log-hours', default='5-11', help="service hours of a log day, FIRST-LAST")
+    parser.add_argument('--log-format', choices=('binary', 'text'), default='binary')
+    parser.add_argument('--engine', default='csr', help="path_solver engine (see routing.ENGINES)")
+    parser.add_argument('--drive-graph', help="real drive graph for the path_solver suite")
+    parser.add_argument('--tram-graph', help="real tram graph for the path_solver suite")
+    parser.add_argument('--grid-spacing', type=float, default=250.0, help="synthetic street grid spacing [m]")
+    parser.add_argument('--output', help=f"result file (default: {RESULTS_DIR}/<timestamp>.json)")
+    parser.add_argument('--compare', nargs='+', metavar='RESULT',
+                        help="compare with an earlier result; with two files only compare them")
+    parser.add_argument('--keep-scratch', action='store_true', help="keep the scratch directory")
+    args = parser.parse_args(argv)
+
+    if args.compare and len(args.compare) == 2:
+        with open(args.compare[0], 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        with open(args.compare[1], 'r', encoding='utf-8') as f:
+            current = json.load(f)
+        compare(baseline, current)
+        return 0
+
+    suites = [suite.strip() for suite in args.suite.split(',') if suite.strip()]
+    unknown = set(suites) - set(SUITES)
+    if unknown:
+        parser.error(f"unknown suites: {', '.join(sorted(unknown))}")
+    args.fixture, routes_data = load_fixture(args.fixture)
+    args.fixture = os.path.abspath(args.fixture)
+    output = os.path.abspath(args.output or os.path.join(RESULTS_DIR, datetime.now().strftime('%Y%m%d-%H%M%S') + '.json'))
+
+    bench = Bench(args.repeat, args.warmup, memory=not args.no_memory)
+    report = {"meta": metadata(args), "results": bench.results, "errors": {}}
+    scratch = tempfile.mkdtemp(prefix='mpk-bench-')
+    print(f"Fixture {args.fixture}: {len(routes_data)} lines; scratch {scratch}")
+    try:
+        app_suites = [suite for suite in suites if suite in ('vehicles', 'routes', 'logged_routes')]
+        if app_suites:
+            with working_dir(scratch):
+                app, dates = prepare_app(scratch, args)
+                client = app.app.test_client()
+                for suite in app_suites:
+                    print(f"[{suite}]")
+                    if suite == 'vehicles':
+                        bench_vehicles(bench, app, client)
+                    elif suite == 'routes':
+                        bench_routes(bench, app, client)
+                    else:
+                        bench_logged_routes(bench, app, client, dates)
+                app.vehicle_poller.stop(timeout=5)
+                app.vehicle_log_writer.stop()
+        for suite, run in (('path_solver', bench_path_solver), ('add_coordinates', bench_add_coordinates)):
+            if suite not in suites:
+                continue
+            print(f"[{suite}]")
+            try:
+                with working_dir(os.path.join(scratch, suite)):
+                    run(bench, routes_data, args)
+            except ImportError as e:
+                report["errors"][suite] = f"skipped: {e}"
+                print(f"  skipped: {e}")
+    finally:
+        if not args.keep_scratch:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {output}")
+
+    if args.compare:
+        with open(args.compare[0], 'r', encoding='utf-8') as f:
+            compare(json.load(f), report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
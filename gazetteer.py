@@ -0,0 +1,190 @@
+"""
+Offline stop geocoding from a local gazetteer.
+
+The gazetteer is built from a GTFS stops.txt (or a GTFS zip) or from a
+routes.json that already has coordinates. Names are normalized once (case,
+Polish diacritics, "Pl."/"Plac"-style abbreviations, the "NŻ" on-request
+suffix, punctuation), and lookups go through an exact index first, then a
+character-trigram index for fuzzy matches. A whole dataset resolves in well
+under a second; only what it cannot match has to go to Nominatim.
+"""
+import csv
+import io
+import json
+import math
+import re
+import unicodedata
+import zipfile
+
+# Minimal Dice similarity of name trigrams for a fuzzy match, and how much
+# better than the runner-up the best candidate must be.
+FUZZY_THRESHOLD = 0.8
+FUZZY_MARGIN = 0.05
+
+# Points sharing a name (e.g. platforms of one stop) are averaged; if they are
+# spread wider than this, the name is ambiguous and is not resolved locally.
+MAX_SPREAD_M = 600.0
+
+# Variants -> canonical token, applied to normalized (ASCII, lowercase) words.
+ABBREVIATIONS = {
+    'pl': 'plac',
+    'al': 'aleja',
+    'alei': 'aleja',
+    'os': 'osiedle',
+    'osiedla': 'osiedle',
+    'ul': '',
+    'ulica': '',
+    'sw': 'swietego',
+    'swietej': 'swietego',
+    'ks': 'ksiedza',
+    'gen': 'generala',
+    'rtm': 'rotmistrza',
+    'rotm': 'rotmistrza',
+    'pkp': 'stacja kolejowa',
+    'podg': 'podgorne',
+    'nr': '',
+}
+
+# "ł" has no Unicode decomposition, so NFKD alone would drop it.
+_TRANSLATE = str.maketrans({'ł': 'l', 'Ł': 'L'})
+_ON_REQUEST = re.compile(r'\s*NŻ(Przystanek na życzenie)?\s*$')
+_NON_WORD = re.compile(r'[^a-z0-9]+')
+
+
+def normalize_name(name):
+    """Canonical form of a stop or street name used for matching."""
+    if not name:
+        return ''
+    name = _ON_REQUEST.sub('', name.strip())
+    name = unicodedata.normalize('NFKD', name.translate(_TRANSLATE))
+    name = ''.join(c for c in name if not unicodedata.combining(c)).lower()
+    words = []
+    for word in _NON_WORD.split(name):
+        word = ABBREVIATIONS.get(word, word)
+        if word:
+            words.append(word)
+    return ' '.join(words)
+
+
+def _trigrams(text):
+    padded = f'  {text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _distance_m(lat1, lon1, lat2, lon2):
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return 6_371_000.0 * math.hypot(x, y)
+
+
+def _centroid(points):
+    """Mean of the points, or None if they are spread wider than MAX_SPREAD_M."""
+    lat = sum(p[0] for p in points) / len(points)
+    lon = sum(p[1] for p in points) / len(points)
+    if any(_distance_m(lat, lon, p[0], p[1]) > MAX_SPREAD_M for p in points):
+        return None
+    return {'lat': lat, 'lon': lon}
+
+
+class Gazetteer:
+    """
+    entries -- iterable of (name, street or None, lat, lon)
+    """
+
+    def __init__(self, entries):
+        by_name = {}
+        by_name_street = {}
+        for name, street, lat, lon in entries:
+            key = normalize_name(name)
+            if not key:
+                continue
+            by_name.setdefault(key, []).append((lat, lon))
+            if street:
+                by_name_street.setdefault((key, normalize_name(street)), []).append((lat, lon))
+
+        self.names = {key: _centroid(points) for key, points in by_name.items()}
+        self.name_streets = {key: _centroid(points) for key, points in by_name_street.items()}
+
+        self._keys = list(self.names)
+        self._key_trigrams = [_trigrams(key) for key in self._keys]
+        self._trigram_index = {}
+        for i, grams in enumerate(self._key_trigrams):
+            for gram in grams:
+                self._trigram_index.setdefault(gram, []).append(i)
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def from_gtfs(cls, path):
+        """GTFS stops.txt, or a GTFS feed zip containing one."""
+        if path.endswith('.zip'):
+            with zipfile.ZipFile(path) as feed:
+                text = feed.read('stops.txt').decode('utf-8-sig')
+        else:
+            with open(path, 'r', encoding='utf-8-sig') as f:
+                text = f.read()
+        return cls(
+            (row['stop_name'], None, float(row['stop_lat']), float(row['stop_lon']))
+            for row in csv.DictReader(io.StringIO(text))
+            if row.get('stop_lat') and row.get('stop_lon')
+        )
+
+    @classmethod
+    def from_routes(cls, path):
+        """A routes.json whose stops (partly) have coordinates."""
+        with open(path, 'r', encoding='utf-8') as f:
+            routes_data = json.load(f)
+        return cls(
+            (stop['name'], stop.get('street'), stop['lat'], stop['lon'])
+            for route in routes_data.values()
+            for direction in route.get('directions', [])
+            for stop in direction.get('stops', [])
+            if stop.get('lat') is not None and stop.get('lon') is not None
+        )
+
+    @classmethod
+    def load(cls, path):
+        """Picks the reader from the file name: *.json is routes data, anything else GTFS."""
+        if path.endswith('.json'):
+            return cls.from_routes(path)
+        return cls.from_gtfs(path)
+
+    def _fuzzy(self, key):
+        grams = _trigrams(key)
+        overlap = {}
+        for gram in grams:
+            for i in self._trigram_index.get(gram, ()):
+                overlap[i] = overlap.get(i, 0) + 1
+        scored = sorted(
+            ((2 * shared / (len(grams) + len(self._key_trigrams[i])), i) for i, shared in overlap.items()),
+            reverse=True,
+        )
+        if not scored or scored[0][0] < FUZZY_THRESHOLD:
+            return None
+        if len(scored) > 1 and scored[0][0] - scored[1][0] < FUZZY_MARGIN:
+            return None
+        return self._keys[scored[0][1]]
+
+    def lookup(self, name, street=None):
+        """Returns {'lat', 'lon'} for a stop, or None if it cannot be matched reliably."""
+        key = normalize_name(name)
+        if not key:
+            return None
+        if street and street != 'N/A':
+            coords = self.name_streets.get((key, normalize_name(street)))
+            if coords:
+                return coords
+        if key in self.names:
+            return self.names[key]
+        match = self._fuzzy(key)
+        return self.names[match] if match else None
+
+    def lookup_many(self, stops):
+        """Resolves [(name, street)] in one batch; returns {(name, street): coords} for the matches."""
+        found = {}
+        for name, street in stops:
+            coords = self.lookup(name, street)
+            if coords:
+                found[(name, street)] = coords
+        return found
@@ -0,0 +1,61 @@
+import os
+import sqlite3
+import time
+
+GEOCODE_CACHE_FILE = 'mpk_viewer/data/geocode_cache.sqlite'
+
+
+class GeocodeCache:
+    """
+    Persistent (stop name, street) -> coordinates cache shared by all runs and tools.
+    Lookups that found nothing are stored too (lat/lon NULL) so they are not
+    repeated on every run.
+    """
+
+    def __init__(self, path=GEOCODE_CACHE_FILE):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=30)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS geocodes ('
+            ' name TEXT NOT NULL, street TEXT NOT NULL, lat REAL, lon REAL,'
+            ' source TEXT, updated_at REAL, PRIMARY KEY (name, street))'
+        )
+        self._db.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name, street):
+        """Returns {'lat', 'lon'}, None for a cached miss, or raises KeyError if never looked up."""
+        row = self._db.execute(
+            'SELECT lat, lon FROM geocodes WHERE name = ? AND street = ?',
+            (name, street or ''),
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            raise KeyError((name, street))
+        self.hits += 1
+        if row[0] is None:
+            return None
+        return {'lat': row[0], 'lon': row[1]}
+
+    def put_many(self, entries, source):
+        """Stores [(name, street, coords or None)] in one transaction."""
+        now = time.time()
+        with self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO geocodes (name, street, lat, lon, source, updated_at)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                [
+                    (name, street or '',
+                     coords['lat'] if coords else None,
+                     coords['lon'] if coords else None,
+                     source, now)
+                    for name, street, coords in entries
+                ],
+            )
+
+    def close(self):
+        self._db.close()
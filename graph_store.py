@@ -0,0 +1,106 @@
+import hashlib
+import os
+import pickle
+
+import networkx as nx
+import osmnx as ox
+
+from path_cache import graph_fingerprint
+
+PLACE_NAME = "Wroclaw, Poland"
+OSM_DIR = "mpk_viewer/data/osm"
+DRIVE_GRAPH_PATH = os.path.join(OSM_DIR, "drive.graphml")
+TRAM_GRAPH_PATH = os.path.join(OSM_DIR, "tram.graphml")
+GRAPH_CACHE_DIR = os.path.join(OSM_DIR, "cache")
+
+# Zmiana sposobu przycinania/łączenia grafów unieważnia cache
+CACHE_VERSION = "1"
+
+
+def fetch_networks(drive_path=DRIVE_GRAPH_PATH, tram_path=TRAM_GRAPH_PATH, place_name=PLACE_NAME):
+    """Pobiera sieć drogową i tramwajową z Overpass i zapisuje je jako GraphML"""
+    G_drive = ox.graph_from_place(place_name, network_type="drive")
+    G_tram = ox.graph_from_place(place_name, custom_filter='["railway"~"tram"]')
+    for G, path in ((G_drive, drive_path), (G_tram, tram_path)):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        ox.save_graphml(G, path)
+    return G_drive, G_tram
+
+
+def load_graph_file(path):
+    """Wczytuje graf z pliku GraphML (zapisanego przez OSMnx) albo wyciągu OSM XML"""
+    if path.endswith(".graphml"):
+        return ox.load_graphml(path)
+    if path.endswith((".osm", ".xml", ".osm.bz2", ".xml.bz2")):
+        return ox.graph_from_xml(path)
+    raise ValueError(f"Unsupported graph file: {path} (expected .graphml or OSM XML)")
+
+
+def prune_graph(G):
+    """
+    Zostawia tylko to, czego potrzebuje solver: współrzędne węzłów
+    i długości krawędzi. Graf jest kilkukrotnie mniejszy w pamięci i na dysku.
+    """
+    pruned = nx.MultiDiGraph(crs=G.graph.get("crs"))
+    pruned.add_nodes_from((node, {"x": data["x"], "y": data["y"]}) for node, data in G.nodes(data=True))
+    pruned.add_edges_from(
+        (u, v, key, {"length": data["length"]})
+        for u, v, key, data in G.edges(keys=True, data=True)
+    )
+    return pruned
+
+
+def file_hash(*paths):
+    """Skrót zawartości plików źródłowych (klucz cache)"""
+    h = hashlib.sha256(CACHE_VERSION.encode())
+    for path in paths:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()[:32]
+
+
+def load_graphs(drive_path=DRIVE_GRAPH_PATH, tram_path=TRAM_GRAPH_PATH,
+                cache_dir=GRAPH_CACHE_DIR, offline=False, log=print):
+    """
+    Zwraca (G_combined, G_drive, G_tram) z lokalnych plików.
+
+    Brakujące pliki są raz pobierane z Overpass (chyba że offline=True).
+    Połączony i przycięty graf trafia do cache (pickle) kluczowanego skrótem
+    zawartości plików źródłowych, więc kolejne uruchomienia tylko go wczytują.
+    Odcisk grafu (graph_fingerprint) jest zapisany w G_combined.graph["fingerprint"].
+    """
+    if not (os.path.exists(drive_path) and os.path.exists(tram_path)):
+        if offline:
+            raise FileNotFoundError(
+                f"Graph files {drive_path} / {tram_path} not found and running offline"
+            )
+        log(f"Graph files not found, fetching networks for {PLACE_NAME}...")
+        fetch_networks(drive_path, tram_path)
+
+    key = file_hash(drive_path, tram_path)
+    cache_path = os.path.join(cache_dir, f"{key}.pickle")
+    if os.path.exists(cache_path):
+        log(f"Loading cached graph {cache_path}")
+        with open(cache_path, "rb") as f:
+            return pickle.load(f)
+
+    log(f"Loading {drive_path} and {tram_path}...")
+    G_drive = prune_graph(load_graph_file(drive_path))
+    G_tram = prune_graph(load_graph_file(tram_path))
+    G_combined = nx.compose(G_drive, G_tram)
+    G_combined.graph["fingerprint"] = graph_fingerprint(G_combined)
+    graphs = (G_combined, G_drive, G_tram)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    for name in os.listdir(cache_dir):
+        if name.endswith(".pickle"):
+            os.remove(os.path.join(cache_dir, name))
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(graphs, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+    log(f"Cached combined graph as {cache_path}")
+    return graphs
@@ -1,13 +1,35 @@
-from flask import Flask, render_template, jsonify
+from flask import Flask, render_template, jsonify, request, Response
 from mpyk import MpykClient
 import json
+import math
 import os
 from datetime import datetime
-from pytz import timezone
 import qrcode
 import base64
 from io import BytesIO
 import logging
+import logging.handlers
+import atexit
+import queue
+import random
+import hashlib
+import threading
+
+from vehicle_feed import VehiclePoller
+from shared_feed import OwnerLock
+from map_matching import RouteMatcher
+from log_writer import VehicleLogWriter
+from vehicle_stream import DeltaBroadcaster, StreamView
+from spatial_index import parse_bbox
+import vehicle_log_store
+from playback import parse_clock, playback_ticks
+from density import CELLS_PER_TILE, DensityCache
+from logged_routes_cache import LoggedRoutesCache
+from segmentation import SegmentationParams, segment_open_records, segment_records
+from trips import TRIP_DIR, OnlineTripSegmenter, TripStore, trips_from_records
+from polyline import simplify_levels
+from route_compiler import CompiledRoutes, build_route_payload, choose_encoding
+from route_snapshot import RouteSnapshot, load_routes
 
 # --- Logging Setup ---
 # Create logs directory if it doesn't exist
@@ -21,35 +43,68 @@ missing_lines_handler = logging.FileHandler('logs/missing_lines.log')
 missing_lines_handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
 missing_lines_logger.addHandler(missing_lines_handler)
 
+# Route traces are an opt-in debug aid: ROUTE_TRACE_SAMPLE_RATE=1 traces every
+# /api/routes/<line> request, 0.01 one in a hundred. Records are handed to a
+# queue and written by a background listener, never on the request thread.
+ROUTE_TRACE_SAMPLE_RATE = float(os.environ.get('ROUTE_TRACE_SAMPLE_RATE', 0))
+route_trace_logger = logging.getLogger('route_trace')
+route_trace_logger.setLevel(logging.INFO)
+route_trace_logger.propagate = False
+if ROUTE_TRACE_SAMPLE_RATE > 0:
+    os.makedirs(os.path.join('logs', 'route_traces'), exist_ok=True)
+    route_trace_handler = logging.handlers.TimedRotatingFileHandler(
+        os.path.join('logs', 'route_traces', 'route_traces.log'), when='midnight', encoding='utf-8')
+    route_trace_handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+    route_trace_queue = queue.SimpleQueue()
+    route_trace_logger.addHandler(logging.handlers.QueueHandler(route_trace_queue))
+    route_trace_listener = logging.handlers.QueueListener(route_trace_queue, route_trace_handler)
+    route_trace_listener.start()
+    atexit.register(route_trace_listener.stop)
+
+
+def maybe_trace_route(line, line_data):
+    if ROUTE_TRACE_SAMPLE_RATE <= 0 or random.random() >= ROUTE_TRACE_SAMPLE_RATE:
+        return
+    if line_data:
+        route_trace_logger.info("Route trace for line %s: %s", line,
+                                json.dumps(line_data, ensure_ascii=False, separators=(',', ':'),
+                                           default=lambda o: o.tolist()))
+    else:
+        route_trace_logger.info("Route trace for line %s: line not found in routes.json", line)
+
 
 # --- Vehicle Data Logging Setup ---
-if not os.path.exists('vehicle_logs'):
-    os.makedirs('vehicle_logs')
+VEHICLE_LOG_DIR = 'vehicle_logs'
+# 'binary' writes fixed-width records (see vehicle_log_store.py), 'text' the original lines
+VEHICLE_LOG_FORMAT = os.environ.get('VEHICLE_LOG_FORMAT', 'binary')
+# VEHICLE_LOG_COMPACT=1 compacts closed days into archives at midnight and
+# applies the retention settings below (see vehicle_log_store.compact; the same
+# job can run from cron with `vehicle_log_store.py compact`).
+VEHICLE_LOG_COMPACT = os.environ.get('VEHICLE_LOG_COMPACT', '0') == '1'
+VEHICLE_LOG_RETENTION = {
+    'resample_s': float(os.environ.get('VEHICLE_LOG_RESAMPLE_S', 0)),
+    'resample_after_days': int(os.environ.get('VEHICLE_LOG_RESAMPLE_AFTER_DAYS', 0)),
+    'retain_days': int(os.environ.get('VEHICLE_LOG_RETAIN_DAYS', 0)),
+}
+compaction_logger = logging.getLogger('vehicle_log_compaction')
+
+
+def compact_vehicle_logs(closed_date):
+    """Runs the compaction job in the background so the log writer is not held up."""
+    def run():
+        try:
+            for date, action, before, after in vehicle_log_store.compact(VEHICLE_LOG_DIR, **VEHICLE_LOG_RETENTION):
+                compaction_logger.info(f"Vehicle logs of {date} {action}: {before} -> {after} bytes")
+        except Exception:
+            compaction_logger.exception("Compacting vehicle logs failed")
+    threading.Thread(target=run, name='vehicle-log-compaction', daemon=True).start()
 
-def setup_vehicle_logger(line):
-    log_dir = os.path.join('vehicle_logs', datetime.now().strftime('%Y-%m-%d'))
-    os.makedirs(log_dir, exist_ok=True)
-    
-    log_file = os.path.join(log_dir, f"line_{line}.log")
-    
-    logger_name = f"vehicle_data_{line}_{datetime.now().strftime('%Y%m%d')}"
-    logger = logging.getLogger(logger_name)
-    logger.setLevel(logging.INFO)
-    
-    # Prevent adding multiple handlers if the logger is re-used in the same request/app context
-    if logger.hasHandlers():
-        # Clear existing handlers to reconfigure with the correct file path for the day
-        logger.handlers.clear()
-
-    handler = logging.FileHandler(log_file, encoding='utf-8')
-    formatter = logging.Formatter('%(asctime)s - %(message)s')
-    handler.setFormatter(formatter)
-    
-    logger.addHandler(handler)
-    return logger
+
+vehicle_log_writer = VehicleLogWriter(VEHICLE_LOG_DIR, log_format=VEHICLE_LOG_FORMAT,
+                                      on_rollover=compact_vehicle_logs if VEHICLE_LOG_COMPACT else None)
+atexit.register(vehicle_log_writer.stop)
 
 app = Flask(__name__)
-client = MpykClient()
 
 # App version
 APP_VERSION = "00.01.00.00b"
@@ -60,16 +115,104 @@ AUTHOR_EMAIL = "filippawlowski2012@gmail.com"
 GITHUB_REPO = "https://github.com/kotlecikmud/MPKViewer"
 
 # Load route data from JSON file
+# (or from the memory-mapped data/routes.snap built by route_snapshot.py)
 routes_data = {}
 routes_path = os.path.join(os.path.dirname(__file__), 'data', 'routes.json')
+snapshot_path = os.path.join(os.path.dirname(__file__), 'data', 'routes.snap')
 try:
-    with open(routes_path, 'r', encoding='utf-8') as f:
-        routes_data = json.load(f)
+    routes_data = load_routes(routes_path, snapshot_path)
 except FileNotFoundError:
     print(f"Error: The file {routes_path} was not found.")
 except json.JSONDecodeError:
     print(f"Error: Could not decode JSON from {routes_path}.")
 
+
+def path_levels_for(line, data):
+    levels = []
+    for i, direction in enumerate(data.get("directions", [])):
+        # The snapshot already stores each path point's Douglas-Peucker significance.
+        sig = routes_data.significance_of(line, i) if isinstance(routes_data, RouteSnapshot) else None
+        levels.append(simplify_levels(direction.get("path", []), sig=sig))
+    return levels
+
+
+# Simplify, encode, serialize and compress each line's route on its first
+# request and keep the result; see polyline.py and route_compiler.py.
+compiled_routes = CompiledRoutes(routes_data, path_levels_for)
+
+
+# --- Live Vehicle Feed ---
+# Seconds between upstream polls; every client is served from the same snapshot.
+VEHICLE_POLL_INTERVAL = float(os.environ.get('VEHICLE_POLL_INTERVAL', 15))
+
+
+def create_client():
+    """Returns the upstream client. MPK_CLIENT=fake swaps in the offline stand-in."""
+    if os.environ.get('MPK_CLIENT') == 'fake':
+        from fake_client import FakeMpykClient
+        seed = os.environ.get('MPK_FAKE_SEED')
+        return FakeMpykClient(
+            routes_data,
+            vehicles_per_direction=int(os.environ.get('MPK_FAKE_VEHICLES', 1)),
+            latency=float(os.environ.get('MPK_FAKE_LATENCY', 0)),
+            failure_rate=float(os.environ.get('MPK_FAKE_FAILURE_RATE', 0)),
+            seed=int(seed) if seed else None,
+            layover_s=float(os.environ.get('MPK_FAKE_LAYOVER_S', 0)),
+            noise_m=float(os.environ.get('MPK_FAKE_NOISE_M', 0)),
+        )
+    return MpykClient()
+
+
+# With several worker processes one of them, the holder of this lock, polls
+# MPK and runs the background jobs; the others serve the snapshot it shares.
+# See shared_feed.py.
+BACKGROUND_LOCK = os.path.join('logs', 'background.lock')
+SHARED_SNAPSHOT = os.path.join('logs', 'vehicle_snapshot.json')
+
+
+def start_background_jobs():
+    """Runs once in the process that becomes the background owner."""
+    trip_segmenter.start(VEHICLE_LOG_DIR)
+
+
+client = create_client()
+# Snap live vehicles onto their route (direction, progress, next stop); see map_matching.py.
+# The matcher indexes every route, so the poller builds it on its first poll.
+# VEHICLE_MAP_MATCHING=0 serves raw positions only.
+vehicle_matcher_factory = (lambda: RouteMatcher(routes_data)) if os.environ.get('VEHICLE_MAP_MATCHING', '1') != '0' else None
+vehicle_poller = VehiclePoller(client, interval=VEHICLE_POLL_INTERVAL, matcher_factory=vehicle_matcher_factory,
+                               owner_lock=OwnerLock(BACKGROUND_LOCK), shared_path=SHARED_SNAPSHOT,
+                               on_owner=start_background_jobs)
+
+
+def log_missing_lines(snapshot, previous):
+    live_lines = {p.line for p in snapshot.positions}
+    missing = live_lines - set(routes_data.keys())
+    for line in missing:
+        missing_lines_logger.info(f"Line '{line}' found in live data but not in routes.json")
+
+
+def log_vehicle_positions(snapshot, previous):
+    vehicle_log_writer.submit(snapshot.fetched_at, snapshot.positions)
+
+
+vehicle_poller.add_listener(log_missing_lines, owner_only=True)
+vehicle_poller.add_listener(log_vehicle_positions, owner_only=True)
+
+vehicle_broadcaster = DeltaBroadcaster()
+vehicle_poller.add_listener(vehicle_broadcaster.on_snapshot)
+
+# Trip splitting rules for logged routes; see segmentation.py.
+SEGMENTATION_PARAMS = SegmentationParams.from_env()
+
+# Trip summaries are materialized while positions are ingested, so /api/trips
+# reads finished trips instead of re-segmenting the logs; see trips.py.
+trip_store = TripStore(os.environ.get('VEHICLE_TRIP_DIR', TRIP_DIR), SEGMENTATION_PARAMS)
+trip_segmenter = OnlineTripSegmenter(trip_store, SEGMENTATION_PARAMS)
+# Started by start_background_jobs() in the background owner only; other
+# processes answer today's trips from the logs.
+vehicle_poller.add_listener(trip_segmenter.on_snapshot, owner_only=True)
+
 @app.route('/')
 def index():
     # Sort the line numbers naturally (e.g., '2', '10', '100')
@@ -105,52 +248,72 @@ def index():
 
 @app.route('/api/vehicles')
 def get_vehicles():
-    """Returns live vehicle positions and the last update time."""
-    positions = client.get_all_positions()
-    
-    # Log missing lines
-    live_lines = {p.line for p in positions}
-    known_lines = set(routes_data.keys())
-    missing = live_lines - known_lines
-    for line in missing:
-        missing_lines_logger.info(f"Line '{line}' found in live data but not in routes.json")
-        
-    # --- Vehicle Data Logging ---
-    loggers = {}
+    """
+    Returns live vehicle positions and the last update time from the shared snapshot.
+    Vehicles matched onto their route carry a "match" object (see map_matching.py).
+    Optional filters: ?line=, ?type=bus|tram and ?bbox=west,south,east,north.
+    """
+    # Until the first poll has succeeded this is an empty snapshot, flagged stale below.
+    snapshot = vehicle_poller.get_snapshot()
+
+    line = request.args.get('line') or None
+    kind = request.args.get('type') or None
+    bbox = request.args.get('bbox')
+    if line is None and kind is None and not bbox:
+        payload, etag = snapshot.payload, snapshot.etag
+    else:
+        try:
+            bbox = parse_bbox(bbox) if bbox else None
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        payload = snapshot.index.payload(snapshot.index.query(line, kind, bbox), snapshot.last_update)
+        etag = hashlib.sha1(payload).hexdigest()
+
+    response = Response(payload, mimetype='application/json')
+    response.set_etag(etag)
+    # Clients may keep the body but must revalidate; unchanged snapshots answer 304.
+    response.headers['Cache-Control'] = 'no-cache'
+    if vehicle_poller.is_stale(snapshot):
+        response.headers['X-Data-Stale'] = '1'
+    return response.make_conditional(request)
+
+@app.route('/api/vehicles/stream')
+def stream_vehicles():
+    """
+    Server-Sent Events feed: a keyframe of all vehicles on connect, then one
+    delta per poll (added / moved / removed, keyed by course). Reconnecting
+    clients resume from Last-Event-ID when possible. With the filters of
+    /api/vehicles (?line=, ?type=, ?bbox=) only the vehicles in that view are sent.
+    """
+    line = request.args.get('line') or None
+    kind = request.args.get('type') or None
+    bbox = request.args.get('bbox')
     try:
-        for p in positions:
-            if p.line not in loggers:
-                loggers[p.line] = setup_vehicle_logger(p.line)
-            
-            log_message = f"lat={p.lat}, lon={p.lon}, type={p.kind}, line={p.line}, course={p.course}"
-            loggers[p.line].info(log_message)
-
-    except Exception as e:
-        app.logger.error(f"Failed to log vehicle data: {e}")
-    finally:
-        # Close all handlers to prevent file locking issues
-        for logger in loggers.values():
-            for handler in logger.handlers[:]:
-                handler.close()
-                logger.removeHandler(handler)
-    # --- End of Logging ---
-
-    # Get the current time in Europe/Warsaw timezone
-    tz = timezone('Europe/Warsaw')
-    last_update_time = datetime.now(tz).strftime('%Y-%m-%d %H:%M:%S')
-
-    vehicle_data = [
-        {
-            'lat': p.lat,
-            'lon': p.lon,
-            'line': p.line,
-            'type': p.kind
-        } for p in positions
-    ]
-    
+        bbox = parse_bbox(bbox) if bbox else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    view = StreamView(line, kind, bbox) if line or kind or bbox else None
+
+    vehicle_poller.get_snapshot()
+    last_seq = vehicle_broadcaster.parse_event_id(
+        request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
+    response = Response(vehicle_broadcaster.stream(last_seq, view), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream.
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/api/status')
+def get_status():
+    """Reports the health of the background poller and the vehicle log writer."""
     return jsonify({
-        "vehicles": vehicle_data,
-        "last_update": last_update_time
+        "poller": vehicle_poller.stats(),
+        "log_writer": vehicle_log_writer.stats(),
+        "stream": vehicle_broadcaster.stats(),
+        "map_matching": vehicle_poller.matcher.stats() if vehicle_poller.matcher else None,
+        "routes": compiled_routes.stats(),
+        "trips": trip_segmenter.stats(),
+        "heatmap": density_cache.stats(),
     })
 
 @app.route('/api/routes')
@@ -174,194 +337,252 @@ def get_all_routes():
 
 @app.route('/api/routes/<line>')
 def get_route(line):
-    """Returns the specific route data for a given line, using pre-existing coordinates."""
+    """
+    Returns the specific route data for a given line, using pre-existing coordinates.
+    Paths are sent as encoded polylines at several resolutions ("path_levels");
+    ?geometry=full additionally includes the raw "path" point list.
+    """
     line_data = routes_data.get(line)
-    
-    # --- Dynamic Logging for Route Traces ---
-    try:
-        # Create date-stamped directory
-        log_dir = os.path.join('logs', 'route_traces', datetime.now().strftime('%Y-%m-%d'))
-        os.makedirs(log_dir, exist_ok=True)
-        
-        # Configure a temporary logger
-        log_file = os.path.join(log_dir, f"line_{line}.log")
-        
-        logger_name = f"route_trace_{line}_{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
-        route_logger = logging.getLogger(logger_name)
-        route_logger.setLevel(logging.INFO)
-        
-        handler = logging.FileHandler(log_file, encoding='utf-8')
-        formatter = logging.Formatter('%(asctime)s - %(message)s')
-        handler.setFormatter(formatter)
-        
-        route_logger.addHandler(handler)
-        
-        route_logger.info(f"--- Route Trace for Line: {line} ---")
-        if line_data:
-            route_logger.info(json.dumps(line_data, indent=2, ensure_ascii=False))
-        else:
-            route_logger.info("Line not found in routes.json")
-        route_logger.info("--- End Trace ---")
-        
-        handler.close()
-        route_logger.removeHandler(handler)
-
-    except Exception as e:
-        app.logger.error(f"Failed to log route trace for line {line}: {e}")
-    # --- End of Logging ---
+    maybe_trace_route(line, line_data)
 
     if not line_data:
         return jsonify({"error": "Line not found"}), 404
 
-    if not line_data.get("directions"):
-        return jsonify({
-            "line": line,
-            "error": "Route details are not available for this line.",
-            "source": line_data.get("source")
-        })
-
-    processed_directions = []
-    for direction in line_data.get("directions", []):
-        processed_stops = []
-        for stop in direction.get("stops", []):
-            cleaned_name = stop["name"].replace("NŻPrzystanek na życzenie", "").strip()
-            
-            processed_stop = {
-                "name": cleaned_name,
-                "street": stop.get("street"),
-                "lat": stop.get("lat"),
-                "lon": stop.get("lon")
-            }
-            processed_stops.append(processed_stop)
-
-        processed_directions.append({
-            "direction_name": direction["direction_name"],
-            "stops": processed_stops,
-            "path": direction.get("path", [])
-        })
-
-    return jsonify({"line": line, "directions": processed_directions})
+    if request.args.get('geometry') == 'full':
+        payload, status = build_route_payload(line, line_data, compiled_routes.levels(line), full_geometry=True)
+        return jsonify(payload), status
 
+    compiled = compiled_routes[line]
+    coding = choose_encoding(compiled, request.accept_encodings)
+    response = Response(compiled.bodies[coding], status=compiled.status, mimetype='application/json')
+    if coding != 'identity':
+        response.headers['Content-Encoding'] = coding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.set_etag(compiled.etags[coding])
+    return response.make_conditional(request)
 
-from flask import request
-from datetime import timedelta
-from geopy.distance import geodesic
-import re
 
 @app.route('/api/logged_routes/dates')
 def get_logged_dates():
     """Returns a list of dates for which logs are available."""
-    log_dir = 'vehicle_logs'
-    if not os.path.exists(log_dir):
-        return jsonify([])
-    
-    dates = [d for d in os.listdir(log_dir) if os.path.isdir(os.path.join(log_dir, d))]
-    valid_dates = []
-    for date_str in dates:
-        try:
-            datetime.strptime(date_str, '%Y-%m-%d')
-            valid_dates.append(date_str)
-        except ValueError:
-            continue
-            
-    return jsonify(sorted(valid_dates, reverse=True))
+    return jsonify(vehicle_log_store.list_dates(VEHICLE_LOG_DIR))
+
+
+def build_line_routes(records):
+    """
+    Splits one line's logged records into per-vehicle routes.
+    Detects route ends on gaps and when a vehicle is stationary for more than 10 minutes.
+    """
+    return segment_records(records, SEGMENTATION_PARAMS, vehicle_log_store.COORD_SCALE)
+
+
+def build_open_line_routes(records):
+    """build_line_routes() for today's logs; see segmentation.segment_open_records."""
+    return segment_open_records(records, SEGMENTATION_PARAMS, vehicle_log_store.COORD_SCALE)
+
+
+logged_routes_cache = LoggedRoutesCache(
+    VEHICLE_LOG_DIR,
+    os.path.join('logs', 'cache', 'logged_routes'),
+    build_line_routes,
+    version=SEGMENTATION_PARAMS.key(),
+    build_open_routes=build_open_line_routes,
+)
+
+
+def trips_available(date):
+    """True if the trip store holds all trips of the date (today's: together with the open ones)."""
+    return trip_segmenter.serves(date) or trip_store.is_complete(date)
+
+
+def iter_trips(date, lines):
+    """Yields (line, trips) from the trip store, including today's trips still in progress."""
+    names = set(trip_store.lines(date)) | trip_segmenter.open_lines(date)
+    for line in (sorted(names) if lines is None else [line for line in lines if line in names]):
+        trips = trip_store.load(date, line) + trip_segmenter.open_trips(date, line)
+        trips.sort(key=lambda trip: (trip['course'], trip['start']))
+        yield line, trips
+
+
+def requested_lines():
+    """Parses the optional ?line=X / ?lines=X,Y filters; None means all lines."""
+    lines = request.args.getlist('line')
+    for value in request.args.getlist('lines'):
+        lines.extend(part.strip() for part in value.split(','))
+    lines = [line for line in lines if line]
+    return lines or None
+
+
+@app.route('/api/logged_routes/lines')
+def get_logged_lines():
+    """Returns the lines that have logs for a date, without processing them."""
+    date = request.args.get('date')
+    if not date:
+        return jsonify({"error": "Date parameter is required"}), 400
+    if not vehicle_log_store.is_date(date):
+        return jsonify({"error": "date must be given as YYYY-MM-DD"}), 400
+    return jsonify(vehicle_log_store.list_lines(date, VEHICLE_LOG_DIR))
 
 
 @app.route('/api/logged_routes')
 def get_logged_routes_for_date():
     """
-    Returns processed logged routes for a specific date.
-    Detects route ends if a vehicle is stationary for more than 10 minutes.
+    Returns processed logged routes for a specific date, optionally only for
+    the lines given in ?line= / ?lines=. With ?format=ndjson (or an
+    application/x-ndjson Accept header) the result is streamed one line per row.
     """
     date = request.args.get('date')
     if not date:
         return jsonify({"error": "Date parameter is required"}), 400
+    if not vehicle_log_store.is_date(date):
+        return jsonify({"error": "date must be given as YYYY-MM-DD"}), 400
 
-    log_dir = os.path.join('vehicle_logs', date)
+    log_dir = os.path.join(VEHICLE_LOG_DIR, date)
     if not os.path.exists(log_dir):
         return jsonify({"error": "No logs found for this date"}), 404
 
+    lines = requested_lines()
+    wants_ndjson = (request.args.get('format') == 'ndjson'
+                    or request.accept_mimetypes.best == 'application/x-ndjson')
+    if wants_ndjson:
+        def generate():
+            for line, routes in logged_routes_cache.iter_routes(date, lines):
+                if routes:
+                    yield json.dumps({"line": line, "routes": routes}, separators=(',', ':')) + '\n'
+        return Response(generate(), mimetype='application/x-ndjson')
+
     all_routes = {}
-    
-    log_pattern = re.compile(
-        r'^(?P<timestamp>\d{4}-\d{2}-\d{2}\s\d{2}:\d{2}:\d{2},\d{3})\s-\s'
-        r'lat=(?P<lat>[-?\d\.]+),\s'
-        r'lon=(?P<lon>[-?\d\.]+),\s'
-        r'type=(?P<type>\w+),\s'
-        r'line=(?P<line>[\w\d]+),\s'
-        r'course=(?P<course>\d+)'
-    )
+    for line, routes in logged_routes_cache.iter_routes(date, lines):
+        if routes:
+            all_routes[line] = routes
+    return jsonify(all_routes)
 
-    for filename in os.listdir(log_dir):
-        if filename.startswith('line_') and filename.endswith('.log'):
-            line_name = filename.replace('line_', '').replace('.log', '')
-            filepath = os.path.join(log_dir, filename)
-            
-            vehicles_points = {}
-            try:
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    for line in f:
-                        match = log_pattern.match(line)
-                        if match:
-                            data = match.groupdict()
-                            course = data['course']
-                            if course not in vehicles_points:
-                                vehicles_points[course] = []
-                            
-                            lat = float(data['lat'])
-                            lon = float(data['lon'])
-
-                            # Validate coordinates to prevent crashes with geopy
-                            if not (-90 <= lat <= 90 and -180 <= lon <= 180):
-                                app.logger.warning(f"Invalid coordinates in {filename}: lat={lat}, lon={lon}. Skipping point.")
-                                continue
-                            
-                            vehicles_points[course].append({
-                                'timestamp': datetime.strptime(data['timestamp'], '%Y-%m-%d %H:%M:%S,%f'),
-                                'lat': lat,
-                                'lon': lon
-                            })
-            except Exception as e:
-                app.logger.error(f"Error reading log file {filename}: {e}")
-                continue
-
-            line_routes = []
-            for course, points in vehicles_points.items():
-                if not points:
-                    continue
-
-                points.sort(key=lambda p: p['timestamp'])
-
-                current_route = []
-                if points:
-                    current_route.append((points[0]['lat'], points[0]['lon']))
-
-                for i in range(1, len(points)):
-                    prev_point = points[i-1]
-                    current_point = points[i]
-                    
-                    time_diff = current_point['timestamp'] - prev_point['timestamp']
-                    dist = geodesic((prev_point['lat'], prev_point['lon']), (current_point['lat'], current_point['lon'])).meters
-
-                    if time_diff > timedelta(minutes=10):
-                        if len(current_route) > 1:
-                            line_routes.append(current_route)
-                        current_route = []
-
-                    if not current_route:
-                         current_route.append((current_point['lat'], current_point['lon']))
-                    else:
-                        # Add point only if it's different from the last one to avoid redundant points
-                        if current_route[-1] != (current_point['lat'], current_point['lon']):
-                            current_route.append((current_point['lat'], current_point['lon']))
-
-                if len(current_route) > 1:
-                    line_routes.append(current_route)
-            
-            if line_routes:
-                all_routes[line_name] = line_routes
 
-    return jsonify(all_routes)
+@app.route('/api/trips')
+def get_trips():
+    """
+    Returns the trips of a date per line, optionally only for ?line= / ?lines=:
+    vehicle (course), start and end (epoch ms), number of points and length in
+    meters, without the paths (those are served by /api/logged_routes).
+    """
+    date = request.args.get('date')
+    if not date:
+        return jsonify({"error": "Date parameter is required"}), 400
+    if not vehicle_log_store.is_date(date):
+        return jsonify({"error": "date must be given as YYYY-MM-DD"}), 400
+    lines = requested_lines()
+
+    if trips_available(date):
+        line_trips = iter_trips(date, lines)
+    elif os.path.exists(os.path.join(VEHICLE_LOG_DIR, date)):
+        # Not backfilled yet: segment the logs (see trips.py backfill).
+        day = vehicle_log_store.load_day(date, VEHICLE_LOG_DIR, lines)
+        line_trips = ((line, trips_from_records(day[line], SEGMENTATION_PARAMS)) for line in sorted(day))
+    else:
+        return jsonify({"error": "No logs found for this date"}), 404
+
+    result = {}
+    for line, trips in line_trips:
+        if trips:
+            result[line] = trips
+    return jsonify(result)
+
+# Per-date density grids of the logged positions; see density.py.
+density_cache = DensityCache(VEHICLE_LOG_DIR, os.path.join('logs', 'cache', 'heatmap'),
+                             max_gap_s=SEGMENTATION_PARAMS.max_gap_s)
+# Most tiles one /api/heatmap request may cover (a full-screen map is ~40).
+HEATMAP_MAX_TILES = int(os.environ.get('HEATMAP_MAX_TILES', 100))
+
+
+@app.route('/api/heatmap')
+def get_heatmap():
+    """
+    Returns where logged vehicles of a date spent time, as grid cells of the
+    map tiles in ?bbox=west,south,east,north at ?zoom= (clamped to the zooms the
+    grids are built for): "tiles" maps "x/y" to [[cell x, cell y, count,
+    mean dwell s], ...], each tile having cells_per_tile x cells_per_tile
+    cells. Optional filters: ?line= / ?lines=, ?type=bus|tram; ?by=line|type
+    keeps cells of different lines / types apart (their name is appended).
+    """
+    date = request.args.get('date')
+    if not date or not request.args.get('bbox') or not request.args.get('zoom'):
+        return jsonify({"error": "date, bbox and zoom parameters are required"}), 400
+    if not vehicle_log_store.is_date(date):
+        return jsonify({"error": "date must be given as YYYY-MM-DD"}), 400
+    try:
+        bbox = parse_bbox(request.args['bbox'])
+        zoom = int(request.args['zoom'])
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    kind = request.args.get('type')
+    if kind is not None and kind not in vehicle_log_store.KINDS:
+        return jsonify({"error": f"type must be one of {', '.join(vehicle_log_store.KINDS)}"}), 400
+    by = request.args.get('by')
+    if by not in (None, 'line', 'type'):
+        return jsonify({"error": "by must be line or type"}), 400
+
+    if not os.path.exists(os.path.join(VEHICLE_LOG_DIR, date)):
+        return jsonify({"error": "No logs found for this date"}), 404
+
+    grid = density_cache.get(date)
+    zoom = grid.zoom_for(zoom)
+    tx0, ty0, tx1, ty1 = grid.tiles_in(zoom, bbox)
+    if (tx1 - tx0 + 1) * (ty1 - ty0 + 1) > HEATMAP_MAX_TILES:
+        return jsonify({"error": "The area is too large for this zoom level; zoom in"}), 400
+    kind_code = vehicle_log_store.KINDS.index(kind) if kind is not None else None
+    return jsonify({
+        "date": date,
+        "zoom": zoom,
+        "cells_per_tile": CELLS_PER_TILE,
+        "tiles": grid.query(zoom, bbox, requested_lines(), kind_code, by),
+    })
+
+# Longest time window one /api/playback request may cover.
+PLAYBACK_MAX_WINDOW_S = float(os.environ.get('PLAYBACK_MAX_WINDOW_S', 3600))
+# Most step-long ticks one /api/playback request may ask for (one-second steps over an hour).
+PLAYBACK_MAX_TICKS = int(os.environ.get('PLAYBACK_MAX_TICKS', 3600))
+
+
+@app.route('/api/playback')
+def get_playback():
+    """
+    Returns logged vehicle positions of a date between ?from= and ?to= (local
+    HH:MM[:SS]), grouped into ticks, optionally only for ?line= / ?lines=.
+    ?step=N merges ticks into N-second buckets (latest position per vehicle).
+    Only the part of each log covering the window is read (see playback.py).
+    """
+    date = request.args.get('date')
+    if not date or not request.args.get('from') or not request.args.get('to'):
+        return jsonify({"error": "date, from and to parameters are required"}), 400
+    if not vehicle_log_store.is_date(date):
+        return jsonify({"error": "date must be given as YYYY-MM-DD"}), 400
+    try:
+        start_ms = parse_clock(date, request.args['from'])
+        end_ms = parse_clock(date, request.args['to'])
+        step_s = float(request.args.get('step', 0))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if end_ms <= start_ms:
+        return jsonify({"error": "to must be later than from"}), 400
+    if end_ms - start_ms > PLAYBACK_MAX_WINDOW_S * 1000:
+        return jsonify({"error": f"The window may be at most {PLAYBACK_MAX_WINDOW_S:g} seconds long"}), 400
+    if not math.isfinite(step_s) or step_s < 0:
+        return jsonify({"error": "step must be a non-negative number of seconds"}), 400
+    if step_s and (end_ms - start_ms) / (step_s * 1000) > PLAYBACK_MAX_TICKS:
+        return jsonify({"error": f"step is too small; the window may hold at most {PLAYBACK_MAX_TICKS} steps"}), 400
+
+    if not os.path.exists(os.path.join(VEHICLE_LOG_DIR, date)):
+        return jsonify({"error": "No logs found for this date"}), 404
+
+    lines = requested_lines()
+    window = vehicle_log_store.load_window(date, start_ms, end_ms, VEHICLE_LOG_DIR, lines)
+    return jsonify({
+        "date": date,
+        "from": start_ms,
+        "to": end_ms,
+        "step": step_s,
+        "ticks": playback_ticks(window, start_ms, int(step_s * 1000)),
+    })
 
 if __name__ == '__main__':
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,302 @@
+"""
+Density grids of logged vehicle positions for /api/heatmap.
+
+A day's records are binned onto the web map's tile pyramid: every tile of
+zooms MIN_ZOOM..MAX_ZOOM is split into CELLS_PER_TILE x CELLS_PER_TILE cells,
+and each (cell, line) gets
+
+* count   -- logged positions in the cell,
+* seconds -- vehicle-seconds spent there (each position counts until the
+             vehicle's next one, unless a gap of more than max_gap_s follows),
+* visits  -- times a vehicle entered the cell,
+
+so seconds / visits is the mean dwell per visit: high at depots, termini and
+congestion hot spots. Binning is one np.unique over 64-bit keys per zoom, laid
+out tile first, so the rows of a tile are contiguous and a viewport query is a
+few binary searches. Grids are built once per date and cached by DensityCache.
+"""
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+
+import vehicle_log_store
+
+log = logging.getLogger(__name__)
+
+MIN_ZOOM = 10
+MAX_ZOOM = 16
+CELL_BITS = 6
+CELLS_PER_TILE = 1 << CELL_BITS
+LINE_BITS = 16
+MAX_LAT = 85.05112878
+
+# key = tile x | tile y | cell x | cell y | line code, from the highest bits down
+_TILE_BITS = MAX_ZOOM
+_Y_SHIFT = LINE_BITS + 2 * CELL_BITS
+_X_SHIFT = _Y_SHIFT + _TILE_BITS
+
+
+def _tile_key(tx, ty):
+    """Smallest key of tile (tx, ty)."""
+    return (np.int64(tx) << _X_SHIFT) | (np.int64(ty) << _Y_SHIFT)
+
+
+def cell_coords(lat, lon, zoom):
+    """Global cell coordinates (tile * CELLS_PER_TILE + cell) of positions at a zoom level."""
+    lat = np.clip(np.asarray(lat, dtype=np.float64), -MAX_LAT, MAX_LAT)
+    x = (np.asarray(lon, dtype=np.float64) + 180.0) / 360.0
+    y = (1.0 - np.arcsinh(np.tan(np.radians(lat))) / math.pi) / 2.0
+    scale = 1 << (zoom + CELL_BITS)
+    return (np.clip(np.floor(x * scale), 0, scale - 1).astype(np.int64),
+            np.clip(np.floor(y * scale), 0, scale - 1).astype(np.int64))
+
+
+def _encode(gx, gy, line_code):
+    ix, iy = gx & (CELLS_PER_TILE - 1), gy & (CELLS_PER_TILE - 1)
+    return (((gx >> CELL_BITS) << _X_SHIFT) | ((gy >> CELL_BITS) << _Y_SHIFT)
+            | (ix << (LINE_BITS + CELL_BITS)) | (iy << LINE_BITS) | line_code)
+
+
+def _decode(keys):
+    """Inverse of _encode(): (gx, gy, line code)."""
+    cell_mask = CELLS_PER_TILE - 1
+    gx = ((keys >> _X_SHIFT) << CELL_BITS) | ((keys >> (LINE_BITS + CELL_BITS)) & cell_mask)
+    gy = (((keys >> _Y_SHIFT) & ((1 << _TILE_BITS) - 1)) << CELL_BITS) | ((keys >> LINE_BITS) & cell_mask)
+    return gx, gy, keys & ((1 << LINE_BITS) - 1)
+
+
+class DensityGrid:
+    """
+    Density grids of one day.
+
+    lines  -- line names; the line code of a row indexes this array
+    kinds  -- vehicle_log_store kind code of every line
+    levels -- {zoom: {'key', 'count', 'seconds', 'visits'}}
+    """
+
+    def __init__(self, lines, kinds, levels):
+        self.lines = lines
+        self.kinds = kinds
+        self.levels = levels
+
+    @classmethod
+    def build(cls, day, max_gap_s=600.0, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM):
+        """Bins {line: records} (vehicle_log_store.load_day) into every zoom level."""
+        parts = [records for records in day.values() if len(records)]
+        records = np.concatenate(parts) if parts else np.zeros(0, dtype=vehicle_log_store.RECORD_DTYPE)
+        records = records[np.lexsort((records['ts'], records['course']))]
+        lines, line_code = np.unique(records['line'], return_inverse=True)
+        if len(lines) > 1 << LINE_BITS:
+            raise ValueError(f"Too many lines for a density grid: {len(lines)}")
+        line_code = line_code.reshape(-1).astype(np.int64)
+        kinds = np.full(len(lines), vehicle_log_store.UNKNOWN_KIND, dtype=np.uint8)
+        kinds[line_code[::-1]] = records['kind'][::-1]  # first record of each line wins
+
+        # Time until the same vehicle's next position; nothing is known across gaps.
+        same = records['course'][1:] == records['course'][:-1]
+        step = np.diff(records['ts']) / 1000
+        followed = same & (step <= max_gap_s)
+        seconds = np.r_[np.where(followed, step, 0.0), 0.0]
+        continued = np.r_[False, followed]
+
+        lat = records['lat'] / vehicle_log_store.COORD_SCALE
+        lon = records['lon'] / vehicle_log_store.COORD_SCALE
+        gx, gy = cell_coords(lat, lon, max_zoom)
+
+        # Bin the positions once at the finest level; coarser cells are unions
+        # of finer ones, so they are aggregated from the (far fewer) fine rows.
+        fine, inverse = np.unique(_encode(gx, gy, line_code), return_inverse=True)
+        inverse = inverse.reshape(-1)
+        fine_count = np.bincount(inverse, minlength=len(fine))
+        fine_seconds = np.bincount(inverse, weights=seconds, minlength=len(fine))
+        fine_gx, fine_gy, fine_line = _decode(fine)
+
+        levels = {}
+        for zoom in range(max_zoom, min_zoom - 1, -1):
+            shift = max_zoom - zoom
+            zx, zy = gx >> shift, gy >> shift
+            # A visit starts where a vehicle enters a cell of this level (or reappears).
+            entered = np.r_[True, (zx[1:] != zx[:-1]) | (zy[1:] != zy[:-1])] | ~continued
+            fine_visits = np.bincount(inverse, weights=entered, minlength=len(fine))
+            keys, level_inverse = np.unique(_encode(fine_gx >> shift, fine_gy >> shift, fine_line),
+                                            return_inverse=True)
+            level_inverse = level_inverse.reshape(-1)
+            levels[zoom] = {
+                'key': keys,
+                'count': np.bincount(level_inverse, weights=fine_count, minlength=len(keys)).astype(np.uint32),
+                'seconds': np.bincount(level_inverse, weights=fine_seconds, minlength=len(keys)).astype(np.float32),
+                'visits': np.bincount(level_inverse, weights=fine_visits, minlength=len(keys)).astype(np.uint32),
+            }
+        return cls(lines, kinds, levels)
+
+    def save(self, path):
+        arrays = {'lines': self.lines, 'kinds': self.kinds}
+        for zoom, level in self.levels.items():
+            arrays.update({f"{name}_{zoom}": values for name, values in level.items()})
+        # Per process: several app workers may write the same cache file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            levels = {}
+            for name in data.files:
+                if name.startswith('key_'):
+                    zoom = int(name[len('key_'):])
+                    levels[zoom] = {field: data[f"{field}_{zoom}"] for field in ('key', 'count', 'seconds', 'visits')}
+            return cls(data['lines'], data['kinds'], levels)
+
+    def zoom_for(self, zoom):
+        return min(max(int(zoom), min(self.levels)), max(self.levels))
+
+    def tiles_in(self, zoom, bbox):
+        """(tx0, ty0, tx1, ty1) of the tiles covering bbox = (south, west, north, east)."""
+        south, west, north, east = bbox
+        (gx0, gx1), (gy0, gy1) = cell_coords([north, south], [west, east], zoom)
+        return gx0 >> CELL_BITS, gy0 >> CELL_BITS, gx1 >> CELL_BITS, gy1 >> CELL_BITS
+
+    def query(self, zoom, bbox, lines=None, kind=None, by=None):
+        """
+        Cells of the tiles covering bbox at a zoom level, optionally only for
+        some lines or one vehicle type, summed over all lines or kept apart per
+        line / type (by='line' / 'type'). Returns
+        {"x/y": [[cell x, cell y, count, mean dwell s(, line or type)], ...]}.
+        """
+        level = self.levels[zoom]
+        keys = level['key']
+        tx0, ty0, tx1, ty1 = self.tiles_in(zoom, bbox)
+        bounds = np.searchsorted(keys, [(_tile_key(tx, ty0), _tile_key(tx, ty1 + 1)) for tx in range(tx0, tx1 + 1)])
+        rows = np.concatenate([np.arange(i, j) for i, j in bounds]) if len(bounds) else np.zeros(0, dtype=np.int64)
+
+        line_code = keys[rows] & ((1 << LINE_BITS) - 1)
+        selected = np.ones(len(rows), dtype=bool)
+        if lines is not None:
+            selected &= np.isin(line_code, np.flatnonzero(np.isin(self.lines, [line.encode('ascii', 'replace') for line in lines])))
+        if kind is not None:
+            selected &= self.kinds[line_code] == kind
+        rows, line_code = rows[selected], line_code[selected]
+
+        if by == 'line':
+            group = line_code
+        elif by == 'type':
+            group = self.kinds[line_code].astype(np.int64)
+        else:
+            group = np.zeros(len(rows), dtype=np.int64)
+        cells, inverse = np.unique(((keys[rows] >> LINE_BITS) << LINE_BITS) | group, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        count = np.bincount(inverse, weights=level['count'][rows], minlength=len(cells))
+        seconds = np.bincount(inverse, weights=level['seconds'][rows], minlength=len(cells))
+        visits = np.bincount(inverse, weights=level['visits'][rows], minlength=len(cells))
+        dwell = np.round(seconds / np.maximum(visits, 1), 1)
+
+        tx = (cells >> _X_SHIFT).tolist()
+        ty = ((cells >> _Y_SHIFT) & ((1 << _TILE_BITS) - 1)).tolist()
+        ix = ((cells >> (LINE_BITS + CELL_BITS)) & (CELLS_PER_TILE - 1)).tolist()
+        iy = ((cells >> LINE_BITS) & (CELLS_PER_TILE - 1)).tolist()
+        count, dwell = count.astype(np.int64).tolist(), dwell.tolist()
+        if by == 'line':
+            names = [line.decode('ascii', 'replace') for line in self.lines.tolist()]
+            labels = [names[code] for code in (cells & ((1 << LINE_BITS) - 1)).tolist()]
+        elif by == 'type':
+            labels = [vehicle_log_store.kind_name(code) for code in (cells & ((1 << LINE_BITS) - 1)).tolist()]
+
+        tiles = {}
+        for i in range(len(cells)):
+            cell = [ix[i], iy[i], count[i], dwell[i]]
+            if by:
+                cell.append(labels[i])
+            tiles.setdefault(f"{tx[i]}/{ty[i]}", []).append(cell)
+        return tiles
+
+    def stats(self):
+        return {"lines": len(self.lines), "cells": {zoom: len(level['key']) for zoom, level in self.levels.items()}}
+
+
+class DensityCache:
+    """
+    Builds DensityGrids on demand and keeps the most recent ones.
+
+    Closed days are also persisted to cache_dir, keyed by the parameters and
+    the signature of the day's log files (so they are rebuilt after e.g. a
+    compaction). Today's grid is rebuilt when it is older than today_ttl_s.
+    """
+
+    def __init__(self, log_root, cache_dir, max_gap_s=600.0, max_dates=4, today_ttl_s=300.0):
+        self.log_root = log_root
+        self.cache_dir = cache_dir
+        self.max_gap_s = max_gap_s
+        self.max_dates = max_dates
+        self.today_ttl_s = today_ttl_s
+        self._grids = OrderedDict()
+        self._lock = threading.Lock()
+        self.builds = 0
+        self.last_build_seconds = None
+
+    def _signature(self, date):
+        files = [path for paths in vehicle_log_store.line_files(date, self.log_root).values() for path in paths]
+        parts = [f"{os.path.basename(path)}:{os.stat(path).st_size}:{os.stat(path).st_mtime_ns}" for path in files]
+        key = f"gap={self.max_gap_s},zooms={MIN_ZOOM}-{MAX_ZOOM},cells={CELLS_PER_TILE}|" + '|'.join(parts)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+
+    def get(self, date):
+        # The date becomes part of a file name; never let it leave cache_dir.
+        if not vehicle_log_store.is_date(date):
+            raise ValueError(f"Invalid date {date!r}; expected YYYY-MM-DD")
+        today = datetime.now().strftime('%Y-%m-%d')
+        with self._lock:
+            entry = self._grids.get(date)
+            if entry is not None:
+                grid, built_at = entry
+                if date < today or time.monotonic() - built_at < self.today_ttl_s:
+                    self._grids.move_to_end(date)
+                    return grid
+
+            signature = self._signature(date)
+            path = os.path.join(self.cache_dir, f"{date}-{signature}.npz")
+            grid = None
+            if date < today and os.path.exists(path):
+                try:
+                    grid = DensityGrid.load(path)
+                except (OSError, ValueError, KeyError) as e:
+                    log.warning(f"Ignoring unreadable density cache {path}: {e}")
+            if grid is None:
+                t0 = time.perf_counter()
+                grid = DensityGrid.build(vehicle_log_store.load_day(date, self.log_root), self.max_gap_s)
+                self.builds += 1
+                self.last_build_seconds = round(time.perf_counter() - t0, 2)
+                if date < today:
+                    self._persist(date, path, grid)
+
+            self._grids[date] = (grid, time.monotonic())
+            self._grids.move_to_end(date)
+            while len(self._grids) > self.max_dates:
+                self._grids.popitem(last=False)
+            return grid
+
+    def _persist(self, date, path, grid):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            for name in os.listdir(self.cache_dir):
+                if name.startswith(f"{date}-"):
+                    os.remove(os.path.join(self.cache_dir, name))
+            grid.save(path)
+        except OSError as e:
+            log.warning(f"Could not persist density cache {path}: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "dates": list(self._grids),
+                "builds": self.builds,
+                "last_build_seconds": self.last_build_seconds,
+            }
@@ -0,0 +1,161 @@
+"""
+Offline stand-in for mpyk.MpykClient.
+
+Generates vehicles that move along the routes in routes.json so the vehicle
+poller (and everything behind it) can be exercised and load-tested without
+talking to MPK. Select it with MPK_CLIENT=fake when starting app.py.
+
+Every vehicle drives its direction at its own speed, waits at the terminus
+and starts over; optionally it only runs during its share of the service
+hours and reports positions with GPS noise. All randomness comes from `seed`
+and time from `clock`, so a simulated day (see synthetic_logs.py) is the
+same on every run.
+"""
+import bisect
+import math
+import random
+import time
+from datetime import datetime
+
+from mpyk import MpykTransLoc
+
+EARTH_RADIUS_M = 6_371_008.8
+
+
+def _distance_m(a, b):
+    """Equirectangular distance between two (lat, lon) points; plenty for stop spacing."""
+    lat = math.radians((a[0] + b[0]) / 2)
+    dx = math.radians(b[1] - a[1]) * math.cos(lat)
+    dy = math.radians(b[0] - a[0])
+    return EARTH_RADIUS_M * math.hypot(dx, dy)
+
+
+class _Vehicle:
+    __slots__ = ('line', 'kind', 'course', 'track', 'cumulative', 'offset', 'speed_mps',
+                 'layover_s', 'on_duty')
+
+    def __init__(self, line, kind, course, track, cumulative, offset, speed_mps, layover_s, on_duty):
+        self.line = line
+        self.kind = kind
+        self.course = course
+        self.track = track
+        self.cumulative = cumulative
+        self.offset = offset
+        self.speed_mps = speed_mps
+        self.layover_s = layover_s
+        self.on_duty = on_duty
+
+
+class FakeMpykClient:
+    """
+    Mimics MpykClient.get_all_positions() for every line that has coordinates.
+
+    latency       -- seconds each call sleeps, to emulate a slow upstream
+    failure_rate  -- probability (0..1) that a call raises, to emulate outages
+    speed_mps     -- mean speed of the simulated vehicles along their route
+                     (each vehicle gets its own, within +-20%)
+    layover_s     -- longest wait at the terminus before the next run
+    noise_m       -- standard deviation of the GPS noise added to each position
+    service_hours -- (first, last) local hour of service; each vehicle starts
+                     and ends its duty at its own time within it and is not
+                     reported outside it. None keeps every vehicle running.
+    clock         -- returns the current epoch time in seconds
+    """
+
+    def __init__(self, routes_data, vehicles_per_direction=1, latency=0.0, failure_rate=0.0,
+                 speed_mps=8.0, seed=None, layover_s=0.0, noise_m=0.0, service_hours=None,
+                 clock=time.time):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.speed_mps = speed_mps
+        self.noise_m = noise_m
+        self.clock = clock
+        self._random = random.Random(seed)
+        self._vehicles = []
+
+        course = 1
+        for line, data in routes_data.items():
+            kind = data.get('type', 'bus')
+            for direction in data.get('directions', []):
+                track = self._track_for(direction)
+                if len(track) < 2:
+                    continue
+                cumulative = [0.0]
+                for a, b in zip(track, track[1:]):
+                    cumulative.append(cumulative[-1] + _distance_m(a, b))
+                if cumulative[-1] <= 0:
+                    continue
+                for _ in range(vehicles_per_direction):
+                    self._vehicles.append(_Vehicle(
+                        line, kind, course, track, cumulative,
+                        offset=self._random.random(),
+                        speed_mps=speed_mps * self._random.uniform(0.8, 1.2),
+                        layover_s=layover_s * self._random.uniform(0.5, 1.0),
+                        on_duty=self._duty_for(service_hours),
+                    ))
+                    course += 1
+
+    def _duty_for(self, service_hours):
+        """Seconds after local midnight the vehicle enters and leaves service."""
+        if service_hours is None:
+            return None
+        first, last = (hour * 3600 for hour in service_hours)
+        span = max(0, last - first)
+        start = first + self._random.uniform(0, 0.15) * span
+        end = last - self._random.uniform(0, 0.15) * span
+        return start, end
+
+    @staticmethod
+    def _track_for(direction):
+        path = direction.get('path')
+        if path is not None and len(path):
+            # Paths are lists when loaded from routes.json, NumPy views from routes.snap.
+            points = path.tolist() if hasattr(path, 'tolist') else path
+            return [tuple(point) for point in points]
+        return [
+            (stop['lat'], stop['lon'])
+            for stop in direction.get('stops', [])
+            if stop.get('lat') is not None and stop.get('lon') is not None
+        ]
+
+    @staticmethod
+    def _position_on(vehicle, distance):
+        cumulative = vehicle.cumulative
+        i = min(max(bisect.bisect_right(cumulative, distance) - 1, 0), len(cumulative) - 2)
+        span = cumulative[i + 1] - cumulative[i]
+        t = (distance - cumulative[i]) / span if span > 0 else 0.0
+        (lat1, lon1), (lat2, lon2) = vehicle.track[i], vehicle.track[i + 1]
+        return lat1 + (lat2 - lat1) * t, lon1 + (lon2 - lon1) * t
+
+    def _add_noise(self, lat, lon):
+        dy = self._random.gauss(0.0, self.noise_m)
+        dx = self._random.gauss(0.0, self.noise_m)
+        lat += math.degrees(dy / EARTH_RADIUS_M)
+        lon += math.degrees(dx / (EARTH_RADIUS_M * math.cos(math.radians(lat))))
+        return lat, lon
+
+    def get_all_positions(self):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and self._random.random() < self.failure_rate:
+            raise ValueError("Error from API: 503 (simulated)")
+
+        now = self.clock()
+        local = datetime.fromtimestamp(now)
+        seconds_of_day = local.hour * 3600 + local.minute * 60 + local.second + local.microsecond / 1e6
+        timestamp = datetime.utcfromtimestamp(int(now))
+        positions = []
+        for vehicle in self._vehicles:
+            if vehicle.on_duty is not None and not vehicle.on_duty[0] <= seconds_of_day < vehicle.on_duty[1]:
+                continue
+            length = vehicle.cumulative[-1]
+            # One run takes length / speed (at least a minute), then the vehicle waits at the terminus.
+            run_s = max(60.0, length / vehicle.speed_mps)
+            cycle_s = run_s + vehicle.layover_s
+            elapsed = (vehicle.offset * cycle_s + now) % cycle_s
+            lat, lon = self._position_on(vehicle, min(elapsed / run_s, 1.0) * length)
+            if self.noise_m:
+                lat, lon = self._add_noise(lat, lon)
+            positions.append(MpykTransLoc(kind=vehicle.kind, line=vehicle.line, course=vehicle.course,
+                                          timestamp=timestamp, lat=lat, lon=lon))
+        return positions
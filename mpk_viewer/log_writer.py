@@ -0,0 +1,270 @@
+"""
+Asynchronous writer for vehicle_logs/<date>/line_<line>.{log,bin}.
+
+The poller hands each snapshot to submit(), which only enqueues it. A single
+background thread keeps the per-day, per-line files open, appends whole batches
+at once and rolls over to a new directory at midnight, so neither the poller
+nor any HTTP request waits on disk. Alongside every log it appends the
+per-minute time index read by vehicle_log_store.load_window(). After a
+rollover, once the previous day's files are closed, it calls on_rollover
+(e.g. to compact the closed day).
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+import vehicle_log_store
+
+log = logging.getLogger(__name__)
+
+
+def format_text_record(timestamp, p):
+    """Formats one position exactly like the old logging.FileHandler output."""
+    dt = datetime.fromtimestamp(timestamp)
+    asctime = dt.strftime('%Y-%m-%d %H:%M:%S') + f",{dt.microsecond // 1000:03d}"
+    return f"{asctime} - lat={p.lat}, lon={p.lon}, type={p.kind}, line={p.line}, course={p.course}\n"
+
+
+class VehicleLogWriter:
+    """
+    Bounded-queue log writer.
+
+    max_queue      -- snapshots that may wait for the writer; beyond that new
+                      snapshots are dropped (and counted) instead of blocking
+    flush_interval -- seconds between flushes of the open files
+    log_format     -- 'text' for the original line format, 'binary' for the
+                      fixed-width records of vehicle_log_store
+    on_rollover    -- callable(date) run on the writer thread when no file of
+                      that (closed) date is open any more; keep it short
+    """
+
+    def __init__(self, root='vehicle_logs', max_queue=256, flush_interval=1.0, log_format='text',
+                 on_rollover=None):
+        if log_format not in ('text', 'binary'):
+            raise ValueError(f"Unknown vehicle log format: {log_format}")
+        self.root = root
+        self.log_format = log_format
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._files = {}
+        # (date, line) -> [index file, last indexed minute]; None if the log cannot be indexed
+        self._indexes = {}
+        self._current_date = None
+        self._closed_date = None
+        self.on_rollover = on_rollover
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.written_records = 0
+        self.dropped_records = 0
+        self.batches = 0
+        self.last_error = None
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='vehicle-log-writer', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5.0):
+        """Writes everything still queued, then closes all files."""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def submit(self, timestamp, positions):
+        """Queues one poll's positions; never blocks. Returns False if dropped."""
+        self.start()
+        try:
+            self._queue.put_nowait((timestamp, positions))
+            return True
+        except queue.Full:
+            self.dropped_records += len(positions)
+            return False
+
+    def stats(self):
+        return {
+            "running": self._thread is not None and self._thread.is_alive(),
+            "queue_depth": self._queue.qsize(),
+            "queue_capacity": self._queue.maxsize,
+            "open_files": len(self._files),
+            "written_records": self.written_records,
+            "dropped_records": self.dropped_records,
+            "batches": self.batches,
+            "last_error": self.last_error,
+        }
+
+    def _run(self):
+        last_flush = time.monotonic()
+        running = True
+        while running:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = ()
+
+            batch = []
+            if item is None:
+                running = False
+            elif item:
+                batch.append(item)
+            # Drain whatever else is waiting so it lands in the same write calls.
+            while running:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                else:
+                    batch.append(item)
+
+            if batch:
+                try:
+                    self._write_batch(batch)
+                except Exception as e:
+                    self.last_error = f"{type(e).__name__}: {e}"
+                    log.exception("Failed to write vehicle log batch")
+
+            if not running or time.monotonic() - last_flush >= self.flush_interval:
+                self._flush()
+                last_flush = time.monotonic()
+
+        self._close_all()
+
+    def _write_batch(self, batch):
+        grouped = {}
+        count = 0
+        for timestamp, positions in batch:
+            date = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d')
+            for p in positions:
+                grouped.setdefault((date, p.line), []).append((timestamp, p))
+                count += 1
+
+        for (date, line), items in grouped.items():
+            f = self._file_for(date, line)
+            data, minutes = self._encode(items)
+            self._index(date, line, f.tell(), minutes)
+            f.write(data)
+        self.written_records += count
+        self.batches += 1
+
+        if self._closed_date is not None:
+            # Late records of the previous day can only be in the batch that
+            # rolled over (the queue is in poll order), so its files are final now.
+            closed, self._closed_date = self._closed_date, None
+            self._close_earlier_days()
+            if self.on_rollover is not None:
+                try:
+                    self.on_rollover(closed)
+                except Exception:
+                    log.exception(f"Rollover handler failed for {closed}")
+
+    def _encode(self, items):
+        """Returns (bytes, [(epoch minute, offset in bytes)]) for the first record of each poll."""
+        chunks = []
+        minutes = []
+        size = 0
+        start = 0
+        # Positions of one poll share a timestamp, so encode them per poll.
+        for i in range(1, len(items) + 1):
+            if i == len(items) or items[i][0] != items[start][0]:
+                timestamp = items[start][0]
+                if self.log_format == 'text':
+                    chunk = ''.join(format_text_record(timestamp, p) for _, p in items[start:i]).encode('utf-8')
+                else:
+                    chunk = vehicle_log_store.encode_records(timestamp, [p for _, p in items[start:i]])
+                minutes.append((int(round(timestamp * 1000)) // vehicle_log_store.MINUTE_MS, size))
+                chunks.append(chunk)
+                size += len(chunk)
+                start = i
+        return b''.join(chunks), minutes
+
+    def _index(self, date, line, base, minutes):
+        state = self._indexes.get((date, line))
+        if state is None:
+            return
+        entries = []
+        for minute, offset in minutes:
+            if minute > state[1]:
+                entries.append((minute, base + offset))
+                state[1] = minute
+        if entries:
+            state[0].write(vehicle_log_store.encode_index_entries(entries))
+
+    def _file_for(self, date, line):
+        if date != self._current_date:
+            if self._current_date is not None and date < self._current_date:
+                # A late record from the previous day; append without a rollover.
+                return self._open(date, line)
+            self._close_all()
+            self._closed_date = self._current_date
+            self._current_date = date
+        return self._open(date, line)
+
+    def _open(self, date, line):
+        key = (date, line)
+        f = self._files.get(key)
+        if f is None:
+            log_dir = os.path.join(self.root, date)
+            os.makedirs(log_dir, exist_ok=True)
+            suffix = vehicle_log_store.TEXT_SUFFIX if self.log_format == 'text' else vehicle_log_store.BINARY_SUFFIX
+            path = os.path.join(log_dir, f"line_{line}{suffix}")
+            f = open(path, 'ab')
+            if suffix == vehicle_log_store.BINARY_SUFFIX and f.tell() == 0:
+                f.write(vehicle_log_store.file_header())
+            self._files[key] = f
+            self._indexes[key] = self._open_index(path, f.tell())
+        return f
+
+    def _open_index(self, path, size):
+        """
+        Opens the log's time index for appending. An existing log is indexed
+        from its contents first, so a stale index (e.g. after a crash) is replaced.
+        """
+        if size <= vehicle_log_store.first_record_offset(path):
+            index_file = open(vehicle_log_store.index_path(path), 'wb')
+            index_file.write(vehicle_log_store.index_header())
+            return [index_file, -1]
+
+        index = vehicle_log_store.build_index(path)
+        vehicle_log_store.write_index(path, index)
+        if index is None:
+            log.warning(f"{path} is not in time order; it will not be indexed")
+            return None
+        last_minute = int(index['minute'][-1]) if len(index) else -1
+        return [open(vehicle_log_store.index_path(path), 'ab'), last_minute]
+
+    def _open_files(self):
+        # Logs first, so a flushed index entry never points past the flushed log.
+        return list(self._files.values()) + [state[0] for state in self._indexes.values() if state]
+
+    def _flush(self):
+        for f in self._open_files():
+            try:
+                f.flush()
+            except OSError as e:
+                self.last_error = f"{type(e).__name__}: {e}"
+
+    def _close_earlier_days(self):
+        """Closes files reopened for late records of days before the current one."""
+        keys = [key for key in self._files if key[0] < self._current_date]
+        states = [self._indexes.pop(key, None) for key in keys]
+        for f in [self._files.pop(key) for key in keys] + [state[0] for state in states if state]:
+            try:
+                f.close()
+            except OSError:
+                pass
+
+    def _close_all(self):
+        for f in self._open_files():
+            try:
+                f.close()
+            except OSError:
+                pass
+        self._files.clear()
+        self._indexes.clear()
@@ -0,0 +1,213 @@
+"""
+Result cache for /api/logged_routes.
+
+Each line of a date is cached together with the (size, mtime) signature of its
+log files. A line is only rebuilt when its files change:
+
+* closed days are persisted as one JSON artifact per date, so after the first
+  request (or a restart) they are served without touching the logs at all;
+* for the current day only the bytes appended since the previous request are
+  parsed. With build_open_routes only each vehicle's records since its last
+  settled route are segmented again: the routes no later sample can change are
+  kept, and only the records after them stay in memory (see
+  segmentation.segment_open_records). Without it the whole day so far is
+  segmented again on every change.
+"""
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+
+import vehicle_log_store
+
+log = logging.getLogger(__name__)
+
+
+def _file_signature(path):
+    st = os.stat(path)
+    return [os.path.basename(path), st.st_size, st.st_mtime_ns]
+
+
+def _check_date(date):
+    # The date becomes part of a file name; never let it leave cache_dir.
+    if not vehicle_log_store.is_date(date):
+        raise ValueError(f"Invalid date {date!r}; expected YYYY-MM-DD")
+
+
+class _LineEntry:
+    """
+    records are those not segmented for good yet: all of the day so far, or
+    with build_open_routes the pending ones; settled holds {course: routes}
+    finished before them.
+    """
+    __slots__ = ('signature', 'routes', 'offsets', 'records', 'settled')
+
+    def __init__(self, signature, routes, offsets=None, records=None, settled=None):
+        self.signature = signature
+        self.routes = routes
+        self.offsets = offsets
+        self.records = records
+        self.settled = settled
+
+
+class LoggedRoutesCache:
+    """
+    build_routes      -- callable(records) -> list of routes for one line
+    build_open_routes -- optional callable(records) -> (routes, settled, pending)
+                         for the current day, like segmentation.segment_open_records;
+                         must give the same routes as build_routes
+    version           -- anything that changes the output of build_routes (e.g. its
+                         parameters); persisted artifacts with another version are ignored
+    max_dates         -- closed days kept in memory besides the current one
+    """
+
+    def __init__(self, log_root, cache_dir, build_routes, version='1', max_dates=8,
+                 build_open_routes=None):
+        self.log_root = log_root
+        self.cache_dir = cache_dir
+        self.build_routes = build_routes
+        self.build_open_routes = build_open_routes
+        self.version = str(version)
+        self.max_dates = max_dates
+        self._dates = OrderedDict()
+        self._lock = threading.RLock()
+
+    def iter_routes(self, date, lines=None):
+        """Yields (line, routes) for the date in line order, building lazily."""
+        _check_date(date)
+        files = vehicle_log_store.line_files(date, self.log_root)
+        names = sorted(files) if lines is None else [line for line in lines if line in files]
+        closed = date < datetime.now().strftime('%Y-%m-%d')
+
+        with self._lock:
+            entries = self._entries_for(date, closed)
+        dirty = False
+        for line in names:
+            with self._lock:
+                entry, changed = self._refresh_line(entries, line, files[line], closed)
+                dirty = dirty or changed
+            yield line, entry.routes
+
+        if closed and dirty:
+            with self._lock:
+                self._persist(date, entries)
+
+    def stats(self):
+        with self._lock:
+            return {date: len(entries) for date, entries in self._dates.items()}
+
+    def _entries_for(self, date, closed):
+        entries = self._dates.get(date)
+        if entries is None:
+            entries = self._load_artifact(date) if closed else {}
+            self._dates[date] = entries
+        self._dates.move_to_end(date)
+        while len(self._dates) > self.max_dates + 1:
+            self._dates.popitem(last=False)
+        return entries
+
+    def _refresh_line(self, entries, line, paths, closed):
+        signature = [_file_signature(path) for path in paths]
+        entry = entries.get(line)
+        if entry is not None and entry.signature == signature:
+            if closed and entry.records is not None:
+                # The day this entry was built incrementally for is over; keep
+                # only the result so it can be persisted.
+                entry = entries[line] = _LineEntry(signature, entry.routes)
+                return entry, True
+            return entry, False
+
+        if closed:
+            records = vehicle_log_store.load_paths(paths)
+            entry = _LineEntry(signature, self.build_routes(records))
+        else:
+            entry = self._append_new_records(entry, paths, signature)
+        entries[line] = entry
+        return entry, True
+
+    def _append_new_records(self, entry, paths, signature):
+        if entry is None or entry.offsets is None:
+            entry = _LineEntry([], [], {}, None, {} if self.build_open_routes else None)
+        # A file that shrank was replaced (e.g. converted); start over.
+        old_sizes = {name: size for name, size, _ in entry.signature}
+        if any(size < old_sizes.get(name, 0) for name, size, _ in signature):
+            return self._append_new_records(None, paths, signature)
+
+        offsets = dict(entry.offsets)
+        parts = [entry.records] if entry.records is not None else []
+        tails = []
+        for path in paths:
+            name = os.path.basename(path)
+            tail, offsets[name] = vehicle_log_store.read_log_tail(path, offsets.get(name, 0))
+            if len(tail):
+                tails.append(tail)
+
+        if entry.settled is not None and tails and entry.records is not None and len(entry.records):
+            # Settled routes assume nothing older than the pending records arrives.
+            tail = np.concatenate(tails)
+            last = {}
+            for course, ts in zip(entry.records['course'].tolist(), entry.records['ts'].tolist()):
+                last[course] = ts
+            if any(ts < last.get(course, ts) for course, ts in zip(tail['course'].tolist(), tail['ts'].tolist())):
+                return self._append_new_records(None, paths, signature)
+
+        parts = [part for part in parts + tails if len(part)]
+        records = np.concatenate(parts) if parts else np.zeros(0, dtype=vehicle_log_store.RECORD_DTYPE)
+        if len(records) > 1 and np.any(np.diff(records['ts']) < 0):
+            records = records[np.argsort(records['ts'], kind='stable')]
+        if entry.settled is None:
+            return _LineEntry(signature, self.build_routes(records), offsets, records)
+
+        open_routes, settled_counts, pending = self.build_open_routes(records)
+        settled = {course: list(routes) for course, routes in entry.settled.items()}
+        for course, count in settled_counts.items():
+            settled.setdefault(course, []).extend(open_routes[course][:count])
+        routes = []
+        for course in sorted(set(settled) | set(open_routes)):
+            routes.extend(settled.get(course, []))
+            routes.extend(open_routes.get(course, [])[settled_counts.get(course, 0):])
+        return _LineEntry(signature, routes, offsets, pending, settled)
+
+    def _artifact_path(self, date):
+        _check_date(date)
+        return os.path.join(self.cache_dir, f"{date}.json")
+
+    def _load_artifact(self, date):
+        path = self._artifact_path(date)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            log.warning(f"Ignoring unreadable logged routes cache {path}: {e}")
+            return {}
+        if data.get('version') != self.version:
+            return {}
+        return {
+            line: _LineEntry(item['signature'], item['routes'])
+            for line, item in data.get('lines', {}).items()
+        }
+
+    def _persist(self, date, entries):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._artifact_path(date)
+        # Per process: several app workers may write the same cache file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        data = {
+            'version': self.version,
+            'lines': {
+                line: {'signature': entry.signature, 'routes': entry.routes}
+                for line, entry in entries.items()
+            },
+        }
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            log.warning(f"Could not persist logged routes cache {path}: {e}")
@@ -0,0 +1,351 @@
+"""
+Map matching of live vehicles onto their line's route geometry.
+
+At startup every direction's path (or, without a path, its stop sequence) is
+cut into segments in a local metric projection. Route variants of a line share
+most of their geometry, so identical segments are stored once and remember
+which directions run along them. The unique segments are bucketed by
+(line, grid cell).
+
+Each poll then matches the whole fleet in one NumPy pass: every vehicle
+gathers the segments of its own line from the 3x3 cells around it, all
+vehicle/segment pairs are projected at once, and the cheapest pair wins. The
+cost is the distance to the segment plus a penalty for running against the
+segment (the heading comes from the vehicle's previous position). Of the
+directions sharing the winning segment, the one matched on the previous poll
+is kept if possible.
+
+The result per vehicle is the direction, the snapped position, the distance
+and fraction travelled along the direction, and the next stop.
+"""
+import math
+import time
+
+import numpy as np
+
+EARTH_RADIUS_M = 6_371_000.0
+
+# Grid cell size; segments farther than one cell from a vehicle are never
+# considered, so it is also the largest accepted distance from the route.
+CELL_M = 60.0
+
+# Cost added for driving exactly against a segment, scaled by (1 - cos) / 2.
+HEADING_PENALTY_M = 60.0
+# Movement between polls below this is treated as standing still (no heading).
+MIN_MOVE_M = 5.0
+# A stop still counts as the next one until the vehicle is this far past it.
+STOP_PASSED_M = 15.0
+# Segment endpoints are compared at this resolution when merging variants.
+MERGE_RESOLUTION_M = 0.01
+
+_KEY_SHIFT = 21
+_KEY_OFFSET = 1 << (_KEY_SHIFT - 1)
+
+
+def _ragged(first, counts):
+    """Concatenation of range(first[i], first[i] + counts[i]) for all i."""
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(first, counts) + offsets
+
+
+def _group_starts(groups):
+    """Start positions of runs of equal values in a sorted array."""
+    return np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]]) if len(groups) else groups
+
+
+class RouteMatcher:
+    """
+    Pre-indexed route geometry of routes_data (routes.json structure or a
+    RouteSnapshot). match() keeps per-course state between calls and is meant
+    to be called from one thread - the poller.
+    """
+
+    def __init__(self, routes_data, cell_m=CELL_M):
+        self.cell_m = cell_m
+        self.max_offset_m = cell_m
+        self.line_ids = {}
+        self.directions = []
+        self._last = {}
+        self.last_match_ms = None
+        self.last_matched = 0
+
+        tracks = []
+        for line, data in routes_data.items():
+            for i, direction in enumerate(data.get('directions', [])):
+                track = _track_for(direction)
+                if len(track) < 2:
+                    continue
+                self.line_ids.setdefault(line, len(self.line_ids))
+                tracks.append((line, direction, track))
+                self.directions.append((line, i, direction.get('direction_name')))
+
+        points = np.concatenate([track for *_, track in tracks]) if tracks else np.zeros((1, 2))
+        self.ref_lat = float(np.mean(points[:, 0]))
+        self._kx = math.radians(1) * EARTH_RADIUS_M * math.cos(math.radians(self.ref_lat))
+        self._ky = math.radians(1) * EARTH_RADIUS_M
+
+        # Per-direction segments ("direction segments").
+        seg_a, seg_b, seg_start, seg_dir = [], [], [], []
+        stop_pos, self._stop_names = [], []
+        self._dir_length = np.zeros(len(tracks))
+        self._dir_line = np.zeros(len(tracks), dtype=np.int64)
+        self._dir_stops = np.zeros(len(tracks) + 1, dtype=np.int64)
+        for d, (line, direction, track) in enumerate(tracks):
+            xy = self._project(track[:, 0], track[:, 1])
+            lengths = np.hypot(*np.diff(xy, axis=0).T)
+            cumulative = np.concatenate(([0.0], np.cumsum(lengths)))
+            seg_a.append(xy[:-1])
+            seg_b.append(xy[1:])
+            seg_start.append(cumulative[:-1])
+            seg_dir.append(np.full(len(lengths), d))
+            self._dir_length[d] = cumulative[-1]
+            self._dir_line[d] = self.line_ids[line]
+
+            names, positions = self._stop_positions(direction, xy, cumulative)
+            self._stop_names.extend(names)
+            stop_pos.append(positions)
+            self._dir_stops[d + 1] = self._dir_stops[d] + len(names)
+
+        seg_a = np.concatenate(seg_a) if seg_a else np.zeros((0, 2))
+        seg_b = np.concatenate(seg_b) if seg_b else np.zeros((0, 2))
+        self._seg_start = np.concatenate(seg_start) if seg_start else np.zeros(0)
+        self._seg_dir = np.concatenate(seg_dir) if seg_dir else np.zeros(0, dtype=np.int64)
+
+        # Stops of all directions in one sorted array: direction d occupies
+        # [dir_offset[d], dir_offset[d] + length], so one searchsorted finds
+        # the next stop of every vehicle.
+        self._dir_offset = np.concatenate(([0.0], np.cumsum(self._dir_length + 1.0)))[:-1]
+        self._stop_key = (
+            np.concatenate(stop_pos) + np.repeat(self._dir_offset, np.diff(self._dir_stops))
+            if stop_pos else np.zeros(0)
+        )
+
+        self._merge_segments(seg_a, seg_b)
+        self._build_grid()
+
+    def _project(self, lats, lons):
+        return np.column_stack((np.asarray(lons) * self._kx, np.asarray(lats) * self._ky))
+
+    def _stop_positions(self, direction, xy, cumulative):
+        """Distance along the path of each stop, kept monotonic along the direction."""
+        stops = [
+            stop for stop in direction.get('stops', [])
+            if stop.get('lat') is not None and stop.get('lon') is not None
+        ]
+        if not stops:
+            return [], np.zeros(0)
+        points = self._project([stop['lat'] for stop in stops], [stop['lon'] for stop in stops])
+        a, d = xy[:-1], np.diff(xy, axis=0)
+        len2 = np.maximum(d[:, 0] ** 2 + d[:, 1] ** 2, 1e-12)
+        # (stops, segments) projections in one go
+        rx, ry = points[:, 0, None] - a[:, 0], points[:, 1, None] - a[:, 1]
+        t = np.clip((rx * d[:, 0] + ry * d[:, 1]) / len2, 0.0, 1.0)
+        dist2 = (rx - d[:, 0] * t) ** 2 + (ry - d[:, 1] * t) ** 2
+        along = cumulative[:-1] + t * np.sqrt(len2)
+
+        positions = np.zeros(len(stops))
+        travelled = 0.0
+        for s in range(len(stops)):
+            best = np.argmin(np.where(along[s] >= travelled, dist2[s], np.inf))
+            travelled = positions[s] = max(travelled, along[s, best])
+        return [stop.get('name') for stop in stops], positions
+
+    def _merge_segments(self, seg_a, seg_b):
+        """Unique segment geometry per line, with the direction segments running along each."""
+        quantized = np.round(np.hstack((seg_a, seg_b)) / MERGE_RESOLUTION_M).astype(np.int64)
+        rows = np.column_stack((self._dir_line[self._seg_dir], quantized))
+        if len(rows):
+            _, first, inverse = np.unique(rows, axis=0, return_index=True, return_inverse=True)
+            inverse = inverse.ravel()
+        else:
+            first = inverse = np.zeros(0, dtype=np.int64)
+
+        self._u_ax, self._u_ay = seg_a[first, 0], seg_a[first, 1]
+        self._u_dx, self._u_dy = seg_b[first, 0] - self._u_ax, seg_b[first, 1] - self._u_ay
+        self._u_len = np.hypot(self._u_dx, self._u_dy)
+        self._u_inv_len2 = 1.0 / np.maximum(self._u_len ** 2, 1e-12)
+        self._u_line = self._dir_line[self._seg_dir[first]]
+
+        # Owners in direction order, so the first owner is the line's first variant.
+        self._owner = np.argsort(inverse, kind='stable')
+        self._owner_first = np.searchsorted(inverse[self._owner], np.arange(len(first)))
+        self._owner_count = np.diff(np.append(self._owner_first, len(self._owner)))
+
+    def _cells(self, x, y):
+        return np.floor(x / self.cell_m).astype(np.int64), np.floor(y / self.cell_m).astype(np.int64)
+
+    def _keys(self, line_ids, cx, cy):
+        return ((line_ids << _KEY_SHIFT | (cx + _KEY_OFFSET)) << _KEY_SHIFT) | (cy + _KEY_OFFSET)
+
+    def _build_grid(self):
+        """(line, cell) -> unique segment ids, as sorted keys plus a CSR-style index."""
+        x0, y0 = self._cells(np.minimum(self._u_ax, self._u_ax + self._u_dx),
+                             np.minimum(self._u_ay, self._u_ay + self._u_dy))
+        x1, y1 = self._cells(np.maximum(self._u_ax, self._u_ax + self._u_dx),
+                             np.maximum(self._u_ay, self._u_ay + self._u_dy))
+        height = y1 - y0 + 1
+        counts = (x1 - x0 + 1) * height
+        seg = np.repeat(np.arange(len(counts)), counts)
+        local = _ragged(np.zeros(len(counts), dtype=np.int64), counts)
+        keys = self._keys(self._u_line[seg], x0[seg] + local // height[seg], y0[seg] + local % height[seg])
+        order = np.argsort(keys, kind='stable')
+        keys, self._cell_segments = keys[order], seg[order]
+        self._cell_keys, self._cell_first = np.unique(keys, return_index=True)
+        self._cell_count = np.diff(np.append(self._cell_first, len(keys)))
+
+    def _candidates(self, line_ids, x, y):
+        """(vehicle, unique segment) pairs grouped by vehicle: its line's segments in the 3x3 cells around it."""
+        if not len(self._cell_keys):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        cx, cy = self._cells(x, y)
+        owner = np.repeat(np.arange(len(x)), 9)
+        keys = self._keys(
+            line_ids[owner],
+            (cx[:, None] + np.repeat([-1, 0, 1], 3)).ravel(),
+            (cy[:, None] + np.tile([-1, 0, 1], 3)).ravel(),
+        )
+        slot = np.minimum(np.searchsorted(self._cell_keys, keys), len(self._cell_keys) - 1)
+        found = (line_ids[owner] >= 0) & (self._cell_keys[slot] == keys)
+        counts = self._cell_count[slot[found]]
+        vehicle = np.repeat(owner[found], counts)
+        return vehicle, self._cell_segments[_ragged(self._cell_first[slot[found]], counts)]
+
+    def match(self, lines, lats, lons, courses=None):
+        """
+        Matches vehicles given as parallel sequences. Returns a dict of arrays:
+        direction (index into self.directions, -1 if unmatched), lat, lon
+        (snapped), along_m, progress (0..1), offset_m and next_stop (index into
+        the stop names, -1 past the last stop or if unmatched).
+        With courses, headings and the previous direction come from the last call.
+        """
+        started = time.perf_counter()
+        n = len(lines)
+        line_ids = np.array([self.line_ids.get(line, -1) for line in lines], dtype=np.int64)
+        x = np.asarray(lons, dtype=np.float64) * self._kx
+        y = np.asarray(lats, dtype=np.float64) * self._ky
+
+        hx, hy = np.zeros(n), np.zeros(n)
+        previous_dir = np.full(n, -1)
+        if courses is not None:
+            for v, course in enumerate(courses):
+                last = self._last.get(course)
+                if last is not None and last[3] == lines[v]:
+                    hx[v], hy[v], previous_dir[v] = x[v] - last[0], y[v] - last[1], last[2]
+
+        # Project every vehicle onto every candidate segment at once.
+        vehicle, seg = self._candidates(line_ids, x, y)
+        rx, ry = x[vehicle] - self._u_ax[seg], y[vehicle] - self._u_ay[seg]
+        dx, dy = self._u_dx[seg], self._u_dy[seg]
+        t = np.clip((rx * dx + ry * dy) * self._u_inv_len2[seg], 0.0, 1.0)
+        offset = np.hypot(rx - dx * t, ry - dy * t)
+
+        vhx, vhy = hx[vehicle], hy[vehicle]
+        moved = np.hypot(vhx, vhy)
+        cos = (vhx * dx + vhy * dy) / np.maximum(moved * self._u_len[seg], 1e-12)
+        cost = offset + np.where(moved >= MIN_MOVE_M, HEADING_PENALTY_M * (1 - cos) / 2, 0.0)
+        cost[offset > self.max_offset_m] = np.inf
+
+        # Cheapest pair per vehicle.
+        starts = _group_starts(vehicle)
+        pair = np.zeros(0, dtype=np.int64)
+        if len(starts):
+            best = np.minimum.reduceat(cost, starts)
+            is_best = (cost == np.repeat(best, np.diff(np.append(starts, len(cost))))) & np.isfinite(cost)
+            pair = np.flatnonzero(is_best)
+            pair = pair[_group_starts(vehicle[pair])]
+        winners, winner_seg = vehicle[pair], seg[pair]
+
+        # Direction: the previous one if it runs along the segment, else the first owner.
+        counts = self._owner_count[winner_seg]
+        owners = self._owner[_ragged(self._owner_first[winner_seg], counts)]
+        owner_vehicle = np.repeat(winners, counts)
+        chosen = self._owner[self._owner_first[winner_seg]]
+        keep = np.flatnonzero(self._seg_dir[owners] == previous_dir[owner_vehicle])
+        chosen[np.searchsorted(winners, owner_vehicle[keep])] = owners[keep]
+
+        direction = self._seg_dir[chosen]
+        along = self._seg_start[chosen] + t[pair] * self._u_len[winner_seg]
+        nxt = np.searchsorted(self._stop_key, self._dir_offset[direction] + along - STOP_PASSED_M,
+                              side='right')
+        # Near the start of a direction the key reaches back into the previous one's stops.
+        nxt = np.maximum(nxt, self._dir_stops[direction])
+
+        result = {
+            'direction': np.full(n, -1, dtype=np.int64),
+            'lat': np.full(n, np.nan), 'lon': np.full(n, np.nan),
+            'along_m': np.full(n, np.nan), 'progress': np.full(n, np.nan),
+            'offset_m': np.full(n, np.nan), 'next_stop': np.full(n, -1, dtype=np.int64),
+        }
+        result['direction'][winners] = direction
+        result['lon'][winners] = (self._u_ax[winner_seg] + dx[pair] * t[pair]) / self._kx
+        result['lat'][winners] = (self._u_ay[winner_seg] + dy[pair] * t[pair]) / self._ky
+        result['along_m'][winners] = along
+        result['progress'][winners] = along / np.maximum(self._dir_length[direction], 1e-9)
+        result['offset_m'][winners] = offset[pair]
+        result['next_stop'][winners] = np.where(nxt < self._dir_stops[direction + 1], nxt, -1)
+
+        if courses is not None:
+            directions = result['direction'].tolist()
+            self._last = {
+                course: (x[v], y[v], directions[v], lines[v]) for v, course in enumerate(courses)
+            }
+        self.last_matched = len(winners)
+        self.last_match_ms = round((time.perf_counter() - started) * 1000, 3)
+        return result
+
+    def match_positions(self, positions):
+        """
+        Matches MpykTransLoc-like objects; returns one dict per position, or
+        None when the vehicle is off its route or its line is unknown.
+        """
+        positions = list(positions)
+        result = self.match(
+            [p.line for p in positions],
+            [p.lat for p in positions],
+            [p.lon for p in positions],
+            [p.course for p in positions],
+        )
+        columns = {key: values.tolist() for key, values in result.items()}
+        matches = []
+        for v in range(len(positions)):
+            d = columns['direction'][v]
+            if d < 0:
+                matches.append(None)
+                continue
+            _, index, name = self.directions[d]
+            stop = columns['next_stop'][v]
+            matches.append({
+                'direction': name,
+                'direction_index': index,
+                'lat': round(columns['lat'][v], 6),
+                'lon': round(columns['lon'][v], 6),
+                'progress': round(columns['progress'][v], 4),
+                'along_m': round(columns['along_m'][v], 1),
+                'offset_m': round(columns['offset_m'][v], 1),
+                'next_stop': self._stop_names[stop] if stop >= 0 else None,
+            })
+        return matches
+
+    def stats(self):
+        return {
+            "lines": len(self.line_ids),
+            "directions": len(self.directions),
+            "segments": len(self._seg_dir),
+            "unique_segments": len(self._u_len),
+            "last_match_ms": self.last_match_ms,
+            "last_matched": self.last_matched,
+        }
+
+
+def _track_for(direction):
+    """(N, 2) lat/lon array of the direction's path, or of its stops if it has no path."""
+    path = direction.get('path')
+    if path is not None and len(path):
+        track = np.asarray(path, dtype=np.float64).reshape(-1, 2)
+    else:
+        track = np.array([
+            (stop['lat'], stop['lon'])
+            for stop in direction.get('stops', [])
+            if stop.get('lat') is not None and stop.get('lon') is not None
+        ], dtype=np.float64).reshape(-1, 2)
+    return track[np.isfinite(track).all(axis=1)]
@@ -0,0 +1,67 @@
+"""
+Historical playback of logged vehicle positions (/api/playback).
+
+A request covers a time window of one day. Records are read through the
+per-minute time index of each log (vehicle_log_store.load_window), so the cost
+follows the size of the window rather than the size of the day, and are
+returned grouped into ticks: one tick per logged poll, or per `step` seconds
+when a coarser time resolution is requested.
+"""
+from datetime import datetime
+
+import numpy as np
+
+import vehicle_log_store
+
+
+def parse_clock(date, value):
+    """Local "HH:MM" or "HH:MM:SS" on date (YYYY-MM-DD) -> epoch milliseconds; raises ValueError."""
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M'):
+        try:
+            return int(datetime.strptime(f"{date} {value}", fmt).timestamp() * 1000)
+        except ValueError:
+            continue
+    raise ValueError(f"Invalid time {value!r}; use HH:MM or HH:MM:SS")
+
+
+def playback_ticks(window, start_ms, step_ms=0):
+    """
+    Groups {line: records} into ticks, oldest first:
+    [{"t": epoch ms, "time": "HH:MM:SS", "vehicles": [[course, line, type, lat, lon], ...]}].
+    With step_ms, each tick holds the latest position of every vehicle within
+    one step-long bucket and is stamped with the bucket's start.
+    """
+    parts = [records for records in window.values() if len(records)]
+    if not parts:
+        return []
+    records = np.concatenate(parts)
+
+    if step_ms:
+        bucket = start_ms + (records['ts'] - start_ms) // step_ms * step_ms
+        # Latest record per (bucket, course): sort by bucket, course, time and keep run ends.
+        order = np.lexsort((records['ts'], records['course'], bucket))
+        records, bucket = records[order], bucket[order]
+        last = np.r_[(bucket[1:] != bucket[:-1]) | (records['course'][1:] != records['course'][:-1]), True]
+        records, tick = records[last], bucket[last]
+    else:
+        order = np.argsort(records['ts'], kind='stable')
+        records = records[order]
+        tick = records['ts']
+
+    kinds = [vehicle_log_store.kind_name(code) for code in range(256)]
+    lats = np.round(records['lat'] / vehicle_log_store.COORD_SCALE, 6).tolist()
+    lons = np.round(records['lon'] / vehicle_log_store.COORD_SCALE, 6).tolist()
+    courses = records['course'].tolist()
+    lines = [line.decode('ascii', 'replace') for line in records['line'].tolist()]
+    types = [kinds[code] for code in records['kind'].tolist()]
+
+    ticks = []
+    bounds = np.flatnonzero(np.r_[True, tick[1:] != tick[:-1], True])
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        t = int(tick[start])
+        ticks.append({
+            "t": t,
+            "time": datetime.fromtimestamp(t / 1000).strftime('%H:%M:%S'),
+            "vehicles": [[courses[i], lines[i], types[i], lats[i], lons[i]] for i in range(start, end)],
+        })
+    return ticks
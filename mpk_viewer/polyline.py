@@ -0,0 +1,142 @@
+"""
+Route geometry simplification and compact transport encoding.
+
+Paths from path_solver.py contain every OSM node along the way. At load time
+each path is simplified with Douglas-Peucker at a few tolerances and encoded
+with the Google encoded-polyline algorithm; the client decodes only the level
+that suits the current map zoom.
+"""
+import numpy as np
+
+EARTH_RADIUS_M = 6_371_008.8
+
+# (min_zoom, tolerance in meters); a tolerance of 0 keeps every point.
+PATH_LEVELS = (
+    (0, 30.0),
+    (13, 8.0),
+    (15, 2.0),
+    (17, 0.0),
+)
+
+
+def _to_local_meters(points):
+    """Equirectangular projection around the path's mean latitude."""
+    lat = np.radians(points[:, 0])
+    lon = np.radians(points[:, 1])
+    x = lon * np.cos(lat.mean()) * EARTH_RADIUS_M
+    y = lat * EARTH_RADIUS_M
+    return x, y
+
+
+def significance(points, min_tolerance_m=0.0):
+    """
+    Runs Douglas-Peucker once and returns, for every point, the largest
+    tolerance at which it is still kept (endpoints get +inf). Simplifying at
+    tolerance t is then just `significance(points) > t`, so all levels of a path
+    cost a single pass. Recursion stops below min_tolerance_m.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    n = len(points)
+    sig = np.zeros(n)
+    if n == 0:
+        return sig
+    sig[0] = sig[-1] = np.inf
+    if n <= 2:
+        return sig
+
+    x, y = _to_local_meters(points)
+    stack = [(0, n - 1, np.inf)]
+    while stack:
+        first, last, parent = stack.pop()
+        if last - first < 2:
+            continue
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        px, py = x[first + 1:last] - x[first], y[first + 1:last] - y[first]
+        length_sq = dx * dx + dy * dy
+        if length_sq == 0:
+            dist = np.hypot(px, py)
+        else:
+            # Distance to the segment (not the infinite line), so loops survive.
+            t = np.minimum(np.maximum((px * dx + py * dy) / length_sq, 0.0), 1.0)
+            dist = np.hypot(px - t * dx, py - t * dy)
+        i = int(dist.argmax())
+        if dist[i] > min_tolerance_m:
+            split = first + 1 + i
+            # A point can never outlive the point whose split created its range.
+            sig[split] = min(dist[i], parent)
+            stack.append((first, split, sig[split]))
+            stack.append((split, last, sig[split]))
+    return sig
+
+
+def douglas_peucker(points, tolerance_m):
+    """Returns the indices of `points` ([[lat, lon], ...]) kept at the given tolerance."""
+    if tolerance_m <= 0:
+        return np.arange(len(points))
+    return np.flatnonzero(significance(points, tolerance_m) > tolerance_m)
+
+
+def _encode_values(values):
+    """Varint-encodes signed integers as polyline characters, vectorized."""
+    values = np.asarray(values, dtype=np.int64)
+    zigzag = np.where(values < 0, ~(values << 1), values << 1)
+    # Split every value into 5-bit chunks, least significant first (at most 7 for int32 deltas).
+    chunks = (zigzag[:, None] >> (5 * np.arange(7))) & 0x1f
+    nchunks = np.maximum(1, (np.floor(np.log2(np.maximum(zigzag, 1))) // 5 + 1).astype(np.int64))
+    used = np.arange(7) < nchunks[:, None]
+    more = np.arange(7) < (nchunks - 1)[:, None]
+    chars = (chunks | np.where(more, 0x20, 0)) + 63
+    return chars[used].astype(np.uint8).tobytes().decode('ascii')
+
+
+def encode(points, precision=5):
+    """Encodes [[lat, lon], ...] as a Google encoded polyline string."""
+    if len(points) == 0:
+        return ''
+    scaled = np.round(np.asarray(points, dtype=np.float64) * 10 ** precision).astype(np.int64)
+    deltas = np.diff(scaled, axis=0, prepend=[[0, 0]])
+    return _encode_values(deltas.ravel())
+
+
+def decode(encoded, precision=5):
+    """Inverse of encode(); returns a list of [lat, lon]."""
+    values = []
+    value = shift = 0
+    for char in encoded:
+        b = ord(char) - 63
+        value |= (b & 0x1f) << shift
+        shift += 5
+        if b < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+    coords = np.cumsum(np.array(values, dtype=np.int64).reshape(-1, 2), axis=0)
+    return (coords / 10 ** precision).tolist()
+
+
+def simplify_levels(path, levels=PATH_LEVELS, sig=None):
+    """
+    Builds the multi-resolution representation of one path:
+    [{"min_zoom": z, "tolerance_m": t, "points": n, "polyline": "..."}, ...]
+    Levels that would not drop any point compared to the previous one are skipped.
+    `sig` may be a precomputed significance() array for the path.
+    """
+    if len(path) == 0:
+        return []
+    points = np.asarray(path, dtype=np.float64)
+    positive = [tolerance_m for _, tolerance_m in levels if tolerance_m > 0]
+    if sig is None and positive:
+        sig = significance(points, min(positive))
+    result = []
+    previous_count = None
+    for min_zoom, tolerance_m in levels:
+        kept = points if tolerance_m <= 0 else points[sig > tolerance_m]
+        if previous_count is not None and len(kept) == previous_count:
+            continue
+        result.append({
+            "min_zoom": min_zoom,
+            "tolerance_m": tolerance_m,
+            "points": len(kept),
+            "polyline": encode(kept),
+        })
+        previous_count = len(kept)
+    return result
@@ -0,0 +1,124 @@
+"""
+Compiles /api/routes/<line> responses once per line.
+
+The first request for a line serializes its cleaned response a single time
+and stores it as identity, gzip and (if the optional `brotli` package is
+installed) brotli bodies, each with its own strong ETag. Later requests only
+pick the variant the client accepts. Lines are compiled on demand (see
+CompiledRoutes), so startup does not pay for lines nobody opens.
+"""
+import gzip
+import hashlib
+import json
+import threading
+from dataclasses import dataclass
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+REQUEST_STOP_SUFFIX = "NŻPrzystanek na życzenie"
+
+
+@dataclass(frozen=True)
+class CompiledResponse:
+    status: int
+    bodies: dict    # content-coding ('identity', 'gzip', 'br') -> bytes
+    etags: dict     # content-coding -> strong ETag value
+
+
+def clean_stop_name(name):
+    return name.replace(REQUEST_STOP_SUFFIX, "").strip()
+
+
+def build_route_payload(line, line_data, path_levels, full_geometry=False):
+    """Returns (payload, status) for one line, as served by /api/routes/<line>."""
+    if not line_data.get("directions"):
+        return {
+            "line": line,
+            "error": "Route details are not available for this line.",
+            "source": line_data.get("source")
+        }, 200
+
+    processed_directions = []
+    for direction, levels in zip(line_data.get("directions", []), path_levels):
+        processed_stops = [
+            {
+                "name": clean_stop_name(stop["name"]),
+                "street": stop.get("street"),
+                "lat": stop.get("lat"),
+                "lon": stop.get("lon")
+            } for stop in direction.get("stops", [])
+        ]
+        processed_direction = {
+            "direction_name": direction["direction_name"],
+            "stops": processed_stops,
+            "path_levels": levels
+        }
+        if full_geometry:
+            path = direction.get("path", [])
+            processed_direction["path"] = path.tolist() if hasattr(path, 'tolist') else path
+        processed_directions.append(processed_direction)
+
+    return {"line": line, "directions": processed_directions}, 200
+
+
+def compile_response(payload, status=200):
+    body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    digest = hashlib.sha256(body).hexdigest()[:32]
+    bodies = {'identity': body, 'gzip': gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        bodies['br'] = brotli.compress(body, quality=11)
+    # Each representation needs its own strong validator.
+    etags = {coding: digest if coding == 'identity' else f"{digest}-{coding}" for coding in bodies}
+    return CompiledResponse(status=status, bodies=bodies, etags=etags)
+
+
+class CompiledRoutes:
+    """
+    Per-line cache of path levels and compiled responses, filled on first use.
+    levels_for(line, line_data) returns the line's path levels (see polyline.py).
+    """
+
+    def __init__(self, routes_data, levels_for):
+        self.routes_data = routes_data
+        self.levels_for = levels_for
+        self._levels = {}
+        self._compiled = {}
+        self._lock = threading.Lock()
+        # One lock per line, so compiling a long line does not hold up the others
+        self._line_locks = {}
+
+    def _line_lock(self, line):
+        with self._lock:
+            return self._line_locks.setdefault(line, threading.Lock())
+
+    def levels(self, line):
+        levels = self._levels.get(line)
+        if levels is None:
+            with self._line_lock(line):
+                levels = self._levels.get(line)
+                if levels is None:
+                    levels = self._levels[line] = self.levels_for(line, self.routes_data[line])
+        return levels
+
+    def __getitem__(self, line):
+        compiled = self._compiled.get(line)
+        if compiled is None:
+            levels = self.levels(line)
+            with self._line_lock(line):
+                compiled = self._compiled.get(line)
+                if compiled is None:
+                    payload, status = build_route_payload(line, self.routes_data[line], levels)
+                    compiled = self._compiled[line] = compile_response(payload, status)
+        return compiled
+
+    def stats(self):
+        return {"lines": len(self.routes_data), "compiled": len(self._compiled)}
+
+
+def choose_encoding(compiled, accept_encodings):
+    """Picks the best available content-coding from a werkzeug Accept-Encoding header."""
+    best = accept_encodings.best_match([coding for coding in ('br', 'gzip') if coding in compiled.bodies])
+    return best or 'identity'
@@ -0,0 +1,237 @@
+"""
+Compact, memory-mapped snapshot of routes.json.
+
+routes.json is pretty-printed JSON dominated by path coordinates, and every
+worker process used to parse it into its own nested dicts. The snapshot stores:
+
+* an interned stop table: each distinct stop once, its coordinates in one array
+* per direction, a slice of stop indices into that table
+* all path coordinates in one (N, 2) float64 array, plus the Douglas-Peucker
+  significance of every path point (see polyline.py)
+
+The arrays are memory-mapped read-only, so the page cache shares them between
+all gunicorn workers and loading only parses a small JSON header.
+
+    python route_snapshot.py build              # data/routes.json -> data/routes.snap
+    python route_snapshot.py bench              # compare load times
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections.abc import Mapping
+
+import numpy as np
+
+from polyline import PATH_LEVELS, significance
+
+MAGIC = b'MPKRSNP1'
+ALIGN = 16
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+DEFAULT_ROUTES = os.path.join(DATA_DIR, 'routes.json')
+DEFAULT_SNAPSHOT = os.path.join(DATA_DIR, 'routes.snap')
+
+
+def _min_tolerance():
+    return min(tolerance for _, tolerance in PATH_LEVELS if tolerance > 0)
+
+
+def build_snapshot(routes_data, out_path):
+    """Writes routes_data (the routes.json structure) to a snapshot file."""
+    stop_index = {}
+    stop_table = []
+    stop_coords = []
+    direction_stops = []
+    path_chunks = []
+    sig_chunks = []
+    lines = []
+    stop_pos = path_pos = 0
+
+    for line, data in routes_data.items():
+        directions = []
+        for direction in data.get('directions', []):
+            indices = []
+            for stop in direction.get('stops', []):
+                attrs = {k: v for k, v in stop.items() if k not in ('lat', 'lon')}
+                coords = (stop.get('lat'), stop.get('lon'))
+                key = (json.dumps(attrs, sort_keys=True, ensure_ascii=False), coords)
+                index = stop_index.get(key)
+                if index is None:
+                    index = stop_index[key] = len(stop_table)
+                    stop_table.append(attrs)
+                    stop_coords.append([np.nan if c is None else c for c in coords])
+                indices.append(index)
+            direction_stops.extend(indices)
+
+            path = np.asarray(direction.get('path', []), dtype=np.float64).reshape(-1, 2)
+            path_chunks.append(path)
+            sig_chunks.append(significance(path, _min_tolerance()).astype(np.float32))
+
+            directions.append({
+                'direction_name': direction.get('direction_name'),
+                'extra': {k: v for k, v in direction.items()
+                          if k not in ('direction_name', 'stops', 'path')},
+                'has_path': 'path' in direction,
+                'stops': [stop_pos, len(indices)],
+                'path': [path_pos, len(path)],
+            })
+            stop_pos += len(indices)
+            path_pos += len(path)
+
+        lines.append({
+            'line': line,
+            'extra': {k: v for k, v in data.items() if k != 'directions'},
+            'directions': directions,
+        })
+
+    arrays = {
+        'stop_coords': np.asarray(stop_coords, dtype=np.float64).reshape(-1, 2),
+        'direction_stops': np.asarray(direction_stops, dtype=np.int32),
+        'path_coords': np.concatenate(path_chunks) if path_chunks else np.zeros((0, 2)),
+        'path_significance': np.concatenate(sig_chunks) if sig_chunks else np.zeros(0, np.float32),
+    }
+
+    header = {'lines': lines, 'stops': stop_table, 'arrays': {}}
+    # Array offsets depend on the header size, which depends on the offsets;
+    # lay out relative offsets first and shift them once the header is sized.
+    offset = 0
+    for name, array in arrays.items():
+        offset = -(-offset // ALIGN) * ALIGN
+        header['arrays'][name] = {'offset': offset, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+        offset += array.nbytes
+    header_bytes = json.dumps(header, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    data_start = -(-(len(MAGIC) + 8 + len(header_bytes)) // ALIGN) * ALIGN
+
+    tmp_path = out_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + header['arrays'][name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+class RouteSnapshot(Mapping):
+    """
+    Read-only, dict-like view of a snapshot: snapshot[line] has the same shape
+    as routes_data[line] except that each direction's "path" is a read-only
+    (N, 2) NumPy view into the shared mapping instead of a list of lists.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._mm = np.memmap(path, dtype=np.uint8, mode='r')
+        if bytes(self._mm[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"{path} is not a routes snapshot")
+        header_len = int(np.frombuffer(self._mm[len(MAGIC):len(MAGIC) + 8], dtype=np.uint64)[0])
+        header_end = len(MAGIC) + 8 + header_len
+        header = json.loads(bytes(self._mm[len(MAGIC) + 8:header_end]).decode('utf-8'))
+        data_start = -(-header_end // ALIGN) * ALIGN
+
+        for name, spec in header['arrays'].items():
+            dtype = np.dtype(spec['dtype'])
+            count = int(np.prod(spec['shape'])) if spec['shape'] else 1
+            start = data_start + spec['offset']
+            raw = self._mm[start:start + count * dtype.itemsize]
+            setattr(self, name, raw.view(dtype).reshape(spec['shape']))
+
+        self._stops = header['stops']
+        self._lines = {entry['line']: entry for entry in header['lines']}
+        self._cache = {}
+
+    def __getitem__(self, line):
+        data = self._cache.get(line)
+        if data is None:
+            data = self._cache[line] = self._materialize(self._lines[line])
+        return data
+
+    def __iter__(self):
+        return iter(self._lines)
+
+    def __len__(self):
+        return len(self._lines)
+
+    def significance_of(self, line, direction_index):
+        start, count = self._lines[line]['directions'][direction_index]['path']
+        return self.path_significance[start:start + count]
+
+    def _materialize(self, entry):
+        directions = []
+        for d in entry['directions']:
+            start, count = d['stops']
+            stops = []
+            for index in self.direction_stops[start:start + count].tolist():
+                stop = dict(self._stops[index])
+                lat, lon = self.stop_coords[index].tolist()
+                if lat == lat and lon == lon:  # NaN marks stops without coordinates
+                    stop['lat'] = lat
+                    stop['lon'] = lon
+                stops.append(stop)
+            direction = {'direction_name': d['direction_name'], 'stops': stops, **d['extra']}
+            if d['has_path']:
+                path_start, path_count = d['path']
+                direction['path'] = self.path_coords[path_start:path_start + path_count]
+            directions.append(direction)
+        return {**entry['extra'], 'directions': directions}
+
+
+def load_routes(routes_path=DEFAULT_ROUTES, snapshot_path=DEFAULT_SNAPSHOT):
+    """
+    Returns the route data, from the snapshot when it is at least as new as
+    routes.json and from routes.json otherwise.
+    """
+    if os.path.exists(snapshot_path):
+        json_mtime = os.path.getmtime(routes_path) if os.path.exists(routes_path) else 0
+        if os.path.getmtime(snapshot_path) >= json_mtime:
+            return RouteSnapshot(snapshot_path)
+        print(f"Warning: {snapshot_path} is older than {routes_path}; loading JSON. "
+              f"Rebuild it with: python route_snapshot.py build")
+    with open(routes_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Routes snapshot tools")
+    sub = parser.add_subparsers(dest='command', required=True)
+    for name, help_text in (('build', "compile routes.json into a snapshot"),
+                            ('bench', "compare JSON and snapshot load times")):
+        cmd = sub.add_parser(name, help=help_text)
+        cmd.add_argument('--routes', default=DEFAULT_ROUTES)
+        cmd.add_argument('--snapshot', default=DEFAULT_SNAPSHOT)
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        t0 = time.perf_counter()
+        with open(args.routes, 'r', encoding='utf-8') as f:
+            routes_data = json.load(f)
+        build_snapshot(routes_data, args.snapshot)
+        print(f"Wrote {args.snapshot} ({os.path.getsize(args.snapshot) / 1e6:.1f} MB, "
+              f"from {os.path.getsize(args.routes) / 1e6:.1f} MB JSON) in {time.perf_counter() - t0:.1f}s")
+        return 0
+
+    t0 = time.perf_counter()
+    with open(args.routes, 'r', encoding='utf-8') as f:
+        routes_data = json.load(f)
+    json_s = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    snapshot = RouteSnapshot(args.snapshot)
+    open_s = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for line in snapshot:
+        snapshot[line]
+    all_s = time.perf_counter() - t0
+
+    print(f"routes.json load:          {json_s * 1000:8.1f} ms ({len(routes_data)} lines)")
+    print(f"snapshot open:             {open_s * 1000:8.1f} ms")
+    print(f"snapshot materialize all:  {all_s * 1000:8.1f} ms")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
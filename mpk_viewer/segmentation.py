@@ -0,0 +1,243 @@
+"""
+Vectorized trip segmentation of logged vehicle positions.
+
+All courses of a line (or a whole day) are processed at once: records are
+sorted by (course, timestamp) and every rule below is a NumPy mask over that
+order, so there is no per-point Python loop.
+
+A trip is split when
+* the vehicle changes (different course),
+* there is no sample for more than `max_gap_s`, or
+* the vehicle stays within `dwell_radius_m` of where it stopped for at least
+  `dwell_s` (it is parked at a terminus or depot); the stationary samples
+  themselves are dropped.
+
+Stops are measured from an anchor sample: the samples that follow it and stay
+within `dwell_radius_m` of it belong to its dwell, and the first one farther
+away becomes the next anchor. A vehicle crawling in a queue keeps moving its
+anchor, so only a real standstill ends a trip.
+"""
+import os
+from dataclasses import asdict, dataclass
+
+import numpy as np
+
+EARTH_RADIUS_M = 6_371_008.8
+# Bumped whenever the rules change, so results cached under key() are rebuilt.
+RULES_VERSION = 2
+
+
+@dataclass(frozen=True)
+class SegmentationParams:
+    max_gap_s: float = 600.0
+    dwell_s: float = 600.0
+    dwell_radius_m: float = 15.0
+    # Keep a point only after the vehicle has moved this far along its trip (0 keeps all).
+    min_step_m: float = 0.0
+    min_points: int = 2
+
+    @classmethod
+    def from_env(cls):
+        """Parameters from the SEGMENT_* environment variables, shared by the app and tools."""
+        return cls(
+            max_gap_s=float(os.environ.get('SEGMENT_MAX_GAP_S', 600)),
+            dwell_s=float(os.environ.get('SEGMENT_DWELL_S', 600)),
+            dwell_radius_m=float(os.environ.get('SEGMENT_DWELL_RADIUS_M', 15)),
+            min_step_m=float(os.environ.get('SEGMENT_MIN_STEP_M', 0)),
+        )
+
+    def key(self):
+        """Stable string identifying these parameters, for cache versioning."""
+        return ','.join([f"rules={RULES_VERSION}"]
+                        + [f"{name}={value}" for name, value in sorted(asdict(self).items())])
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Great-circle distance in meters; works element-wise on arrays."""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(a, dtype=np.float64)) for a in (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def path_length_m(lat, lon):
+    if len(lat) < 2:
+        return 0.0
+    return float(haversine_m(lat[:-1], lon[:-1], lat[1:], lon[1:]).sum())
+
+
+def dwell_anchors(lat, lon, same_vehicle, step, radius_m, window=4):
+    """
+    Marks the anchor samples of time-ordered samples: the first sample of each
+    vehicle, then for every anchor the first later sample of the same vehicle
+    at least radius_m away from it. Each anchor's dwell is the run of samples up
+    to the next anchor.
+
+    same_vehicle and step compare every sample with the one before it. A step
+    of 2 * radius_m or more always leaves the current dwell, so only the runs
+    between such steps are scanned, for all runs at once and `window` samples
+    at a time.
+    """
+    n = len(lat)
+    anchor = np.zeros(n, dtype=bool)
+    if n == 0:
+        return anchor
+    anchor[0] = True
+    anchor[1:] = ~same_vehicle | (step >= 2 * radius_m)
+
+    # Runs of samples after a certain anchor whose own anchor is still unknown.
+    certain = np.flatnonzero(anchor)
+    ends = np.r_[certain[1:], n]
+    scan = ends - certain > 1
+    frontier, stop = certain[scan], ends[scan]
+    offset = np.ones(len(frontier), dtype=np.int64)
+    steps = np.arange(window)
+    while len(frontier):
+        candidates = frontier[:, None] + offset[:, None] + steps
+        valid = candidates < stop[:, None]
+        candidates = np.minimum(candidates, n - 1)
+        away = valid & (haversine_m(lat[frontier][:, None], lon[frontier][:, None],
+                                    lat[candidates], lon[candidates]) >= radius_m)
+        found = away.any(axis=1)
+        following = candidates[np.arange(len(frontier)), away.argmax(axis=1)]
+        anchor[following[found]] = True
+
+        # Found: continue from the new anchor. Not found: look further, unless the run is over.
+        frontier = np.where(found, following, frontier)
+        offset = np.where(found, 1, offset + window)
+        more = frontier + offset < stop
+        frontier, offset, stop = frontier[more], offset[more], stop[more]
+    return anchor
+
+
+def _split(ts, lat, lon, course, params):
+    """
+    The work of segment_indices(). Returns (order, anchor, breaks, trips):
+    order sorts the valid samples by (course, ts); anchor (see dwell_anchors)
+    and breaks (breaks[i] separates sample i from i + 1) are over that order,
+    and trips are position arrays into it, before the min_points filter.
+    order is None if there are fewer than min_points samples.
+    """
+    ts = np.asarray(ts, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    course = np.asarray(course)
+
+    valid = np.flatnonzero((lat >= -90) & (lat <= 90) & (lon >= -180) & (lon <= 180))
+    order = valid[np.lexsort((ts[valid], course[valid]))]
+    n = len(order)
+    if n < params.min_points:
+        return None, None, None, []
+
+    t, la, lo, c = ts[order], lat[order], lon[order], course[order]
+    step = haversine_m(la[:-1], lo[:-1], la[1:], lo[1:])
+    same_vehicle = c[1:] == c[:-1]
+
+    # breaks[i] separates sample i from sample i + 1
+    breaks = ~same_vehicle | (np.diff(t) > params.max_gap_s)
+    keep = np.ones(n, dtype=bool)
+
+    anchor = dwell_anchors(la, lo, same_vehicle, step, params.dwell_radius_m)
+    starts = np.flatnonzero(anchor)
+    ends = np.r_[starts[1:], n] - 1
+    long_dwell = (ends > starts) & ((t[ends] - t[starts]) >= params.dwell_s)
+    for s, e in zip(starts[long_dwell], ends[long_dwell]):
+        # Samples s..e are parked: end the trip at s, start the next one at e.
+        breaks[s:e] = True
+        keep[s + 1:e] = False
+
+    # Drop exact repeats of the previous sample within a trip.
+    repeat = same_vehicle & ~breaks & (la[1:] == la[:-1]) & (lo[1:] == lo[:-1])
+    keep[1:] &= ~repeat
+
+    trip_id = np.concatenate(([0], np.cumsum(breaks)))
+
+    if params.min_step_m > 0:
+        # Downsample: keep the first sample of every min_step_m of travel per trip.
+        travelled = np.concatenate(([0.0], np.cumsum(np.where(breaks, 0.0, step))))
+        trip_start = np.concatenate(([True], breaks))
+        travelled -= np.maximum.accumulate(np.where(trip_start, travelled, 0.0))
+        bucket = np.floor(travelled / params.min_step_m)
+        new_bucket = np.concatenate(([True], (bucket[1:] != bucket[:-1]) | breaks))
+        is_last = np.concatenate((breaks, [True]))
+        keep &= new_bucket | is_last
+
+    kept = np.flatnonzero(keep)
+    if len(kept) == 0:
+        return order, anchor, breaks, []
+    kept_trips = trip_id[kept]
+    bounds = np.flatnonzero(np.diff(kept_trips)) + 1
+    return order, anchor, breaks, np.split(kept, bounds)
+
+
+def segment_indices(ts, lat, lon, course, params=SegmentationParams()):
+    """
+    Splits samples into trips.
+
+    ts is in seconds, lat/lon in degrees; all arrays have the same length.
+    Returns a list of index arrays into the inputs, each in time order.
+    """
+    order, _, _, trips = _split(ts, lat, lon, course, params)
+    return [order[trip] for trip in trips if len(trip) >= params.min_points]
+
+
+def segment_records(records, params=SegmentationParams(), coord_scale=1):
+    """
+    Segments a vehicle_log_store record array into routes, each a list of
+    [lat, lon] pairs ready for JSON.
+    """
+    if len(records) == 0:
+        return []
+    lat = records['lat'] / coord_scale
+    lon = records['lon'] / coord_scale
+    trips = segment_indices(records['ts'] / 1000, lat, lon, records['course'], params)
+    points = np.column_stack((lat, lon))
+    return [points[trip].tolist() for trip in trips]
+
+
+def segment_open_records(records, params=SegmentationParams(), coord_scale=1):
+    """
+    Segments the records of vehicles that may still report (today's log), so
+    that later samples only need the returned `pending` records to be
+    re-segmented. Returns (routes, settled, pending):
+
+    routes  -- {course: [route, ...]} like segment_records(), per course
+    settled -- {course: number of leading routes no later sample can change}
+    pending -- the records the rest of each course's routes came from
+
+    A course is re-segmented from its last dwell anchor, at or before its last
+    anchor, that starts a trip or ends one (a long dwell begins there): the
+    anchors and breaks up to there only depend on earlier samples, and those
+    after it come out the same when segmentation starts there. When it ends a
+    trip, that trip is settled with it, and starting there only adds a
+    one-sample trip, which min_points drops. Appended samples must not be
+    older than a course's previous ones.
+    """
+    if len(records) == 0:
+        return {}, {}, records
+    lat = records['lat'] / coord_scale
+    lon = records['lon'] / coord_scale
+    order, anchor, breaks, trips = _split(records['ts'] / 1000, lat, lon, records['course'], params)
+    if order is None:
+        return {}, {}, records
+    points = np.column_stack((lat, lon))
+    course = records['course'][order]
+    restart_at = anchor & np.r_[True, breaks]
+    if params.min_points >= 2:
+        # Not the break after a course's last sample: its trip may go on
+        restart_at |= anchor & np.r_[breaks & (course[1:] == course[:-1]), False]
+
+    routes, settled, pending = {}, {}, []
+    course_bounds = np.flatnonzero(np.r_[True, course[1:] != course[:-1], True])
+    trip_firsts = np.array([trip[0] for trip in trips], dtype=np.int64)
+    for first, end in zip(course_bounds[:-1], course_bounds[1:]):
+        last_anchor = first + np.flatnonzero(anchor[first:end])[-1]
+        restart = first + np.flatnonzero(restart_at[first:last_anchor + 1])[-1]
+        key = int(course[first])
+        in_course = np.flatnonzero((trip_firsts >= first) & (trip_firsts < end))
+        course_trips = [trips[i] for i in in_course]
+        routes[key] = [points[order[trip]].tolist() for trip in course_trips
+                       if len(trip) >= params.min_points]
+        settled[key] = sum(len(trip) >= params.min_points for trip in course_trips if trip[0] < restart)
+        pending.append(order[restart:end])
+    return routes, settled, records[np.sort(np.concatenate(pending))]
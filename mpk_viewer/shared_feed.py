@@ -0,0 +1,79 @@
+"""
+One background owner for several app processes (e.g. `gunicorn -w 4`).
+
+Polling MPK, writing the vehicle logs, compacting them and segmenting trips
+must happen once, not once per worker. The process holding an exclusive lock
+on a lock file (OwnerLock) is the background owner: its poller fetches from
+MPK, runs those jobs and after every poll writes the snapshot to a shared
+file. The other processes only read that file, so every worker serves the
+same positions and map matches. The lock is released when the owner exits,
+and the next process that tries takes over.
+
+Without fcntl (not POSIX) every process is its own owner; run one process there.
+"""
+import json
+import os
+from collections import namedtuple
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# What /api/vehicles and the stream need of a position read from the shared file
+SharedPosition = namedtuple('SharedPosition', 'kind line course lat lon')
+
+
+class OwnerLock:
+    """Non-blocking exclusive lock on `path`, held until the process exits."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self.held = False
+
+    def try_acquire(self):
+        """Returns True if this process is (or just became) the owner."""
+        if self.held:
+            return True
+        if fcntl is None:
+            self.held = True
+            return True
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        f = open(self.path, 'a+')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        # The pid is only informative; the lock itself is what counts.
+        f.truncate(0)
+        f.write(f"{os.getpid()}\n")
+        f.flush()
+        self._file = f
+        self.held = True
+        return True
+
+
+def write_shared_snapshot(path, snapshot):
+    """Writes a VehicleSnapshot's positions and map matches for the other processes."""
+    data = {
+        "fetched_at": snapshot.fetched_at,
+        "positions": [[p.kind, p.line, p.course, p.lat, p.lon] for p in snapshot.positions],
+        "matches": [vehicle.get('match') for vehicle in snapshot.vehicles],
+    }
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp, path)
+
+
+def read_shared_snapshot(path):
+    """Returns (fetched_at, positions, matches) from the shared file, or None if there is none yet."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    positions = [SharedPosition(*row) for row in data['positions']]
+    return data['fetched_at'], positions, data['matches']
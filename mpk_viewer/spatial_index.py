@@ -0,0 +1,93 @@
+"""
+Per-snapshot lookup structures for filtered /api/vehicles requests.
+
+Built once per poll: every vehicle's JSON object is serialized a single time,
+and vehicles are bucketed by line, by type and by a fixed lat/lon grid. A
+filtered request only visits the buckets it needs and joins the pre-serialized
+fragments, so its cost follows the size of the result rather than the fleet.
+"""
+import json
+import math
+
+# Grid cell size in degrees (~1.1 km north-south, ~0.7 km east-west in Wrocław).
+CELL_DEGREES = 0.01
+
+
+def _cell(lat, lon):
+    return math.floor(lat / CELL_DEGREES), math.floor(lon / CELL_DEGREES)
+
+
+def parse_bbox(value):
+    """
+    Parses "west,south,east,north" (Leaflet's toBBoxString order).
+    Returns (south, west, north, east) or raises ValueError.
+    """
+    parts = [float(part) for part in value.split(',')]
+    if len(parts) != 4:
+        raise ValueError("bbox needs four comma-separated numbers: west,south,east,north")
+    west, south, east, north = parts
+    if not all(math.isfinite(part) for part in parts):
+        raise ValueError("bbox coordinates must be finite numbers")
+    if not (-90 <= south <= 90 and -90 <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180):
+        raise ValueError("bbox latitudes must be within -90..90 and longitudes within -180..180")
+    if south > north or west > east:
+        raise ValueError("bbox must be given as west,south,east,north")
+    return south, west, north, east
+
+
+class VehicleIndex:
+    def __init__(self, vehicles):
+        self.fragments = tuple(
+            json.dumps(vehicle, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            for vehicle in vehicles
+        )
+        self._coords = tuple((vehicle['lat'], vehicle['lon']) for vehicle in vehicles)
+        self._types = tuple(vehicle['type'] for vehicle in vehicles)
+        self.by_line = {}
+        self.by_type = {}
+        self.grid = {}
+        for i, vehicle in enumerate(vehicles):
+            self.by_line.setdefault(vehicle['line'], []).append(i)
+            self.by_type.setdefault(vehicle['type'], []).append(i)
+            self.grid.setdefault(_cell(vehicle['lat'], vehicle['lon']), []).append(i)
+
+    def query(self, line=None, kind=None, bbox=None):
+        """Returns the indices of matching vehicles, in snapshot order."""
+        candidates = None
+        if line is not None:
+            candidates = self.by_line.get(line, [])
+        elif kind is not None:
+            candidates = self.by_type.get(kind, [])
+            kind = None
+
+        if bbox is not None:
+            south, west, north, east = bbox
+            if candidates is None:
+                candidates = self._grid_candidates(south, west, north, east)
+            candidates = [
+                i for i in candidates
+                if south <= self._coords[i][0] <= north and west <= self._coords[i][1] <= east
+            ]
+        if kind is not None:
+            candidates = [i for i in candidates if self._types[i] == kind]
+        if candidates is None:
+            return range(len(self.fragments))
+        return sorted(candidates)
+
+    def _grid_candidates(self, south, west, north, east):
+        (row0, col0), (row1, col1) = _cell(south, west), _cell(north, east)
+        if (row1 - row0 + 1) * (col1 - col0 + 1) > len(self.grid):
+            # Viewport covers more cells than are occupied: walk the occupied ones.
+            return [i for (row, col), members in self.grid.items()
+                    if row0 <= row <= row1 and col0 <= col <= col1 for i in members]
+        result = []
+        for row in range(row0, row1 + 1):
+            for col in range(col0, col1 + 1):
+                result.extend(self.grid.get((row, col), ()))
+        return result
+
+    def payload(self, indices, last_update):
+        """Serializes the /api/vehicles body for the given vehicles."""
+        body = b','.join(self.fragments[i] for i in indices)
+        return (b'{"vehicles":[' + body + b'],"last_update":'
+                + json.dumps(last_update).encode('utf-8') + b'}')
@@ -43,29 +43,180 @@ function toggleTheme() {
     setStreetViewTheme(!isDarkMode ? 'dark' : 'light');
 }
 
+// --- Route Geometry ---
+// Decodes a Google encoded polyline into [[lat, lon], ...].
+function decodePolyline(encoded, precision = 5) {
+    const factor = Math.pow(10, precision);
+    const points = [];
+    let index = 0, lat = 0, lon = 0;
+    while (index < encoded.length) {
+        for (let axis = 0; axis < 2; axis++) {
+            let result = 0, shift = 0, b;
+            do {
+                b = encoded.charCodeAt(index++) - 63;
+                result |= (b & 0x1f) << shift;
+                shift += 5;
+            } while (b >= 0x20);
+            const delta = (result & 1) ? ~(result >> 1) : (result >> 1);
+            if (axis === 0) lat += delta; else lon += delta;
+        }
+        points.push([lat / factor, lon / factor]);
+    }
+    return points;
+}
+
+// Picks the most detailed path level allowed at the given zoom and decodes it once.
+function pathForZoom(pathLevels, zoom) {
+    let chosen = null;
+    pathLevels.forEach(level => {
+        if (level.min_zoom <= zoom) chosen = level;
+    });
+    if (!chosen) chosen = pathLevels[0];
+    if (!chosen.decoded) chosen.decoded = decodePolyline(chosen.polyline);
+    return chosen.decoded;
+}
+
+map.on('zoomend', () => {
+    routePolylines.forEach(polyline => {
+        if (polyline.pathLevels) {
+            const latlngs = pathForZoom(polyline.pathLevels, map.getZoom());
+            if (latlngs !== polyline.currentPath) {
+                polyline.currentPath = latlngs;
+                polyline.setLatLngs(latlngs);
+            }
+        }
+    });
+});
+
+function renderVehicles(vehicles, lastUpdate) {
+    document.getElementById('last-updated').textContent =
+        lastUpdate ? `Last update: ${lastUpdate}` : 'Waiting for live data...';
+    vehicleMarkers.forEach(marker => marker.remove());
+    vehicleMarkers = [];
+    vehicles.forEach(vehicle => {
+        if (selectedLine && vehicle.line !== selectedLine) {
+            return;
+        }
+        const marker = L.circleMarker([vehicle.lat, vehicle.lon], {
+            radius: 8,
+            fillColor: vehicle.type === 'bus' ? '#ff7800' : '#0078ff',
+            color: '#000',
+            weight: 1,
+            opacity: 1,
+            fillOpacity: 0.8
+        }).addTo(map);
+        let popup = `<b>Line:</b> ${vehicle.line}<br><b>Type:</b> ${vehicle.type}`;
+        if (vehicle.match) {
+            popup += `<br><b>Direction:</b> ${vehicle.match.direction}`
+                + `<br><b>Progress:</b> ${Math.round(vehicle.match.progress * 100)}%`;
+            if (vehicle.match.next_stop) {
+                popup += `<br><b>Next stop:</b> ${vehicle.match.next_stop}`;
+            }
+        }
+        marker.bindPopup(popup);
+        vehicleMarkers.push(marker);
+    });
+}
+
+// --- Live Vehicle Stream ---
+// With EventSource support the server pushes a keyframe and then per-poll
+// deltas keyed by course; otherwise we fall back to polling /api/vehicles.
+// Either way the server only sends the selected line and the area around the view.
+const liveVehicles = new Map();
+let liveSeq = null;
+let liveScale = 100000;
+let liveLastUpdate = '';
+let vehicleStream = null;
+// The line and area the open stream was requested for.
+let streamView = null;
+
+// The visible area plus a margin, rounded outwards to 0.01 degrees so that
+// clients looking at the same area share the server's messages.
+function vehicleArea() {
+    const bounds = map.getBounds().pad(0.2);
+    const south = Math.floor(bounds.getSouth() * 100) / 100;
+    const west = Math.floor(bounds.getWest() * 100) / 100;
+    const north = Math.ceil(bounds.getNorth() * 100) / 100;
+    const east = Math.ceil(bounds.getEast() * 100) / 100;
+    return {
+        bounds: L.latLngBounds([south, west], [north, east]),
+        bbox: [west, south, east, north].map(value => value.toFixed(2)).join(',')
+    };
+}
+
+function liveVehicleList() {
+    return Array.from(liveVehicles.values()).map(v => ({
+        line: v.line, type: v.type, lat: v.lat / liveScale, lon: v.lon / liveScale,
+        match: v.match ? { direction: v.match[0], progress: v.match[1], next_stop: v.match[2] } : null
+    }));
+}
+
+function connectVehicleStream() {
+    const area = vehicleArea();
+    streamView = { line: selectedLine, bounds: area.bounds };
+    const params = new URLSearchParams({ bbox: area.bbox });
+    if (selectedLine) params.set('line', selectedLine);
+    vehicleStream = new EventSource(`/api/vehicles/stream?${params}`);
+
+    vehicleStream.addEventListener('keyframe', event => {
+        const data = JSON.parse(event.data);
+        liveVehicles.clear();
+        liveScale = data.scale;
+        data.vehicles.forEach(([course, line, type, lat, lon, match]) => {
+            liveVehicles.set(course, { line, type, lat, lon, match });
+        });
+        liveSeq = data.seq;
+        liveLastUpdate = data.last_update;
+        renderVehicles(liveVehicleList(), liveLastUpdate);
+    });
+
+    vehicleStream.addEventListener('delta', event => {
+        const data = JSON.parse(event.data);
+        if (liveSeq === null || data.base !== liveSeq) {
+            // Missed a message: reconnect without Last-Event-ID to get a keyframe.
+            reconnectVehicleStream();
+            return;
+        }
+        data.removed.forEach(course => liveVehicles.delete(course));
+        data.added.forEach(([course, line, type, lat, lon, match]) => {
+            liveVehicles.set(course, { line, type, lat, lon, match });
+        });
+        data.moved.forEach(([course, lat, lon, match]) => {
+            const vehicle = liveVehicles.get(course);
+            if (vehicle) {
+                vehicle.lat = lat;
+                vehicle.lon = lon;
+                vehicle.match = match;
+            }
+        });
+        liveSeq = data.seq;
+        liveLastUpdate = data.last_update;
+        renderVehicles(liveVehicleList(), liveLastUpdate);
+    });
+}
+
+function reconnectVehicleStream() {
+    vehicleStream.close();
+    liveSeq = null;
+    connectVehicleStream();
+}
+
 function updateVehicleMarkers() {
-    fetch('/api/vehicles')
+    if (vehicleStream) {
+        if (streamView.line !== selectedLine || !streamView.bounds.contains(map.getBounds())) {
+            // The stream covers another line or area: subscribe again for the current view.
+            reconnectVehicleStream();
+        } else {
+            renderVehicles(liveVehicleList(), liveLastUpdate);
+        }
+        return;
+    }
+    // Let the server filter by the selected line and the visible map area.
+    const params = new URLSearchParams({ bbox: vehicleArea().bbox });
+    if (selectedLine) params.set('line', selectedLine);
+    fetch(`/api/vehicles?${params}`)
         .then(response => response.json())
-        .then(data => {
-            document.getElementById('last-updated').textContent = `Last update: ${data.last_update}`;
-            vehicleMarkers.forEach(marker => marker.remove());
-            vehicleMarkers = [];
-            data.vehicles.forEach(vehicle => {
-                if (selectedLine && vehicle.line !== selectedLine) {
-                    return;
-                }
-                const marker = L.circleMarker([vehicle.lat, vehicle.lon], {
-                    radius: 8,
-                    fillColor: vehicle.type === 'bus' ? '#ff7800' : '#0078ff',
-                    color: '#000',
-                    weight: 1,
-                    opacity: 1,
-                    fillOpacity: 0.8
-                }).addTo(map);
-                marker.bindPopup(`<b>Line:</b> ${vehicle.line}<br><b>Type:</b> ${vehicle.type}`);
-                vehicleMarkers.push(marker);
-            });
-        });
+        .then(data => renderVehicles(data.vehicles, data.last_update));
 }
 
 function fetchAndDisplayLines() {
@@ -165,8 +316,11 @@ function displayRoute(lineId) {
             Object.values(routeGroups).forEach((group) => {
                 const groupPolylines = [];
                 group.directions.forEach(direction => {
-                    if (direction.path && direction.path.length > 0) {
-                        const polyline = L.polyline(direction.path, { color: colors[colorIndex % colors.length] });
+                    if (direction.path_levels && direction.path_levels.length > 0) {
+                        const path = pathForZoom(direction.path_levels, map.getZoom());
+                        const polyline = L.polyline(path, { color: colors[colorIndex % colors.length] });
+                        polyline.pathLevels = direction.path_levels;
+                        polyline.currentPath = path;
                         groupPolylines.push(polyline);
                         routePolylines.push(polyline);
                         colorIndex++;
@@ -336,41 +490,104 @@ function clearLoggedRoutes() {
     loggedRoutePolylines = [];
 }
 
+function showLoggedRoutes(routes) {
+    clearLoggedRoutes();
+    const colors = ['#ff0000', '#00ff00', '#0000ff', '#ffff00', '#ff00ff', '#00ffff'];
+    let colorIndex = 0;
+
+    routes.forEach(route => {
+        const polyline = L.polyline(route, { color: colors[colorIndex % colors.length] }).addTo(map);
+        loggedRoutePolylines.push(polyline);
+        colorIndex++;
+    });
+
+    if (loggedRoutePolylines.length > 0) {
+        const group = new L.featureGroup(loggedRoutePolylines);
+        map.fitBounds(group.getBounds());
+    }
+}
+
 function fetchLoggedRoutes(date) {
-    fetch(`/api/logged_routes?date=${date}`)
+    // Only the list of lines is fetched up front; each line's routes are
+    // requested when its button is clicked.
+    fetch(`/api/logged_routes/lines?date=${date}`)
         .then(response => response.json())
-        .then(data => {
+        .then(lines => {
             const container = document.getElementById('logged-lines-container');
             container.innerHTML = ''; // Clear previous lines
             clearLoggedRoutes();
 
-            const lines = Object.keys(data).sort((a, b) => a.localeCompare(b, undefined, {numeric: true}));
-            
+            lines.sort((a, b) => a.localeCompare(b, undefined, {numeric: true}));
+
             lines.forEach(line => {
                 const button = document.createElement('button');
                 button.textContent = line;
                 button.onclick = () => {
-                    clearLoggedRoutes();
-                    const routes = data[line];
-                    const colors = ['#ff0000', '#00ff00', '#0000ff', '#ffff00', '#ff00ff', '#00ffff'];
-                    let colorIndex = 0;
-                    
-                    routes.forEach(route => {
-                        const polyline = L.polyline(route, { color: colors[colorIndex % colors.length] }).addTo(map);
-                        loggedRoutePolylines.push(polyline);
-                        colorIndex++;
-                    });
-
-                    if (loggedRoutePolylines.length > 0) {
-                        const group = new L.featureGroup(loggedRoutePolylines);
-                        map.fitBounds(group.getBounds());
-                    }
+                    fetch(`/api/logged_routes?date=${date}&line=${encodeURIComponent(line)}`)
+                        .then(response => response.json())
+                        .then(data => showLoggedRoutes(data[line] || []));
                 };
                 container.appendChild(button);
             });
         });
 }
 
+// --- Density Heatmap ---
+// Cells of the map tiles in view, coloured by how many positions were logged
+// there; only the visible tiles are requested (see /api/heatmap).
+const heatmapLayer = L.layerGroup();
+const heatmapRenderer = L.canvas();
+
+function heatmapColor(share) {
+    // yellow (few positions) to red (many)
+    return `hsl(${Math.round(60 - 60 * share)}, 100%, 50%)`;
+}
+
+function updateHeatmap() {
+    const date = document.getElementById('date-selector').value;
+    if (!date || !document.getElementById('heatmap-toggle').checked) {
+        return;
+    }
+    const params = new URLSearchParams({ date, zoom: map.getZoom(), bbox: map.getBounds().toBBoxString() });
+    fetch(`/api/heatmap?${params}`)
+        .then(response => response.json())
+        .then(data => {
+            heatmapLayer.clearLayers();
+            if (!data.tiles) {
+                return;
+            }
+            const cellSize = 256 / data.cells_per_tile;
+            let max = 1;
+            Object.values(data.tiles).forEach(cells => cells.forEach(cell => { max = Math.max(max, cell[2]); }));
+            Object.entries(data.tiles).forEach(([tile, cells]) => {
+                const [tileX, tileY] = tile.split('/').map(Number);
+                cells.forEach(([cellX, cellY, count, dwell]) => {
+                    const x = (tileX * data.cells_per_tile + cellX) * cellSize;
+                    const y = (tileY * data.cells_per_tile + cellY) * cellSize;
+                    const bounds = L.latLngBounds(map.unproject([x, y], data.zoom),
+                                                  map.unproject([x + cellSize, y + cellSize], data.zoom));
+                    L.rectangle(bounds, {
+                        renderer: heatmapRenderer,
+                        stroke: false,
+                        fillColor: heatmapColor(Math.log(count + 1) / Math.log(max + 1)),
+                        fillOpacity: 0.6,
+                    }).bindTooltip(`${count} positions, mean dwell ${dwell} s`).addTo(heatmapLayer);
+                });
+            });
+        });
+}
+
+document.getElementById('heatmap-toggle').addEventListener('change', (event) => {
+    if (event.target.checked) {
+        heatmapLayer.addTo(map);
+        updateHeatmap();
+    } else {
+        heatmapLayer.clearLayers();
+        map.removeLayer(heatmapLayer);
+    }
+});
+map.on('moveend', updateHeatmap);
+
 document.getElementById('logged-routes-btn').addEventListener('click', () => {
     const sidebar = document.getElementById('logged-routes-sidebar');
     const rightSidebar = document.getElementById('right-sidebar');
@@ -401,19 +618,31 @@ document.getElementById('logged-routes-btn').addEventListener('click', () => {
         sidebar.style.display = 'none';
         rightSidebar.style.display = 'block';
         clearLoggedRoutes();
+        const heatmapToggle = document.getElementById('heatmap-toggle');
+        if (heatmapToggle.checked) {
+            heatmapToggle.checked = false;
+            heatmapToggle.dispatchEvent(new Event('change'));
+        }
     }
 });
 
 document.getElementById('date-selector').addEventListener('change', (event) => {
     fetchLoggedRoutes(event.target.value);
+    updateHeatmap();
 });
 
 
 // --- Initial Load ---
 setStreetViewTheme();
-updateVehicleMarkers();
 fetchAndDisplayLines();
-setInterval(updateVehicleMarkers, 15000);
+if (window.EventSource) {
+    connectVehicleStream();
+} else {
+    updateVehicleMarkers();
+    setInterval(updateVehicleMarkers, 15000);
+}
+// Vehicles are only sent for the area around the view, so refresh after panning.
+map.on('moveend', updateVehicleMarkers);
 setInterval(() => {
     if (!map.hasLayer(satelliteLayer)) {
         setStreetViewTheme();
@@ -0,0 +1,108 @@
+"""
+Synthetic vehicle_logs days for benchmarks and development.
+
+A FakeMpykClient fleet driven by a simulated clock is polled every `interval`
+seconds through the service hours of each day, and every poll goes through
+VehicleLogWriter exactly like the app's live logging, so the result (logs and
+time indexes, binary or text) is what the historical endpoints read in
+production. The same seed gives the same files.
+
+    python synthetic_logs.py --days 3 --root /tmp/vehicle_logs
+    python synthetic_logs.py --days 1 --end-date 2026-10-11 --vehicles-per-direction 2 --compact
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import date as date_cls, datetime, timedelta
+
+import vehicle_log_store
+from fake_client import FakeMpykClient
+from log_writer import VehicleLogWriter
+
+DEFAULT_ROUTES = os.path.join(os.path.dirname(__file__), 'data', 'routes.json')
+FALLBACK_ROUTES = os.path.join(os.path.dirname(__file__), 'data', 'routes_old.json')
+
+
+def load_routes_fixture(path=None):
+    """Reads routes.json (routes_old.json if there is none yet)."""
+    if path is None:
+        path = DEFAULT_ROUTES if os.path.exists(DEFAULT_ROUTES) else FALLBACK_ROUTES
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def day_range(days, end_date=None):
+    """The `days` dates up to and including end_date (default: yesterday), oldest first."""
+    end = (datetime.strptime(end_date, '%Y-%m-%d').date() if end_date
+           else date_cls.today() - timedelta(days=1))
+    return [(end - timedelta(days=n)).strftime('%Y-%m-%d') for n in range(days - 1, -1, -1)]
+
+
+def generate(routes_data, dates, root='vehicle_logs', interval=15.0, service_hours=(5, 23),
+             vehicles_per_direction=1, log_format='binary', seed=0, layover_s=900.0, noise_m=3.0,
+             speed_mps=8.0):
+    """
+    Writes one simulated day of logs per date into root. Returns the writer's
+    stats (written_records, batches, ...).
+    """
+    clock = [0.0]
+    client = FakeMpykClient(
+        routes_data, vehicles_per_direction=vehicles_per_direction, speed_mps=speed_mps,
+        seed=seed, layover_s=layover_s, noise_m=noise_m, service_hours=service_hours,
+        clock=lambda: clock[0],
+    )
+    writer = VehicleLogWriter(root, max_queue=64, log_format=log_format)
+    try:
+        for date in dates:
+            midnight = datetime.strptime(date, '%Y-%m-%d').timestamp()
+            t = midnight + service_hours[0] * 3600
+            end = midnight + service_hours[1] * 3600
+            while t < end:
+                clock[0] = t
+                positions = client.get_all_positions()
+                # The writer drops snapshots when its queue is full; wait for it instead.
+                while writer.stats()['queue_depth'] >= writer.stats()['queue_capacity'] - 1:
+                    time.sleep(0.005)
+                writer.submit(t, positions)
+                t += interval
+    finally:
+        writer.stop(timeout=None)
+    return writer.stats()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate synthetic vehicle_logs days from a fake fleet")
+    parser.add_argument('--root', default='vehicle_logs', help="log directory to write into")
+    parser.add_argument('--routes', help="routes JSON the fleet drives on (default: data/routes.json)")
+    parser.add_argument('--days', type=int, default=1, help="number of consecutive days")
+    parser.add_argument('--end-date', help="last generated day, YYYY-MM-DD (default: yesterday)")
+    parser.add_argument('--hours', default='5-23', help="service hours as FIRST-LAST (default: 5-23)")
+    parser.add_argument('--interval', type=float, default=15.0, help="seconds between polls")
+    parser.add_argument('--vehicles-per-direction', type=int, default=1)
+    parser.add_argument('--format', choices=('binary', 'text'), default='binary')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--layover', type=float, default=900.0, help="longest terminus wait [s]")
+    parser.add_argument('--noise', type=float, default=3.0, help="GPS noise, standard deviation [m]")
+    parser.add_argument('--compact', action='store_true', help="compact every generated day into archives")
+    args = parser.parse_args(argv)
+
+    first, last = (int(hour) for hour in args.hours.split('-'))
+    dates = day_range(args.days, args.end_date)
+    t0 = time.perf_counter()
+    stats = generate(
+        load_routes_fixture(args.routes), dates, args.root, args.interval, (first, last),
+        args.vehicles_per_direction, args.format, args.seed, args.layover, args.noise,
+    )
+    print(f"{len(dates)} days ({dates[0]} .. {dates[-1]}): {stats['written_records']} records "
+          f"in {time.perf_counter() - t0:.1f}s")
+    if args.compact:
+        for date in dates:
+            before, after = vehicle_log_store.compact_day(date, args.root)
+            print(f"{date}: compacted {before} -> {after} bytes")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,465 @@
+"""
+Trips materialized while vehicles are being ingested.
+
+OnlineTripSegmenter is a VehiclePoller listener. It applies the rules of
+segmentation.py incrementally: every (line, course) has one open trip held in
+compact arrays, and a trip is closed as soon as a rule ends it (a gap, a long
+dwell, a new day). Each closed trip is finalized with segment_indices(), so it
+is exactly the trip /api/logged_routes builds from the logs, and its summary is
+appended to a per-day TripStore:
+
+    vehicle_trips/<date>/line_<line>.jsonl   one JSON object per completed trip
+    vehicle_trips/<date>/manifest.json       segmentation parameters, completeness
+
+A summary is the vehicle, start and end time, number of points and length, but
+not the path, so reading a day stays O(trips) however long the trips are; the
+points of a trip are in the logs, in its [start, end] window
+(vehicle_log_store.load_window). Today's trips are available immediately. On startup the segmenter replays
+today's logs to rebuild its state; closed days are backfilled from vehicle_logs
+with
+
+    python trips.py backfill --all
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from array import array
+from datetime import datetime
+
+import numpy as np
+
+import vehicle_log_store
+from segmentation import SegmentationParams, haversine_m, path_length_m, segment_indices
+
+log = logging.getLogger(__name__)
+
+TRIP_DIR = 'vehicle_trips'
+MANIFEST = 'manifest.json'
+TRIP_SUFFIX = '.jsonl'
+
+
+def _date_of(ts_ms):
+    return datetime.fromtimestamp(ts_ms / 1000).strftime('%Y-%m-%d')
+
+
+def _trip(course, ts_ms, lat, lon):
+    return {
+        'course': int(course),
+        'start': int(ts_ms[0]),
+        'end': int(ts_ms[-1]),
+        'points': len(ts_ms),
+        'length_m': round(path_length_m(lat, lon), 1),
+    }
+
+
+def make_trips(course, ts_ms, lat, lon, params):
+    """Finalizes the samples of one vehicle's open trip (usually one trip, none if too short)."""
+    ts_ms = np.asarray(ts_ms, dtype=np.int64)
+    lat, lon = np.asarray(lat), np.asarray(lon)
+    return [
+        _trip(course, ts_ms[trip], lat[trip], lon[trip])
+        for trip in segment_indices(ts_ms / 1000, lat, lon, np.zeros(len(ts_ms), dtype=np.int64), params)
+    ]
+
+
+def trips_from_records(records, params):
+    """Segments one line's log records (vehicle_log_store format) into trip dicts."""
+    if len(records) == 0:
+        return []
+    lat = records['lat'] / vehicle_log_store.COORD_SCALE
+    lon = records['lon'] / vehicle_log_store.COORD_SCALE
+    return [
+        _trip(records['course'][trip[0]], records['ts'][trip], lat[trip], lon[trip])
+        for trip in segment_indices(records['ts'] / 1000, lat, lon, records['course'], params)
+    ]
+
+
+def _sort_key(trip):
+    return trip['course'], trip['start']
+
+
+class TripStore:
+    """Per-day, per-line JSON-lines files of completed trips."""
+
+    def __init__(self, root=TRIP_DIR, params=SegmentationParams()):
+        self.root = root
+        self.params = params
+        self._lock = threading.Lock()
+
+    def _dir(self, date):
+        return os.path.join(self.root, date)
+
+    def _path(self, date, line):
+        return os.path.join(self._dir(date), f"line_{line}{TRIP_SUFFIX}")
+
+    def manifest(self, date):
+        try:
+            with open(os.path.join(self._dir(date), MANIFEST), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def write_manifest(self, date, complete):
+        os.makedirs(self._dir(date), exist_ok=True)
+        path = os.path.join(self._dir(date), MANIFEST)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'params': self.params.key(), 'complete': complete}, f)
+        os.replace(path + '.tmp', path)
+
+    def is_complete(self, date):
+        """True if the date's trips were built from the whole day with the current parameters."""
+        manifest = self.manifest(date)
+        return bool(manifest and manifest.get('complete') and manifest.get('params') == self.params.key())
+
+    def append(self, date, line_trips):
+        """Appends {line: [trip, ...]} to the date's files."""
+        with self._lock:
+            os.makedirs(self._dir(date), exist_ok=True)
+            for line, trips in line_trips.items():
+                with open(self._path(date, line), 'a', encoding='utf-8') as f:
+                    f.write(''.join(json.dumps(trip, separators=(',', ':')) + '\n' for trip in trips))
+
+    def replace_day(self, date, line_trips, complete):
+        """Rewrites all trips of a date, e.g. after a replay of its logs."""
+        with self._lock:
+            os.makedirs(self._dir(date), exist_ok=True)
+            for name in os.listdir(self._dir(date)):
+                if name.startswith('line_') and name.endswith(TRIP_SUFFIX):
+                    os.remove(os.path.join(self._dir(date), name))
+            for line, trips in line_trips.items():
+                path = self._path(date, line)
+                with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                    f.write(''.join(json.dumps(trip, separators=(',', ':')) + '\n' for trip in trips))
+                os.replace(path + '.tmp', path)
+            self.write_manifest(date, complete)
+
+    def lines(self, date):
+        directory = self._dir(date)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(
+            name[len('line_'):-len(TRIP_SUFFIX)] for name in os.listdir(directory)
+            if name.startswith('line_') and name.endswith(TRIP_SUFFIX)
+        )
+
+    def load(self, date, line):
+        """Trips of one line, ordered by course and start time."""
+        trips = []
+        try:
+            with open(self._path(date, line), 'r', encoding='utf-8') as f:
+                for row in f:
+                    if row.endswith('\n'):
+                        trips.append(json.loads(row))
+        except FileNotFoundError:
+            return []
+        trips.sort(key=_sort_key)
+        return trips
+
+
+class _OpenTrip:
+    """
+    Samples of one vehicle's current trip.
+
+    anchor: index of the sample the current dwell is measured from (see
+    segmentation.dwell_anchors); None while parked. lead: (ts, lat, lon) of the
+    anchor of a long dwell the samples follow; it is put back in front of them
+    when the trip is finalized, so the dwell ends where segment_indices() ends
+    it. parked: waiting out a long dwell. anchored: the first sample was
+    already emitted (see the stale sweep) and is only kept in case the vehicle
+    reappears at the same spot.
+    """
+    __slots__ = ('date', 'ts', 'lat', 'lon', 'anchor', 'anchor_ts', 'anchor_lat', 'anchor_lon',
+                 'lead', 'parked', 'anchored')
+
+    def __init__(self, date, ts, lat, lon):
+        self.date = date
+        self.parked = False
+        self.restart(ts, lat, lon)
+
+    def restart(self, ts, lat, lon, anchored=False):
+        """Starts over from one sample, which is its own anchor."""
+        self.ts, self.lat, self.lon = array('q', [ts]), array('d', [lat]), array('d', [lon])
+        self.anchored = anchored
+        self.lead = None
+        self.set_anchor(0)
+
+    def set_anchor(self, index):
+        self.anchor = index
+        self.anchor_ts, self.anchor_lat, self.anchor_lon = self.ts[index], self.lat[index], self.lon[index]
+
+    def park(self, ts, lat, lon):
+        """Keeps only the latest sample of a long dwell; the dwell's anchor becomes the lead."""
+        self.lead = (self.anchor_ts, self.anchor_lat, self.anchor_lon)
+        self.ts, self.lat, self.lon = array('q', [ts]), array('d', [lat]), array('d', [lon])
+        self.anchored = False
+        self.anchor = None
+
+    def pending(self):
+        """True if the trip holds samples that were not emitted yet."""
+        return len(self.ts) > 1 or not self.anchored
+
+
+class OnlineTripSegmenter:
+    """
+    Keeps one open trip per (line, course) and writes completed trips to the store.
+    Register on_snapshot() with VehiclePoller.add_listener() and call start()
+    with the log directory to rebuild today's state first.
+    """
+
+    def __init__(self, store, params=SegmentationParams()):
+        self.store = store
+        self.params = params
+        self._open = {}
+        self._lock = threading.RLock()
+        self._pending = []
+        self.ready = False
+        self.date = None
+        self._last_sweep = 0.0
+        self.completed_trips = 0
+        self.replay_seconds = None
+
+    def start(self, log_root):
+        """Replays today's logs in a background thread; snapshots arriving meanwhile are queued."""
+        threading.Thread(target=self._replay_today, args=(log_root,), name='trip-replay', daemon=True).start()
+
+    def _replay_today(self, log_root):
+        t0 = time.perf_counter()
+        today = datetime.now().strftime('%Y-%m-%d')
+        try:
+            completed = self.replay(vehicle_log_store.load_day(today, log_root))
+            self.store.replace_day(today, completed, complete=False)
+        except Exception:
+            log.exception("Replaying today's vehicle logs into trips failed")
+        with self._lock:
+            self.date = self.date or today
+            pending, self._pending = self._pending, []
+            for fetched_at, positions in pending:
+                self._ingest_positions(fetched_at, positions)
+            self.ready = True
+        self.replay_seconds = round(time.perf_counter() - t0, 2)
+
+    def replay(self, day):
+        """
+        Feeds {line: records} (one day of logs) through the segmenter without
+        writing; returns the completed trips as {line: [trip, ...]}.
+        """
+        records = [part for part in day.values() if len(part)]
+        if not records:
+            return {}
+        records = np.concatenate(records)
+        records = records[np.argsort(records['ts'], kind='stable')]
+        lines = [line.decode('ascii', 'replace') for line in records['line'].tolist()]
+        lat = (records['lat'] / vehicle_log_store.COORD_SCALE).tolist()
+        lon = (records['lon'] / vehicle_log_store.COORD_SCALE).tolist()
+        courses, ts = records['course'].tolist(), records['ts'].tolist()
+        bounds = np.flatnonzero(np.r_[True, records['ts'][1:] != records['ts'][:-1], True])
+
+        # Runs before the segmenter is ready, so no snapshot touches the state meanwhile.
+        completed = {}
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            for line, trip in self._ingest(ts[start], lines[start:end], courses[start:end],
+                                           lat[start:end], lon[start:end]):
+                completed.setdefault(line, []).append(trip)
+        return completed
+
+    def on_snapshot(self, snapshot, previous):
+        with self._lock:
+            if not self.ready:
+                self._pending.append((snapshot.fetched_at, snapshot.positions))
+                return
+            self._ingest_positions(snapshot.fetched_at, snapshot.positions)
+
+    def _ingest_positions(self, fetched_at, positions):
+        # Quantized like the logs, so online and replayed trips are identical.
+        scale = vehicle_log_store.COORD_SCALE
+        completed = {}
+        for line, trip in self._ingest(
+            int(round(fetched_at * 1000)),
+            [p.line for p in positions],
+            [p.course for p in positions],
+            (np.round(np.array([p.lat for p in positions], dtype=np.float64) * scale) / scale).tolist(),
+            (np.round(np.array([p.lon for p in positions], dtype=np.float64) * scale) / scale).tolist(),
+        ):
+            completed.setdefault(_date_of(trip['start']), {}).setdefault(line, []).append(trip)
+        for date, line_trips in completed.items():
+            self.store.append(date, line_trips)
+
+    def _ingest(self, ts, lines, courses, lats, lons):
+        """Adds one poll (all samples share ts, in ms); yields (line, trip) for every trip completed."""
+        params = self.params
+        date = _date_of(ts)
+        if self.date is not None and date != self.date:
+            # New day: the logs are split per date, so every open trip ends here.
+            for key in [key for key, trip in self._open.items() if trip.date != date]:
+                yield from self._close(key)
+            if self.ready:
+                self.store.write_manifest(self.date, complete=True)
+        self.date = date
+
+        t = ts / 1000
+        keys, anchors = [], []
+        for line, course, lat, lon in zip(lines, courses, lats, lons):
+            if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+                continue
+            key = (line, course)
+            trip = self._open.get(key)
+            if trip is None:
+                self._open[key] = _OpenTrip(date, ts, lat, lon)
+                continue
+            if trip.ts[-1] >= ts:
+                continue  # already seen (replay overlap) or out of order
+            keys.append((key, trip, lat, lon))
+            anchors.append((trip.anchor_lat, trip.anchor_lon))
+
+        if keys:
+            anchors = np.array(anchors)
+            distances = haversine_m(anchors[:, 0], anchors[:, 1],
+                                    [k[2] for k in keys], [k[3] for k in keys]).tolist()
+            for (key, trip, lat, lon), distance in zip(keys, distances):
+                yield from self._add(key, trip, ts, lat, lon, distance)
+
+        # Vehicles that disappeared. A trip whose last sample is an anchor is
+        # final (a gap ends it whatever comes next), so it is emitted and only
+        # that sample is kept: if the vehicle reappears there, the dwell it
+        # starts is timed from that sample, as in segment_indices(). Trips
+        # ending inside a dwell stay open until the vehicle moves or the day ends.
+        # Emitting later gives the same trips, so the sweep runs once a minute.
+        if t - self._last_sweep >= 60:
+            self._last_sweep = t
+            for key, trip in list(self._open.items()):
+                if (t - trip.ts[-1] / 1000 > params.max_gap_s and trip.anchor == len(trip.ts) - 1
+                        and not trip.parked and len(trip.ts) > 1):
+                    yield from self._emit(key, trip)
+                    trip.restart(trip.ts[-1], trip.lat[-1], trip.lon[-1], anchored=True)
+
+    def _add(self, key, trip, ts, lat, lon, distance):
+        """distance: meters from the trip's current anchor (or lead while parked)."""
+        params = self.params
+        if distance >= params.dwell_radius_m:
+            if (ts - trip.ts[-1]) / 1000 > params.max_gap_s:
+                # A gap while moving ends the trip. A vehicle that is still at the
+                # same spot after a gap continues its dwell, as in segment_indices().
+                yield from self._close(key)
+                self._open[key] = _OpenTrip(self.date, ts, lat, lon)
+                return
+            # Left the dwell: this sample is the next anchor.
+            trip.parked = False
+            trip.ts.append(ts)
+            trip.lat.append(lat)
+            trip.lon.append(lon)
+            trip.set_anchor(len(trip.ts) - 1)
+            return
+        if not trip.parked and (ts - trip.anchor_ts) / 1000 >= params.dwell_s:
+            # Long dwell: the trip ended at the anchor, where the vehicle stopped.
+            yield from self._emit(key, trip, trip.anchor + 1)
+            trip.parked = True
+        if trip.parked:
+            # Only the last parked sample is kept: it starts the next trip.
+            trip.park(ts, lat, lon)
+            return
+        trip.ts.append(ts)
+        trip.lat.append(lat)
+        trip.lon.append(lon)
+
+    def _close(self, key):
+        yield from self._emit(key, self._open.pop(key))
+
+    def _emit(self, key, trip, end=None):
+        line, course = key
+        for finished in self._finalize(course, trip, end):
+            self.completed_trips += 1
+            yield line, finished
+
+    def _finalize(self, course, trip, end=None):
+        """Trips made of the first `end` samples of an open trip (all by default)."""
+        end = len(trip.ts) if end is None else end
+        ts, lat, lon = trip.ts[:end], trip.lat[:end], trip.lon[:end]
+        if trip.lead is not None:
+            lead_ts, lead_lat, lead_lon = trip.lead
+            ts, lat, lon = [lead_ts] + list(ts), [lead_lat] + list(lat), [lead_lon] + list(lon)
+        if len(ts) < self.params.min_points:
+            return []
+        trips = make_trips(course, ts, lat, lon, self.params)
+        if trip.lead is not None:
+            # The lead only places the dwell; its own trip was emitted before.
+            trips = [finished for finished in trips if finished['start'] != trip.lead[0]]
+        if trip.anchored:
+            # The anchor always ends its own trip (a gap follows it), which was emitted before.
+            trips = [finished for finished in trips if finished['start'] != trip.ts[0]]
+        return trips
+
+    def open_trips(self, date, line):
+        """Trips of a line still in progress on date, as they would look if they ended now."""
+        with self._lock:
+            trips = []
+            for (trip_line, course), trip in self._open.items():
+                if trip_line == line and trip.date == date and trip.pending():
+                    trips.extend(self._finalize(course, trip))
+        return trips
+
+    def open_lines(self, date):
+        with self._lock:
+            return {line for (line, _), trip in self._open.items() if trip.date == date and trip.pending()}
+
+    def serves(self, date):
+        """True if trips of date can be answered from the store plus the open trips."""
+        return self.ready and date == self.date
+
+    def stats(self):
+        with self._lock:
+            return {
+                "ready": self.ready,
+                "date": self.date,
+                "open_trips": sum(trip.pending() for trip in self._open.values()),
+                "completed_trips": self.completed_trips,
+                "replay_seconds": self.replay_seconds,
+            }
+
+
+def backfill_day(date, log_root, store):
+    """Rebuilds a closed day's trips from its logs. Returns the number of trips."""
+    line_trips = {}
+    for line, records in vehicle_log_store.load_day(date, log_root).items():
+        trips = trips_from_records(records, store.params)
+        if trips:
+            line_trips[line] = trips
+    store.replace_day(date, line_trips, complete=True)
+    return sum(len(trips) for trips in line_trips.values())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Trip store tools")
+    sub = parser.add_subparsers(dest='command', required=True)
+    backfill = sub.add_parser('backfill', help="build trips of closed days from vehicle_logs "
+                                               "(SEGMENT_* variables as for the app)")
+    backfill.add_argument('dates', nargs='*', help="YYYY-MM-DD dates to backfill")
+    backfill.add_argument('--all', action='store_true', help="every logged date without complete trips")
+    backfill.add_argument('--log-root', default='vehicle_logs')
+    backfill.add_argument('--root', default=TRIP_DIR)
+    backfill.add_argument('--force', action='store_true', help="also rebuild dates that are complete")
+    args = parser.parse_args(argv)
+
+    store = TripStore(args.root, SegmentationParams.from_env())
+    dates = vehicle_log_store.list_dates(args.log_root) if args.all else args.dates
+    if not dates:
+        parser.error("give one or more dates or --all")
+    today = datetime.now().strftime('%Y-%m-%d')
+    for date in dates:
+        if date >= today:
+            print(f"{date}: skipped, the day is still being logged (the app replays it on start)")
+            continue
+        if store.is_complete(date) and not args.force:
+            print(f"{date}: already complete")
+            continue
+        t0 = time.perf_counter()
+        count = backfill_day(date, args.log_root, store)
+        print(f"{date}: {count} trips in {time.perf_counter() - t0:.2f}s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
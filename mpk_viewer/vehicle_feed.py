@@ -0,0 +1,275 @@
+"""
+Shared live-vehicle feed.
+
+A single background poller fetches positions from MPK on a fixed cadence and
+publishes them as an immutable, pre-serialized snapshot. HTTP handlers only
+read the current snapshot, so upstream traffic no longer grows with the number
+of open browser tabs.
+"""
+import hashlib
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+
+from pytz import timezone
+
+from shared_feed import read_shared_snapshot, write_shared_snapshot
+from spatial_index import VehicleIndex
+
+WARSAW_TZ = timezone('Europe/Warsaw')
+
+# Seconds between reads of the shared snapshot (and attempts to take over) in a
+# process that is not the background owner.
+FOLLOW_INTERVAL = 1.0
+
+log = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class VehicleSnapshot:
+    """One successful upstream poll, serialized once for every reader."""
+    seq: int
+    fetched_at: float
+    last_update: str
+    positions: tuple
+    vehicles: tuple
+    index: VehicleIndex
+    payload: bytes
+    etag: str
+
+
+def build_snapshot(seq, positions, fetched_at, matcher=None, matches=None):
+    """
+    Builds the snapshot served by /api/vehicles from raw MpykTransLoc objects.
+    With a RouteMatcher (see map_matching.py) vehicles on their route also get
+    a "match" object: direction, snapped position, progress and next stop.
+    Matches computed elsewhere can be passed as `matches` (one per position).
+    """
+    last_update = datetime.fromtimestamp(fetched_at, WARSAW_TZ).strftime('%Y-%m-%d %H:%M:%S')
+    vehicles = tuple(
+        {
+            'lat': p.lat,
+            'lon': p.lon,
+            'line': p.line,
+            'type': p.kind
+        } for p in positions
+    )
+    if matcher is not None:
+        matches = matcher.match_positions(positions)
+    if matches is not None:
+        for vehicle, match in zip(vehicles, matches):
+            if match is not None:
+                vehicle['match'] = match
+    index = VehicleIndex(vehicles)
+    payload = index.payload(range(len(vehicles)), last_update)
+    etag = hashlib.sha1(payload).hexdigest()
+    return VehicleSnapshot(
+        seq=seq,
+        fetched_at=fetched_at,
+        last_update=last_update,
+        positions=tuple(positions),
+        vehicles=vehicles,
+        index=index,
+        payload=payload,
+        etag=etag,
+    )
+
+
+def empty_snapshot():
+    """Served until the first poll succeeds: no vehicles, no update time, always stale."""
+    index = VehicleIndex(())
+    payload = index.payload((), None)
+    return VehicleSnapshot(
+        seq=0,
+        fetched_at=0.0,
+        last_update=None,
+        positions=(),
+        vehicles=(),
+        index=index,
+        payload=payload,
+        etag=hashlib.sha1(payload).hexdigest(),
+    )
+
+
+class VehiclePoller:
+    """
+    Refreshes the vehicle snapshot in a daemon thread every `interval` seconds.
+
+    If upstream is slow or failing, readers keep getting the last good snapshot;
+    it is reported as stale once it is older than `max_age` seconds.
+    Listeners registered with add_listener() run once per successful refresh
+    with (snapshot, previous_snapshot). An optional matcher map-matches every
+    snapshot onto the route geometry before it is published; with
+    matcher_factory it is built by the polling thread before the first fetch.
+
+    With an owner_lock (see shared_feed.py) only the process holding the lock
+    fetches from upstream; it writes every snapshot to shared_path, which the
+    other processes read instead. Listeners added with owner_only=True (logs,
+    trips) run only in the owner, and on_owner() runs once when this process
+    becomes the owner, before its first fetch.
+    """
+
+    def __init__(self, client, interval=15.0, max_age=120.0, matcher=None, matcher_factory=None,
+                 owner_lock=None, shared_path=None, on_owner=None):
+        self.client = client
+        self.matcher = matcher
+        self.matcher_factory = matcher_factory
+        self.owner_lock = owner_lock
+        self.shared_path = shared_path
+        self.on_owner = on_owner
+        self._owner = owner_lock is None
+        self._owner_listeners = []
+        self.interval = interval
+        self.max_age = max_age
+        self._snapshot = None
+        self._empty = empty_snapshot()
+        self._listeners = []
+        self._fetch_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._seq = 0
+        self.last_error = None
+        self.last_attempt = None
+        self.consecutive_failures = 0
+        self.fetch_seconds = None
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    def add_listener(self, callback, owner_only=False):
+        (self._owner_listeners if owner_only else self._listeners).append(callback)
+
+    @property
+    def is_owner(self):
+        return self._owner
+
+    def start(self):
+        """Starts the polling thread; safe to call repeatedly."""
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name='vehicle-poller', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def get_snapshot(self):
+        """
+        Returns the current snapshot, starting the poller on first use.
+        Never waits on upstream: until the poller's first fetch succeeds this
+        is an empty snapshot, which is_stale() reports as stale.
+        """
+        self.start()
+        snapshot = self._snapshot
+        return snapshot if snapshot is not None else self._empty
+
+    def is_stale(self, snapshot):
+        return time.time() - snapshot.fetched_at > self.max_age
+
+    def refresh(self):
+        """Fetches positions once and publishes a new snapshot on success."""
+        with self._fetch_lock:
+            return self._refresh_locked()
+
+    def stats(self):
+        snapshot = self._snapshot
+        return {
+            "running": self._thread is not None and self._thread.is_alive(),
+            "owner": self._owner,
+            "interval": self.interval,
+            "seq": snapshot.seq if snapshot else None,
+            "vehicles": len(snapshot.vehicles) if snapshot else 0,
+            "age_seconds": round(time.time() - snapshot.fetched_at, 1) if snapshot else None,
+            "stale": self.is_stale(snapshot) if snapshot else True,
+            "fetch_seconds": self.fetch_seconds,
+            "consecutive_failures": self.consecutive_failures,
+            "last_error": self.last_error,
+        }
+
+    def _take_ownership(self):
+        """True if this process fetches from upstream, taking over a free owner lock if there is one."""
+        if self._owner:
+            return True
+        if not self.owner_lock.try_acquire():
+            return False
+        self._owner = True
+        log.info("This process is now the background owner of the vehicle feed")
+        if self.on_owner is not None:
+            try:
+                self.on_owner()
+            except Exception:
+                log.exception("Starting the background jobs failed")
+        return True
+
+    def _follow(self):
+        """Publishes the owner's latest snapshot from the shared file, if it is new."""
+        shared = read_shared_snapshot(self.shared_path)
+        if shared is None:
+            return self._snapshot
+        fetched_at, positions, matches = shared
+        if self._snapshot is not None and self._snapshot.fetched_at == fetched_at:
+            return self._snapshot
+        self._seq += 1
+        previous = self._snapshot
+        snapshot = build_snapshot(self._seq, positions, fetched_at, matches=matches)
+        self._snapshot = snapshot
+        self._notify(self._listeners, snapshot, previous)
+        return snapshot
+
+    def _notify(self, listeners, snapshot, previous):
+        for listener in listeners:
+            try:
+                listener(snapshot, previous)
+            except Exception:
+                log.exception(f"Vehicle snapshot listener {listener!r} failed")
+
+    def _refresh_locked(self):
+        if not self._take_ownership():
+            return self._follow()
+        if self.matcher is None and self.matcher_factory is not None:
+            factory, self.matcher_factory = self.matcher_factory, None
+            try:
+                self.matcher = factory()
+            except Exception:
+                log.exception("Building the map matcher failed; serving raw positions")
+        self.last_attempt = time.time()
+        t0 = time.perf_counter()
+        try:
+            positions = self.client.get_all_positions()
+        except Exception as e:
+            self.consecutive_failures += 1
+            self.last_error = f"{type(e).__name__}: {e}"
+            log.warning(f"Vehicle poll failed ({self.consecutive_failures} in a row): {e}")
+            return self._snapshot
+        self.fetch_seconds = round(time.perf_counter() - t0, 3)
+        self.consecutive_failures = 0
+        self.last_error = None
+
+        self._seq += 1
+        previous = self._snapshot
+        snapshot = build_snapshot(self._seq, positions, time.time(), self.matcher)
+        self._snapshot = snapshot
+
+        if self.shared_path is not None:
+            try:
+                write_shared_snapshot(self.shared_path, snapshot)
+            except OSError:
+                log.exception("Writing the shared vehicle snapshot failed")
+        self._notify(self._listeners + self._owner_listeners, snapshot, previous)
+        return snapshot
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            started = time.monotonic()
+            self.refresh()
+            elapsed = time.monotonic() - started
+            interval = self.interval if self._owner else FOLLOW_INTERVAL
+            self._stop_event.wait(max(0.0, interval - elapsed))
@@ -0,0 +1,753 @@
+"""
+Storage and reader API for vehicle_logs.
+
+Three on-disk formats live side by side in vehicle_logs/<date>/:
+
+* line_<line>.log -- the original human-readable text lines
+* line_<line>.bin -- append-only fixed-width records (RECORD_DTYPE) behind a
+  32-byte header, readable with a single np.memmap
+* line_<line>.arc -- compacted archive of a closed day: hourly blocks of
+  records sorted by vehicle and time, stored column-wise as deltas and
+  deflate-compressed, optionally downsampled (see write_archive())
+
+The historical endpoints only use load_line()/load_day()/load_window(), which
+accept any format, so existing text logs keep working and can be converted at
+any time:
+
+    python vehicle_log_store.py convert --all
+
+Closed days are compacted into archives, and days past the retention period
+deleted, with
+
+    python vehicle_log_store.py compact [--resample S] [--retain-days N]
+
+Next to each log file the writer keeps a time index, line_<line>.<ext>.idx:
+one (epoch minute, byte offset) entry per minute, pointing at the minute's first
+record. load_window() uses it to read only the bytes of a time window; logs
+from before the index existed can be indexed with
+
+    python vehicle_log_store.py index --all
+"""
+import argparse
+import os
+import re
+import shutil
+import sys
+import time
+import zlib
+from datetime import datetime
+
+import numpy as np
+
+MAGIC = b'MPKVLOG1'
+HEADER_SIZE = 32
+# Coordinates are stored as integer multiples of 1e-7 degree (~1 cm).
+COORD_SCALE = 10_000_000
+
+RECORD_DTYPE = np.dtype([
+    ('ts', '<i8'),       # epoch milliseconds
+    ('lat', '<i4'),      # degrees * COORD_SCALE
+    ('lon', '<i4'),      # degrees * COORD_SCALE
+    ('course', '<i4'),
+    ('kind', 'u1'),      # index into KINDS
+    ('_pad', 'V3'),
+    ('line', 'S8'),
+])
+assert RECORD_DTYPE.itemsize == HEADER_SIZE
+
+KINDS = ('bus', 'tram')
+UNKNOWN_KIND = 255
+_KIND_CODES = {kind: i for i, kind in enumerate(KINDS)}
+
+TEXT_SUFFIX = '.log'
+BINARY_SUFFIX = '.bin'
+ARCHIVE_SUFFIX = '.arc'
+INDEX_SUFFIX = '.idx'
+# Left behind by convert_day() unless it was told to remove the text logs.
+CONVERTED_SUFFIX = TEXT_SUFFIX + '.converted'
+
+ARCHIVE_MAGIC = b'MPKVARC1'
+ARCHIVE_VERSION = 1
+ARCHIVE_HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('lines', '<u4'),        # entries in the line name table
+    ('blocks', '<u4'),       # entries in the block table
+    ('_pad', 'V4'),
+    ('resample_ms', '<i8'),  # 0 unless downsampled, see downsample()
+])
+ARCHIVE_BLOCK_DTYPE = np.dtype([
+    ('start_ms', '<i8'),     # first timestamp in the block
+    ('end_ms', '<i8'),       # last timestamp + 1
+    ('offset', '<i8'),       # byte offset of the compressed block in the file
+    ('size', '<i4'),         # compressed size
+    ('count', '<i4'),        # records
+])
+ARCHIVE_BLOCK_MS = 3_600_000
+ARCHIVE_COMPRESSION = 9
+# (field, stored dtype, delta-encoded); 'line' is an index into the archive's line table.
+ARCHIVE_COLUMNS = (
+    ('ts', '<i8', True),
+    ('course', '<i4', True),
+    ('lat', '<i4', True),
+    ('lon', '<i4', True),
+    ('kind', 'u1', False),
+    ('line', '<u2', False),
+)
+
+INDEX_MAGIC = b'MPKVIDX1'
+INDEX_HEADER_SIZE = 16
+INDEX_DTYPE = np.dtype([
+    ('minute', '<i8'),   # epoch minutes (ts // 60000)
+    ('offset', '<i8'),   # byte offset of the minute's first record in the log file
+])
+MINUTE_MS = 60_000
+
+_TEXT_PATTERN = re.compile(
+    r'^(\d{4}-\d{2}-\d{2} \d{2}):(\d{2}):(\d{2}),(\d{3}) - '
+    r'lat=([-\d.]+), lon=([-\d.]+), type=(\w+), line=(\w+), course=(\d+)',
+    re.MULTILINE,
+)
+
+
+def file_header():
+    return MAGIC + b'\0' * (HEADER_SIZE - len(MAGIC))
+
+
+def index_header():
+    return INDEX_MAGIC + b'\0' * (INDEX_HEADER_SIZE - len(INDEX_MAGIC))
+
+
+def encode_index_entries(entries):
+    """Packs [(minute, offset)] into INDEX_DTYPE bytes (no header)."""
+    return np.array(entries, dtype=INDEX_DTYPE).tobytes()
+
+
+def kind_name(code):
+    return KINDS[code] if code < len(KINDS) else 'unknown'
+
+
+def encode_records(timestamp, positions):
+    """Packs one poll's positions into RECORD_DTYPE bytes (no header)."""
+    records = np.zeros(len(positions), dtype=RECORD_DTYPE)
+    records['ts'] = int(round(timestamp * 1000))
+    records['lat'] = np.round(np.array([p.lat for p in positions], dtype=np.float64) * COORD_SCALE)
+    records['lon'] = np.round(np.array([p.lon for p in positions], dtype=np.float64) * COORD_SCALE)
+    records['course'] = [p.course for p in positions]
+    records['kind'] = [_KIND_CODES.get(p.kind, UNKNOWN_KIND) for p in positions]
+    records['line'] = [p.line.encode('ascii', 'replace') for p in positions]
+    return records.tobytes()
+
+
+def read_binary_log(path):
+    """Memory-maps a .bin log. Trailing partial records (mid-append) are ignored."""
+    size = os.path.getsize(path)
+    count = (size - HEADER_SIZE) // RECORD_DTYPE.itemsize
+    if count <= 0:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a vehicle log (bad header)")
+    return np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=HEADER_SIZE, shape=(count,))
+
+
+# The same pattern over raw bytes, so match positions are byte offsets.
+_TEXT_PATTERN_BYTES = re.compile(_TEXT_PATTERN.pattern.encode('ascii'), re.MULTILINE)
+
+
+def _text_minutes(matches):
+    """Epoch minute of every match of _TEXT_PATTERN_BYTES."""
+    hour_epochs = {}
+    minutes = []
+    for match in matches:
+        hour = match.group(1).decode('ascii')
+        base = hour_epochs.get(hour)
+        if base is None:
+            base = int(datetime.strptime(hour, '%Y-%m-%d %H').timestamp()) // 60
+            hour_epochs[hour] = base
+        minutes.append(base + int(match.group(2)))
+    return minutes
+
+
+def parse_text_log(text):
+    """Parses the text log format into a RECORD_DTYPE array; malformed lines are skipped."""
+    rows = _TEXT_PATTERN.findall(text)
+    records = np.zeros(len(rows), dtype=RECORD_DTYPE)
+    if not rows:
+        return records
+
+    hour_epochs = {}
+    ts = np.empty(len(rows), dtype=np.int64)
+    for i, row in enumerate(rows):
+        hour = row[0]
+        base = hour_epochs.get(hour)
+        if base is None:
+            # Local wall-clock hour -> epoch; cached because a file spans few hours.
+            base = int(datetime.strptime(hour, '%Y-%m-%d %H').timestamp()) * 1000
+            hour_epochs[hour] = base
+        ts[i] = base + int(row[1]) * 60_000 + int(row[2]) * 1000 + int(row[3])
+
+    columns = list(zip(*rows))
+    records['ts'] = ts
+    records['lat'] = np.round(np.array(columns[4], dtype=np.float64) * COORD_SCALE)
+    records['lon'] = np.round(np.array(columns[5], dtype=np.float64) * COORD_SCALE)
+    records['kind'] = [_KIND_CODES.get(kind, UNKNOWN_KIND) for kind in columns[6]]
+    records['line'] = np.array(columns[7], dtype='S8')
+    records['course'] = np.array(columns[8], dtype=np.int64)
+    return records
+
+
+def read_text_log(path):
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        return parse_text_log(f.read())
+
+
+def downsample(records, interval_s):
+    """Keeps each vehicle's first record in every interval_s-long time bucket."""
+    if interval_s <= 0 or len(records) < 2:
+        return records
+    bucket = records['ts'] // int(interval_s * 1000)
+    order = np.lexsort((records['ts'], bucket, records['course']))
+    course, bucket = records['course'][order], bucket[order]
+    first = np.r_[True, (course[1:] != course[:-1]) | (bucket[1:] != bucket[:-1])]
+    return records[np.sort(order[first])]
+
+
+def _encode_block(records, line_codes):
+    """Compresses one block: records in (course, ts) order, one byte-shuffled column at a time."""
+    parts = []
+    for name, dtype, delta in ARCHIVE_COLUMNS:
+        column = line_codes if name == 'line' else records[name]
+        column = np.ascontiguousarray(column, dtype=dtype)
+        if delta:
+            # Differences wrap around on overflow, and so does the cumsum undoing them.
+            column = np.diff(column, prepend=column.dtype.type(0))
+        # Byte planes: the high bytes of small differences are long runs of 0x00/0xff.
+        parts.append(column.view(np.uint8).reshape(-1, column.dtype.itemsize).T.tobytes())
+    return zlib.compress(b''.join(parts), ARCHIVE_COMPRESSION)
+
+
+def _decode_block(data, count):
+    """Inverse of _encode_block(); returns {field: column}."""
+    data = zlib.decompress(data)
+    columns = {}
+    offset = 0
+    for name, dtype, delta in ARCHIVE_COLUMNS:
+        dtype = np.dtype(dtype)
+        size = count * dtype.itemsize
+        planes = np.frombuffer(data, dtype=np.uint8, count=size, offset=offset)
+        column = planes.reshape(dtype.itemsize, count).T.copy().view(dtype).ravel()
+        offset += size
+        columns[name] = np.cumsum(column, dtype=dtype) if delta else column
+    return columns
+
+
+def write_archive(path, records, resample_s=0):
+    """
+    Writes records as a compressed archive:
+
+        header (ARCHIVE_HEADER_DTYPE) | line names (S8 each) |
+        block table (ARCHIVE_BLOCK_DTYPE) | zlib-compressed blocks
+
+    Every block covers one hour, so a time window only inflates the blocks it
+    overlaps. Within a block the records are ordered by vehicle and time and
+    stored column-wise, ts/course/lat/lon as differences to the previous
+    record: along a vehicle's track those are small and repetitive, and
+    compress far better than the fixed-width rows.
+    """
+    lines, line_codes = np.unique(records['line'], return_inverse=True)
+    line_codes = line_codes.reshape(-1)
+    hour = records['ts'] // ARCHIVE_BLOCK_MS
+    order = np.lexsort((records['ts'], records['course'], hour))
+    bounds = np.flatnonzero(np.r_[True, hour[order][1:] != hour[order][:-1], True]) if len(order) else [0]
+
+    blocks = np.zeros(len(bounds) - 1, dtype=ARCHIVE_BLOCK_DTYPE)
+    payloads = []
+    offset = ARCHIVE_HEADER_DTYPE.itemsize + len(lines) * 8 + len(blocks) * ARCHIVE_BLOCK_DTYPE.itemsize
+    for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        block = order[start:end]
+        payload = _encode_block(records[block], line_codes[block])
+        blocks[i] = (records['ts'][block].min(), records['ts'][block].max() + 1, offset, len(payload), len(block))
+        payloads.append(payload)
+        offset += len(payload)
+
+    header = np.zeros(1, dtype=ARCHIVE_HEADER_DTYPE)
+    header['magic'] = ARCHIVE_MAGIC
+    header['version'] = ARCHIVE_VERSION
+    header['lines'] = len(lines)
+    header['blocks'] = len(blocks)
+    header['resample_ms'] = int(resample_s * 1000)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(np.asarray(lines, dtype='S8').tobytes())
+        f.write(blocks.tobytes())
+        f.write(b''.join(payloads))
+    os.replace(tmp_path, path)
+
+
+def _archive_tables(f, path):
+    header = np.frombuffer(f.read(ARCHIVE_HEADER_DTYPE.itemsize), dtype=ARCHIVE_HEADER_DTYPE)
+    if len(header) != 1 or header['magic'][0] != ARCHIVE_MAGIC:
+        raise ValueError(f"{path} is not a vehicle log archive (bad header)")
+    if header['version'][0] != ARCHIVE_VERSION:
+        raise ValueError(f"{path}: unsupported archive version {header['version'][0]}")
+    lines = np.frombuffer(f.read(int(header['lines'][0]) * 8), dtype='S8')
+    blocks = np.frombuffer(f.read(int(header['blocks'][0]) * ARCHIVE_BLOCK_DTYPE.itemsize),
+                           dtype=ARCHIVE_BLOCK_DTYPE)
+    return header[0], lines, blocks
+
+
+def read_archive(path, start_ms=None, end_ms=None):
+    """
+    Reads an archive back into RECORD_DTYPE records sorted by timestamp,
+    optionally only those with start_ms <= ts < end_ms.
+    """
+    with open(path, 'rb') as f:
+        _, lines, blocks = _archive_tables(f, path)
+        if start_ms is not None:
+            blocks = blocks[(blocks['end_ms'] > start_ms) & (blocks['start_ms'] < end_ms)]
+        parts = []
+        for block in blocks:
+            f.seek(int(block['offset']))
+            parts.append(_decode_block(f.read(int(block['size'])), int(block['count'])))
+    if not parts:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+
+    # Gather column by column: much cheaper than reordering whole records.
+    columns = {name: np.concatenate([part[name] for part in parts]) for name, _, _ in ARCHIVE_COLUMNS}
+    ts = columns['ts']
+    selected = np.flatnonzero((ts >= start_ms) & (ts < end_ms)) if start_ms is not None else None
+    order = np.argsort(ts if selected is None else ts[selected], kind='stable')
+    if selected is not None:
+        order = selected[order]
+    records = np.zeros(len(order), dtype=RECORD_DTYPE)
+    for name, column in columns.items():
+        records[name] = lines[column[order]] if name == 'line' else column[order]
+    return records
+
+
+def archive_resample_s(path):
+    with open(path, 'rb') as f:
+        header, _, _ = _archive_tables(f, path)
+    return header['resample_ms'] / 1000
+
+
+def read_log_tail(path, offset=0):
+    """
+    Reads only the complete records appended after byte `offset`.
+    Returns (records, new_offset); pass new_offset back on the next call.
+    """
+    if path.endswith(BINARY_SUFFIX):
+        records = read_binary_log(path)
+        start = max(0, (offset - HEADER_SIZE) // RECORD_DTYPE.itemsize)
+        tail = np.array(records[start:])
+        return tail, HEADER_SIZE + len(records) * RECORD_DTYPE.itemsize
+    if path.endswith(ARCHIVE_SUFFIX):
+        # Archives are written once; nothing is ever appended.
+        size = os.path.getsize(path)
+        if offset >= size:
+            return np.zeros(0, dtype=RECORD_DTYPE), offset
+        return read_archive(path), size
+
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b'\n') + 1
+    if end == 0:
+        return np.zeros(0, dtype=RECORD_DTYPE), offset
+    return parse_text_log(data[:end].decode('utf-8', errors='replace')), offset + end
+
+
+def index_path(log_path):
+    return log_path + INDEX_SUFFIX
+
+
+def first_record_offset(log_path):
+    return HEADER_SIZE if log_path.endswith(BINARY_SUFFIX) else 0
+
+
+def build_index(log_path):
+    """
+    Computes the time index of a log file from its contents.
+    Returns None if the records are not in time order (the file cannot be indexed).
+    """
+    if log_path.endswith(BINARY_SUFFIX):
+        minutes = np.asarray(read_binary_log(log_path)['ts']) // MINUTE_MS
+        offsets = HEADER_SIZE + np.arange(len(minutes), dtype=np.int64) * RECORD_DTYPE.itemsize
+    else:
+        with open(log_path, 'rb') as f:
+            matches = list(_TEXT_PATTERN_BYTES.finditer(f.read()))
+        minutes = np.array(_text_minutes(matches), dtype=np.int64)
+        offsets = np.array([match.start() for match in matches], dtype=np.int64)
+
+    if len(minutes) > 1 and np.any(np.diff(minutes) < 0):
+        return None
+    first = np.flatnonzero(np.r_[True, minutes[1:] != minutes[:-1]]) if len(minutes) else []
+    index = np.zeros(len(first), dtype=INDEX_DTYPE)
+    index['minute'] = minutes[first]
+    index['offset'] = offsets[first]
+    return index
+
+
+def write_index(log_path, index):
+    """Writes (or, with index None, removes) the time index of a log file."""
+    path = index_path(log_path)
+    if index is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(index_header())
+        f.write(np.ascontiguousarray(index, dtype=INDEX_DTYPE).tobytes())
+    os.replace(tmp_path, path)
+
+
+def read_index(log_path):
+    """
+    Returns the time index of a log file, or None if there is no usable one.
+    An index has to start at the file's first record; trailing partial entries
+    (mid-append) are ignored.
+    """
+    path = index_path(log_path)
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    if data[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+        return None
+    count = (len(data) - INDEX_HEADER_SIZE) // INDEX_DTYPE.itemsize
+    index = np.frombuffer(data, dtype=INDEX_DTYPE, count=max(count, 0), offset=INDEX_HEADER_SIZE)
+    if not len(index) or index['offset'][0] != first_record_offset(log_path):
+        return None
+    return index
+
+
+def _byte_range(log_path, index, start_ms, end_ms):
+    """Byte range of the log file that holds every record in [start_ms, end_ms)."""
+    size = os.path.getsize(log_path)
+    minutes = index['minute']
+    i = min(np.searchsorted(minutes, start_ms // MINUTE_MS, side='left'), len(index) - 1)
+    j = np.searchsorted(minutes, (end_ms - 1) // MINUTE_MS, side='right')
+    start = int(index['offset'][i])
+    # Past the last indexed minute the index may lag behind the log; read to the end.
+    end = int(index['offset'][j]) if j < len(index) else size
+    return min(start, size), min(end, size)
+
+
+def read_window(log_path, start_ms, end_ms):
+    """
+    Records of one log file with start_ms <= ts < end_ms. With a time index
+    only the window's bytes are read, otherwise the whole file is filtered.
+    """
+    if log_path.endswith(ARCHIVE_SUFFIX):
+        return read_archive(log_path, start_ms, end_ms)
+    index = read_index(log_path)
+    if index is None:
+        records = read_log_file(log_path)
+    else:
+        start, end = _byte_range(log_path, index, start_ms, end_ms)
+        if log_path.endswith(BINARY_SUFFIX):
+            records = read_binary_log(log_path)
+            size = RECORD_DTYPE.itemsize
+            records = records[(start - HEADER_SIZE) // size:(end - HEADER_SIZE) // size]
+        else:
+            with open(log_path, 'rb') as f:
+                f.seek(start)
+                data = f.read(end - start)
+            data = data[:data.rfind(b'\n') + 1]
+            records = parse_text_log(data.decode('utf-8', errors='replace'))
+    ts = records['ts']
+    return np.array(records[(ts >= start_ms) & (ts < end_ms)])
+
+
+def load_window(date, start_ms, end_ms, root='vehicle_logs', lines=None):
+    """Returns {line: records in [start_ms, end_ms), sorted by time} for a date."""
+    files = line_files(date, root)
+    if lines is not None:
+        files = {line: paths for line, paths in files.items() if line in lines}
+    window = {}
+    for line, paths in files.items():
+        parts = [read_window(path, start_ms, end_ms) for path in paths]
+        parts = [part for part in parts if len(part)]
+        if not parts:
+            continue
+        records = np.concatenate(parts) if len(parts) > 1 else parts[0]
+        if len(records) > 1 and np.any(np.diff(records['ts']) < 0):
+            records = records[np.argsort(records['ts'], kind='stable')]
+        window[line] = records
+    return window
+
+
+def index_day(date, root='vehicle_logs', rebuild=False):
+    """Builds the time index of every log file of a date that has none. Returns the count."""
+    built = 0
+    for paths in line_files(date, root).values():
+        for path in paths:
+            if path.endswith(ARCHIVE_SUFFIX):
+                continue  # read whole; see read_window()
+            if not rebuild and read_index(path) is not None:
+                continue
+            write_index(path, build_index(path))
+            built += 1
+    return built
+
+
+def is_date(value):
+    """True for a YYYY-MM-DD date, the only form a date may take in a log or cache path."""
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d') == value
+    except (TypeError, ValueError):
+        return False
+
+
+def list_dates(root='vehicle_logs'):
+    """Returns the YYYY-MM-DD directories under root, newest first."""
+    if not os.path.isdir(root):
+        return []
+    dates = [name for name in os.listdir(root) if is_date(name) and os.path.isdir(os.path.join(root, name))]
+    return sorted(dates, reverse=True)
+
+
+def line_files(date, root='vehicle_logs'):
+    """Maps line name -> list of log file paths (text, binary and/or archive) for a date."""
+    log_dir = os.path.join(root, date)
+    files = {}
+    if not os.path.isdir(log_dir):
+        return files
+    for filename in sorted(os.listdir(log_dir)):
+        if not filename.startswith('line_'):
+            continue
+        for suffix in (TEXT_SUFFIX, BINARY_SUFFIX, ARCHIVE_SUFFIX):
+            if filename.endswith(suffix):
+                line = filename[len('line_'):-len(suffix)]
+                files.setdefault(line, []).append(os.path.join(log_dir, filename))
+    return files
+
+
+def list_lines(date, root='vehicle_logs'):
+    return sorted(line_files(date, root))
+
+
+def read_log_file(path):
+    if path.endswith(BINARY_SUFFIX):
+        return read_binary_log(path)
+    if path.endswith(ARCHIVE_SUFFIX):
+        return read_archive(path)
+    return read_text_log(path)
+
+
+def load_line(date, line, root='vehicle_logs'):
+    """Returns all records of one line for a date, sorted by timestamp."""
+    paths = line_files(date, root).get(line, [])
+    return load_paths(paths)
+
+
+def load_paths(paths):
+    parts = [read_log_file(path) for path in paths]
+    parts = [part for part in parts if len(part)]
+    if not parts:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    if len(parts) == 1:
+        records = parts[0]
+    else:
+        records = np.concatenate(parts)
+    if len(records) > 1 and np.any(np.diff(records['ts']) < 0):
+        records = records[np.argsort(records['ts'], kind='stable')]
+    return records
+
+
+def load_day(date, root='vehicle_logs', lines=None):
+    """Returns {line: records} for a date, optionally restricted to `lines`."""
+    files = line_files(date, root)
+    if lines is not None:
+        files = {line: paths for line, paths in files.items() if line in lines}
+    return {line: load_paths(paths) for line, paths in files.items()}
+
+
+def convert_day(date, root='vehicle_logs', remove_text=False):
+    """
+    Converts every line_<line>.log of a date into line_<line>.bin, merged with
+    any records already in the .bin file. The text file is then renamed to
+    line_<line>.log.converted (or deleted with remove_text) so that readers never
+    see the same record twice. Returns the number of records converted.
+
+    Only convert closed days: the live writer keeps today's files open.
+    """
+    converted = 0
+    for line, paths in line_files(date, root).items():
+        text_paths = [path for path in paths if path.endswith(TEXT_SUFFIX)]
+        if not text_paths:
+            continue
+        records = load_paths(paths)
+        bin_path = os.path.join(root, date, f"line_{line}{BINARY_SUFFIX}")
+        tmp_path = bin_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(file_header())
+            f.write(np.ascontiguousarray(records).tobytes())
+        del records  # release the memory map of the old .bin before replacing it
+        os.replace(tmp_path, bin_path)
+        write_index(bin_path, build_index(bin_path))
+        for path in text_paths:
+            converted += len(read_text_log(path))
+            write_index(path, None)
+            if remove_text:
+                os.remove(path)
+            else:
+                os.replace(path, path + '.converted')
+    return converted
+
+
+def day_files(date, root='vehicle_logs'):
+    """Every file of a date directory that holds (or duplicates) logged records."""
+    log_dir = os.path.join(root, date)
+    if not os.path.isdir(log_dir):
+        return []
+    return [
+        os.path.join(log_dir, name) for name in sorted(os.listdir(log_dir))
+        if name.startswith('line_') and name.endswith((TEXT_SUFFIX, BINARY_SUFFIX, ARCHIVE_SUFFIX,
+                                                         CONVERTED_SUFFIX, INDEX_SUFFIX))
+    ]
+
+
+def compact_day(date, root='vehicle_logs', resample_s=0):
+    """
+    Replaces every log file of a closed day by one archive per line (see
+    write_archive()), optionally downsampled to one record per vehicle every
+    resample_s seconds. Text logs left over from conversion and time indexes are
+    removed too. Exact duplicate records, e.g. from an interrupted earlier run,
+    are dropped. Returns (bytes before, bytes after).
+
+    Only compact closed days: the live writer keeps today's files open.
+    """
+    before = sum(os.path.getsize(path) for path in day_files(date, root))
+    for line, paths in line_files(date, root).items():
+        records = np.unique(np.array(load_paths(paths)))
+        archive_path = os.path.join(root, date, f"line_{line}{ARCHIVE_SUFFIX}")
+        write_archive(archive_path, downsample(records, resample_s), resample_s)
+        for path in paths:
+            if path != archive_path:
+                os.remove(path)
+                write_index(path, None)
+    for path in day_files(date, root):
+        if path.endswith((CONVERTED_SUFFIX, INDEX_SUFFIX)):
+            os.remove(path)
+    after = sum(os.path.getsize(path) for path in day_files(date, root))
+    return before, after
+
+
+def needs_compaction(date, root='vehicle_logs', resample_s=0):
+    """True if a date still has raw logs, or archives kept at a finer resolution than resample_s."""
+    for path in day_files(date, root):
+        if not path.endswith(ARCHIVE_SUFFIX):
+            return True
+        if resample_s > archive_resample_s(path):
+            return True
+    return False
+
+
+def compact(root='vehicle_logs', today=None, resample_s=0, resample_after_days=0, retain_days=0):
+    """
+    Applies the retention policy to every closed day under root and yields
+    (date, action, bytes before, bytes after) per date it changed:
+
+    * days older than retain_days (0 keeps every day) are deleted;
+    * other closed days are compacted into archives, downsampled to resample_s
+      once they are at least resample_after_days old.
+    """
+    today = today or datetime.now().strftime('%Y-%m-%d')
+    today_date = datetime.strptime(today, '%Y-%m-%d')
+    for date in sorted(list_dates(root)):
+        if date >= today:
+            continue
+        age = (today_date - datetime.strptime(date, '%Y-%m-%d')).days
+        if retain_days and age > retain_days:
+            before = sum(os.path.getsize(path) for path in day_files(date, root))
+            shutil.rmtree(os.path.join(root, date))
+            yield date, 'deleted', before, 0
+            continue
+        target = resample_s if age >= resample_after_days else 0
+        if needs_compaction(date, root, target):
+            before, after = compact_day(date, root, target)
+            yield date, 'compacted', before, after
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Vehicle log tools")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    convert = sub.add_parser('convert', help="convert text logs to the binary format")
+    convert.add_argument('dates', nargs='*', help="YYYY-MM-DD directories to convert")
+    convert.add_argument('--all', action='store_true', help="convert every date")
+    convert.add_argument('--root', default='vehicle_logs')
+    convert.add_argument('--remove-text', action='store_true', help="delete .log files after converting")
+    convert.add_argument('--include-today', action='store_true',
+                         help="also convert today's logs (stop the app first)")
+
+    index = sub.add_parser('index', help="build missing time indexes (for playback)")
+    index.add_argument('dates', nargs='*', help="YYYY-MM-DD directories to index")
+    index.add_argument('--all', action='store_true', help="index every date")
+    index.add_argument('--root', default='vehicle_logs')
+    index.add_argument('--rebuild', action='store_true', help="also rebuild existing indexes")
+
+    compaction = sub.add_parser('compact', help="compact closed days into archives and apply retention")
+    compaction.add_argument('--root', default='vehicle_logs')
+    compaction.add_argument('--resample', type=float, default=0, metavar='S',
+                            help="keep one record per vehicle every S seconds (default: all)")
+    compaction.add_argument('--resample-after', type=int, default=0, metavar='DAYS',
+                            help="only downsample days at least this old (default: every closed day)")
+    compaction.add_argument('--retain-days', type=int, default=0, metavar='DAYS',
+                            help="delete days older than this (default: keep everything)")
+
+    bench = sub.add_parser('bench', help="time loading a whole day")
+    bench.add_argument('date')
+    bench.add_argument('--root', default='vehicle_logs')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'convert':
+        dates = list_dates(args.root) if args.all else args.dates
+        if not dates:
+            parser.error("give one or more dates or --all")
+        today = datetime.now().strftime('%Y-%m-%d')
+        for date in dates:
+            if date == today and not args.include_today:
+                print(f"{date}: skipped, the day is still being logged (use --include-today)")
+                continue
+            t0 = time.perf_counter()
+            count = convert_day(date, args.root, remove_text=args.remove_text)
+            print(f"{date}: {count} records converted in {time.perf_counter() - t0:.2f}s")
+    elif args.command == 'index':
+        dates = list_dates(args.root) if args.all else args.dates
+        if not dates:
+            parser.error("give one or more dates or --all")
+        for date in dates:
+            t0 = time.perf_counter()
+            count = index_day(date, args.root, rebuild=args.rebuild)
+            print(f"{date}: {count} files indexed in {time.perf_counter() - t0:.2f}s")
+    elif args.command == 'compact':
+        total_before = total_after = 0
+        t0 = time.perf_counter()
+        for date, action, before, after in compact(args.root, resample_s=args.resample,
+                                                   resample_after_days=args.resample_after,
+                                                   retain_days=args.retain_days):
+            total_before += before
+            total_after += after
+            ratio = f", {before / after:.1f}x" if after else ""
+            print(f"{date}: {action}, {before / 1e6:.2f} MB -> {after / 1e6:.2f} MB{ratio}")
+        print(f"{total_before / 1e6:.2f} MB -> {total_after / 1e6:.2f} MB in {time.perf_counter() - t0:.2f}s")
+    elif args.command == 'bench':
+        t0 = time.perf_counter()
+        day = load_day(args.date, args.root)
+        # Touch every record so memory-mapped files are really read.
+        total = sum(int(records['ts'].size) for records in day.values())
+        checksum = sum(int(records['lat'].sum()) for records in day.values())
+        print(f"{args.date}: {len(day)} lines, {total} records in "
+              f"{(time.perf_counter() - t0) * 1000:.1f} ms (checksum {checksum})")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,280 @@
+"""
+Server-Sent Events push feed for live vehicles (/api/vehicles/stream).
+
+Once per poller tick the broadcaster diffs the new snapshot against the
+previous one, keyed by vehicle course, and encodes a single delta message:
+added vehicles, removed courses and moved vehicles with coordinates quantized
+to 1e-5 degree (~1 m). Vehicles matched onto their route also carry
+[direction, progress, next stop] (see map_matching.py), null otherwise; a
+vehicle whose match changed counts as moved. Every connected client is sent
+the same pre-encoded bytes, so per-client work is a memory copy.
+
+    keyframe vehicles: [course, line, kind, lat, lon, match]
+    delta added:       [course, line, kind, lat, lon, match]
+    delta moved:       [course, lat, lon, match]
+
+A client gets a full keyframe when it connects. Each message carries a
+sequence number as its SSE id, and a delta the sequence number it applies on
+("base"). A client that reconnects with Last-Event-ID inside the retained
+history is replayed the deltas it missed; otherwise it gets a fresh keyframe.
+
+A client may subscribe to a view (StreamView: one line, one vehicle type
+and/or a bounding box). It then only gets the vehicles in its view: its
+deltas are diffs between the view of the last state it was sent and the view
+of the current one, so a vehicle leaving the box arrives as removed and one
+entering it as added. A view's messages are encoded once per tick and shared
+by every client with the same view.
+
+Each open stream holds a worker thread under the Flask dev server; for many
+viewers run the app under a gevent/eventlet worker.
+"""
+import json
+import threading
+import time
+from collections import deque
+
+COORD_QUANTUM = 100_000
+HEARTBEAT_SECONDS = 15.0
+
+
+def _quantize(value):
+    return int(round(value * COORD_QUANTUM))
+
+
+def _match(vehicle):
+    """The streamed part of a vehicle's map match: (direction, progress, next stop), or None."""
+    match = vehicle.get('match')
+    if match is None:
+        return None
+    return match['direction'], round(match['progress'], 3), match['next_stop']
+
+
+def _sse(event, event_id, payload):
+    data = json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
+    return f"id: {event_id}\nevent: {event}\ndata: {data}\n\n".encode('utf-8')
+
+
+def _diff(old, new):
+    """(added, moved, removed) rows turning state `old` into state `new`."""
+    added, moved = [], []
+    for course, vehicle in new.items():
+        before = old.get(course)
+        if before is None or before[:2] != vehicle[:2]:
+            added.append([course, *vehicle])
+        elif before[2:] != vehicle[2:]:
+            moved.append([course, *vehicle[2:]])
+    removed = [course for course in old if course not in new]
+    return added, moved, removed
+
+
+class StreamView:
+    """
+    The part of the fleet one client subscribes to; None fields do not filter.
+    bbox is (south, west, north, east) as returned by spatial_index.parse_bbox().
+    """
+
+    def __init__(self, line=None, kind=None, bbox=None):
+        self.line = line
+        self.kind = kind
+        self.bbox = None if bbox is None else tuple(_quantize(value) for value in bbox)
+        self.key = (line, kind, self.bbox)
+
+    def apply(self, state):
+        """The vehicles of state inside the view."""
+        line, kind, bbox = self.line, self.kind, self.bbox
+        if bbox is not None:
+            south, west, north, east = bbox
+        return {
+            course: vehicle for course, vehicle in state.items()
+            if (line is None or vehicle[0] == line)
+            and (kind is None or vehicle[1] == kind)
+            and (bbox is None or (south <= vehicle[2] <= north and west <= vehicle[3] <= east))
+        }
+
+
+class DeltaBroadcaster:
+    """
+    Poller listener that turns snapshots into keyframe/delta SSE messages.
+    history -- number of past deltas kept for clients that reconnect
+    """
+
+    def __init__(self, history=64):
+        # Event ids are "<epoch>:<seq>" so ids from before a restart never match.
+        self.epoch = str(int(time.time()))
+        self._cond = threading.Condition()
+        # (seq, message, state after seq) per tick
+        self._deltas = deque(maxlen=history)
+        self._state = {}
+        self._seq = 0
+        self._last_update = None
+        self._keyframe = None
+        # Messages of views for the current tick: {(view key, base seq or None): message}
+        self._view_messages = {}
+        self.clients = 0
+
+    def on_snapshot(self, snapshot, previous):
+        # snapshot.vehicles holds the served (and matched) form of each position, in the same order.
+        state = {
+            p.course: (p.line, p.kind, _quantize(p.lat), _quantize(p.lon), _match(vehicle))
+            for p, vehicle in zip(snapshot.positions, snapshot.vehicles)
+        }
+        with self._cond:
+            added, moved, removed = _diff(self._state, state)
+            delta = {
+                "seq": snapshot.seq,
+                "base": self._seq,
+                "last_update": snapshot.last_update,
+                "added": added,
+                "moved": moved,
+                "removed": removed,
+            }
+            self._seq = snapshot.seq
+            self._state = state
+            self._last_update = snapshot.last_update
+            self._keyframe = None
+            self._view_messages = {}
+            self._deltas.append((snapshot.seq, _sse('delta', self._event_id(snapshot.seq), delta), state))
+            self._cond.notify_all()
+
+    def _keyframe_message(self, seq, state, last_update):
+        payload = {
+            "seq": seq,
+            "last_update": last_update,
+            "scale": COORD_QUANTUM,
+            "vehicles": [[course, *vehicle] for course, vehicle in state.items()],
+        }
+        return _sse('keyframe', self._event_id(seq), payload)
+
+    def keyframe(self):
+        """Returns (seq, message) for the full current state; built once per tick."""
+        with self._cond:
+            if self._keyframe is None:
+                self._keyframe = (self._seq, self._keyframe_message(self._seq, self._state, self._last_update))
+            return self._keyframe
+
+    def _event_id(self, seq):
+        return f"{self.epoch}:{seq}"
+
+    def parse_event_id(self, event_id):
+        """Returns the sequence number of a Last-Event-ID from this process, else None."""
+        epoch, _, seq = (event_id or '').partition(':')
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        return int(seq)
+
+    def _messages_after(self, seq):
+        """Deltas newer than seq, or None if the client has to resync."""
+        if seq == self._seq:
+            return []
+        if not self._deltas or seq < self._deltas[0][0] - 1 or seq > self._seq:
+            return None
+        return [message for delta_seq, message, _ in self._deltas if delta_seq > seq]
+
+    def _state_at(self, seq):
+        """The state after tick seq if it is still retained, else None. Caller holds the lock."""
+        if seq == self._seq:
+            return self._state
+        for delta_seq, _, state in self._deltas:
+            if delta_seq == seq:
+                return state
+        return None
+
+    def view_message(self, view, base_seq=None, base_state=None):
+        """
+        Returns (seq, state, message) for a view of the current state: a
+        keyframe, or with base_seq/base_state the delta from that earlier
+        state. Built once per tick and view.
+        """
+        with self._cond:
+            seq, state, last_update = self._seq, self._state, self._last_update
+            key = (view.key, base_seq)
+            message = self._view_messages.get(key)
+        if message is None:
+            if base_state is None:
+                message = self._keyframe_message(seq, view.apply(state), last_update)
+            else:
+                added, moved, removed = _diff(view.apply(base_state), view.apply(state))
+                message = _sse('delta', self._event_id(seq), {
+                    "seq": seq,
+                    "base": base_seq,
+                    "last_update": last_update,
+                    "added": added,
+                    "moved": moved,
+                    "removed": removed,
+                })
+            with self._cond:
+                if self._seq == seq:
+                    self._view_messages[key] = message
+        return seq, state, message
+
+    def _wait_for_change(self, seq):
+        """Waits until a tick after seq or the heartbeat interval passed. Caller holds the lock."""
+        deadline = time.monotonic() + HEARTBEAT_SECONDS
+        while self._seq == seq and time.monotonic() < deadline:
+            self._cond.wait(deadline - time.monotonic())
+
+    def stream(self, last_seq=None, view=None):
+        """Generator of SSE bytes for one client, of the whole fleet or only of a StreamView."""
+        with self._cond:
+            self.clients += 1
+        try:
+            # Ask browsers to wait a few seconds before reconnecting.
+            yield b"retry: 5000\n\n"
+            if view is not None:
+                yield from self._view_stream(last_seq, view)
+                return
+            messages = None
+            if last_seq is not None:
+                with self._cond:
+                    messages = self._messages_after(last_seq)
+                    seq = self._seq
+            if messages is None:
+                seq, message = self.keyframe()
+                messages = [message]
+            for message in messages:
+                yield message
+
+            while True:
+                with self._cond:
+                    self._wait_for_change(seq)
+                    messages = self._messages_after(seq)
+                    latest = self._seq
+                if latest == seq:
+                    yield b": ping\n\n"
+                    continue
+                if messages is None:
+                    latest, message = self.keyframe()
+                    messages = [message]
+                seq = latest
+                for message in messages:
+                    yield message
+        finally:
+            with self._cond:
+                self.clients -= 1
+
+    def _view_stream(self, last_seq, view):
+        with self._cond:
+            base_state = self._state_at(last_seq) if last_seq is not None else None
+            current = self._seq
+        if base_state is None:
+            seq, state, message = self.view_message(view)
+        elif last_seq == current:
+            seq, state, message = last_seq, base_state, None
+        else:
+            seq, state, message = self.view_message(view, last_seq, base_state)
+        if message is not None:
+            yield message
+
+        while True:
+            with self._cond:
+                self._wait_for_change(seq)
+                latest = self._seq
+            if latest == seq:
+                yield b": ping\n\n"
+                continue
+            seq, state, message = self.view_message(view, seq, state)
+            yield message
+
+    def stats(self):
+        with self._cond:
+            return {"seq": self._seq, "clients": self.clients, "history": len(self._deltas)}
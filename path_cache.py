@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import sqlite3
+
+DEFAULT_CACHE_PATH = "mpk_viewer/data/path_cache.sqlite"
+
+# Wartość zwracana przez PathCache.get(), gdy para nie była jeszcze liczona
+MISSING = object()
+
+
+def graph_fingerprint(G):
+    """Liczy skrót grafu (węzły, współrzędne, krawędzie i ich długości)"""
+    h = hashlib.sha256()
+    for node, data in sorted(G.nodes(data=True), key=lambda item: item[0]):
+        h.update(f"{node}:{data.get('x')}:{data.get('y')};".encode())
+    for u, v, length in sorted(G.edges(data="length"), key=lambda e: (e[0], e[1], repr(e[2]))):
+        h.update(f"{u}>{v}:{length};".encode())
+    return h.hexdigest()[:32]
+
+
+class PathCache:
+    """
+    Trwały cache najkrótszych ścieżek (SQLite), kluczowany przez
+    (odcisk grafu, węzeł startowy, węzeł końcowy).
+
+    Wspólny dla wszystkich linii, kierunków i kolejnych uruchomień. Wpisy dla
+    innego odcisku grafu są usuwane przy otwarciu, więc zmiana grafu
+    unieważnia cache. Brak ścieżki też jest zapamiętywany (jako None).
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, fingerprint="", prune=True, commit_every=500):
+        """
+        prune        -- usuwa wpisy innych grafów (wyłączone w procesach roboczych)
+        commit_every -- po ilu nowych wpisach zapisywać; 0 = tylko przez flush()
+        """
+        self.path = path
+        self.fingerprint = fingerprint
+        self.commit_every = commit_every
+        self.hits = 0
+        self.misses = 0
+        self._pending = []
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=30)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS paths ("
+            " graph TEXT NOT NULL, start INTEGER NOT NULL, end INTEGER NOT NULL,"
+            " nodes TEXT, PRIMARY KEY (graph, start, end))"
+        )
+        if prune:
+            removed = self._db.execute(
+                "DELETE FROM paths WHERE graph != ?", (fingerprint,)
+            ).rowcount
+            if removed:
+                print(f"Path cache: dropped {removed} entries of a previous graph")
+        self._db.commit()
+
+        # Wszystkie wpisy bieżącego grafu trzymamy w pamięci - odczyt to lookup w dict
+        self._memory = {
+            (start, end): (json.loads(nodes) if nodes is not None else None)
+            for start, end, nodes in self._db.execute(
+                "SELECT start, end, nodes FROM paths WHERE graph = ?", (fingerprint,)
+            )
+        }
+
+    def __len__(self):
+        return len(self._memory)
+
+    def __contains__(self, pair):
+        return pair in self._memory
+
+    def get(self, start, end):
+        """Zwraca listę węzłów, None (brak ścieżki) albo MISSING"""
+        nodes = self._memory.get((start, end), MISSING)
+        if nodes is MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return nodes
+
+    def put(self, start, end, nodes):
+        """Zapamiętuje ścieżkę (listę węzłów) lub None, gdy ścieżki nie ma"""
+        self._memory[(start, end)] = nodes
+        self._pending.append(
+            (self.fingerprint, start, end, json.dumps(nodes) if nodes is not None else None)
+        )
+        if self.commit_every and len(self._pending) >= self.commit_every:
+            self.flush()
+
+    def pop_pending(self):
+        """
+        Zwraca i zapomina niezapisane wpisy jako (start, end, nodes).
+        Procesy robocze przekazują je w ten sposób do procesu głównego,
+        który jako jedyny pisze do bazy.
+        """
+        entries = [(start, end, self._memory[(start, end)]) for _, start, end, _ in self._pending]
+        self._pending = []
+        return entries
+
+    def flush(self):
+        """Zapisuje oczekujące wpisy jedną transakcją"""
+        if not self._pending:
+            return
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO paths (graph, start, end, nodes) VALUES (?, ?, ?, ?)",
+                self._pending,
+            )
+        self._pending = []
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+    def stats(self):
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0.0
+        return f"{self.hits} hits, {self.misses} misses ({rate:.1f}% hit rate), {len(self)} entries"
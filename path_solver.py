@@ -1,10 +1,22 @@
-import osmnx as ox
 import json
 import networkx as nx
 from tqdm import tqdm
 from datetime import datetime
+import argparse
+import hashlib
+import multiprocessing
+import os
 import time
 
+from graph_store import DRIVE_GRAPH_PATH, TRAM_GRAPH_PATH, load_graphs
+from path_cache import PathCache, MISSING, DEFAULT_CACHE_PATH, graph_fingerprint
+from routing import ENGINES, BidirectionalEngine, make_engine
+from stop_snapping import (
+    STOP_NODES_PATH, line_mode, snap_stops, stop_key, stop_nodes_for, unique_stops
+)
+
+JOURNAL_PATH = "mpk_viewer/data/routes_solved.journal.jsonl"
+
 
 def ts():
     """Zwraca aktualny czas w formacie HH:MM:SS"""
@@ -12,110 +24,359 @@ def ts():
 
 
 def save_routes(routes_data):
-    """Zapisuje dane tras do pliku JSON"""
-    with open("mpk_viewer/data/routes_solved.json", "w", encoding="utf-8") as f:
+    """Zapisuje dane tras do pliku JSON (atomowo, przez plik tymczasowy)"""
+    tmp_path = "mpk_viewer/data/routes_solved.json.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
         json.dump(routes_data, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, "mpk_viewer/data/routes_solved.json")
 
 
-def get_graph():
-    """Pobiera i łączy sieć drogową oraz tramwajową dla Wrocławia"""
-    place_name = "Wroclaw, Poland"
-
-    print(f"[{ts()}] Fetching drive network...")
+def get_graph(drive_path=DRIVE_GRAPH_PATH, tram_path=TRAM_GRAPH_PATH, offline=False):
+    """
+    Wczytuje sieć drogową oraz tramwajową dla Wrocławia z plików lokalnych
+    (pobiera je tylko przy pierwszym uruchomieniu) i łączy je
+    """
     t0 = time.perf_counter()
-    G_drive = ox.graph_from_place(place_name, network_type="drive")
-    print(f"[{ts()}] Drive network loaded in {time.perf_counter() - t0:.1f}s")
+    G_combined, G_drive, G_tram = load_graphs(
+        drive_path, tram_path, offline=offline,
+        log=lambda message: print(f"[{ts()}] {message}"),
+    )
+    print(
+        f"[{ts()}] Graph loaded in {time.perf_counter() - t0:.1f}s "
+        f"({G_combined.number_of_nodes()} nodes, {G_combined.number_of_edges()} edges)"
+    )
 
-    print(f"[{ts()}] Fetching tram network...")
+    return G_combined, G_drive, G_tram
+
+
+def shortest_path_nodes(G_combined, start_node, end_node, cache=None, engine=None):
+    """
+    Zwraca listę węzłów najkrótszej ścieżki albo None, gdy ścieżki nie ma.
+    Wynik (również brak ścieżki) jest zapamiętywany w cache.
+    engine -- silnik z routing.py; domyślnie dwukierunkowy Dijkstra
+              (jak nx.shortest_path)
+    """
+    if cache is not None:
+        route = cache.get(start_node, end_node)
+        if route is not MISSING:
+            return route
+
+    if engine is None:
+        engine = BidirectionalEngine(G_combined)
+    route = engine.path(start_node, end_node)
+
+    if cache is not None:
+        cache.put(start_node, end_node, route)
+    return route
+
+
+def solve_direction(G_combined, stops, stop_nodes, cache=None, engine=None):
+    """
+    Liczy ścieżkę jednego kierunku jako listę [lat, lon].
+    stop_nodes -- {klucz przystanku: [węzeł, odległość_m]} dla sieci linii
+    """
+    path_coordinates = []
+
+    if stops and "lat" in stops[0] and "lon" in stops[0]:
+        path_coordinates.append(
+            [stops[0]["lat"], stops[0]["lon"]]
+        )
+
+    for i in range(len(stops) - 1):
+        start_stop = stops[i]
+        end_stop = stops[i + 1]
+
+        if (
+            "lat" not in start_stop or "lon" not in start_stop
+            or "lat" not in end_stop or "lon" not in end_stop
+        ):
+            continue
+
+        try:
+            start_node = stop_nodes[stop_key(start_stop["lat"], start_stop["lon"])][0]
+            end_node = stop_nodes[stop_key(end_stop["lat"], end_stop["lon"])][0]
+
+            route = shortest_path_nodes(
+                G_combined, start_node, end_node, cache, engine
+            )
+            if route is None:
+                raise nx.NetworkXNoPath(
+                    f"No path between {start_node} and {end_node}"
+                )
+
+            route_coords = [
+                [
+                    G_combined.nodes[node]["y"],
+                    G_combined.nodes[node]["x"],
+                ]
+                for node in route
+            ]
+
+            path_coordinates.extend(route_coords[1:])
+
+        except (nx.NetworkXNoPath, nx.NodeNotFound):
+            # fallback: linia prosta
+            path_coordinates.append(
+                [end_stop["lat"], end_stop["lon"]]
+            )
+
+    return path_coordinates
+
+
+def solve_line(G_combined, data, stop_nodes, cache=None, engine=None):
+    """Liczy ścieżki wszystkich kierunków linii (stop_nodes jak ze snap_stops)"""
+    mode_nodes = stop_nodes[line_mode(data)]
+    return [
+        solve_direction(G_combined, direction.get("stops", []), mode_nodes, cache, engine)
+        for direction in data.get("directions", [])
+    ]
+
+
+def line_input_hash(data):
+    """Skrót przystanków linii - wpis w dzienniku jest ważny tylko dla tych samych danych"""
+    stops = [
+        [[stop.get("lat"), stop.get("lon")] for stop in direction.get("stops", [])]
+        for direction in data.get("directions", [])
+    ]
+    return hashlib.sha1(json.dumps(stops).encode()).hexdigest()
+
+
+def load_journal(journal_path, fingerprint):
+    """
+    Wczytuje dziennik postępu: {linia: wpis}.
+    Dziennik innego grafu jest pomijany, a urwany ostatni wiersz
+    (przerwany zapis) ignorowany.
+    """
+    if not os.path.exists(journal_path):
+        return {}
+
+    done = {}
+    with open(journal_path, "r", encoding="utf-8") as f:
+        header = f.readline()
+        try:
+            if json.loads(header).get("graph") != fingerprint:
+                print(f"[{ts()}] Journal was written for another graph, starting over")
+                return {}
+        except ValueError:
+            return {}
+        for row in f:
+            try:
+                entry = json.loads(row)
+            except ValueError:
+                break
+            done[entry["line"]] = entry
+    return done
+
+
+def open_journal(journal_path, fingerprint, resume):
+    """Otwiera dziennik do dopisywania; bez wznowienia zaczyna nowy plik"""
+    if resume and os.path.exists(journal_path):
+        f = open(journal_path, "r+", encoding="utf-8")
+        # Ucinamy ewentualny niedokończony ostatni wiersz
+        content = f.read()
+        f.seek(content.rfind("\n") + 1 if "\n" in content else 0)
+        f.truncate()
+        return f
+
+    directory = os.path.dirname(journal_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    f = open(journal_path, "w", encoding="utf-8")
+    f.write(json.dumps({"graph": fingerprint}) + "\n")
+    f.flush()
+    return f
+
+
+def prefetch_pairs(router, lines, stop_nodes, cache):
+    """
+    Liczy wszystkie brakujące w cache pary przystanków z podanych linii,
+    pogrupowane po węźle startowym - jedno przeszukiwanie na start.
+    """
+    by_start = {}
+    for data in lines:
+        mode_nodes = stop_nodes[line_mode(data)]
+        for direction in data.get("directions", []):
+            nodes = [
+                mode_nodes[stop_key(stop["lat"], stop["lon"])][0]
+                if "lat" in stop and "lon" in stop else None
+                for stop in direction.get("stops", [])
+            ]
+            for start_node, end_node in zip(nodes, nodes[1:]):
+                if start_node is not None and end_node is not None and (start_node, end_node) not in cache:
+                    by_start.setdefault(start_node, set()).add(end_node)
+
+    if not by_start:
+        return
     t0 = time.perf_counter()
-    G_tram = ox.graph_from_place(
-        place_name, custom_filter='["railway"~"tram"]'
+    count = 0
+    for start_node, end_nodes in tqdm(by_start.items(), desc=f"Routing pairs ({router.name})"):
+        try:
+            routes = router.paths_from(start_node, end_nodes)
+        except nx.NodeNotFound:
+            continue
+        for end_node, route in routes.items():
+            cache.put(start_node, end_node, route)
+            count += 1
+    cache.flush()
+    print(
+        f"[{ts()}] Routed {count} stop pairs from {len(by_start)} starts "
+        f"in {time.perf_counter() - t0:.1f}s"
     )
-    print(f"[{ts()}] Tram network loaded in {time.perf_counter() - t0:.1f}s")
 
-    print(f"[{ts()}] Combining networks...")
-    G_combined = nx.compose(G_drive, G_tram)
 
-    return G_combined, G_drive
+# Stan procesu roboczego (ustawiany raz przez _init_worker)
+_worker = {}
+
+
+def _init_worker(G_combined, stop_nodes, cache_path, fingerprint, engine_name):
+    _worker["G_combined"] = G_combined
+    _worker["stop_nodes"] = stop_nodes
+    _worker["engine"] = make_engine(engine_name, G_combined)
+    _worker["cache"] = (
+        PathCache(cache_path, fingerprint, prune=False, commit_every=0)
+        if cache_path else None
+    )
 
 
-def calculate_paths(G_combined, G_drive, routes_data):
-    """Liczy realistyczne ścieżki pomiędzy przystankami"""
+def _solve_line_task(item):
+    """Zadanie dla puli procesów: zwraca ścieżki linii i nowe wpisy cache"""
+    line, data = item
+    cache = _worker["cache"]
+    paths = solve_line(
+        _worker["G_combined"], data, _worker["stop_nodes"], cache, _worker["engine"]
+    )
+    if cache is None:
+        return line, paths, [], 0, 0
+    hits, misses = cache.hits, cache.misses
+    cache.hits = cache.misses = 0
+    return line, paths, cache.pop_pending(), hits, misses
+
+
+def calculate_paths(G_combined, G_drive, routes_data, cache=None, workers=1,
+                    journal_path=JOURNAL_PATH, resume=True, fingerprint=None,
+                    G_tram=None, stop_nodes=None, engine="bidirectional"):
+    """
+    Liczy realistyczne ścieżki pomiędzy przystankami.
+
+    Przystanki linii tramwajowych są dociągane do sieci tramwajowej (G_tram),
+    autobusowych do drogowej. Bez gotowego stop_nodes wszystkie przystanki
+    są dociągane tutaj, jednym zapytaniem wsadowym na sieć.
+
+    engine -- nazwa silnika z routing.ENGINES. Silnik wsadowy ("csr") liczy
+    najpierw wszystkie brakujące w cache pary, po jednym przeszukiwaniu
+    na każdy przystanek początkowy.
+
+    Każda policzona linia trafia do dziennika (journal_path), więc przerwane
+    liczenie można wznowić bez powtarzania gotowych linii. Przy workers > 1
+    linie są liczone równolegle w puli procesów.
+    """
     start_time = time.perf_counter()
     print(f"[{ts()}] Path calculation started")
 
-    with tqdm(routes_data.items(), desc="Processing lines") as pbar:
-        for line, data in pbar:
-            pbar.set_description(f"Processing line ({line})")
-
-            for direction in data.get("directions", []):
-                stops = direction.get("stops", [])
-                path_coordinates = []
-
-                if stops and "lat" in stops[0] and "lon" in stops[0]:
-                    path_coordinates.append(
-                        [stops[0]["lat"], stops[0]["lon"]]
-                    )
-
-                for i in range(len(stops) - 1):
-                    start_stop = stops[i]
-                    end_stop = stops[i + 1]
-
-                    if (
-                        "lat" not in start_stop or "lon" not in start_stop
-                        or "lat" not in end_stop or "lon" not in end_stop
-                    ):
-                        continue
-
-                    try:
-                        start_node = ox.nearest_nodes(
-                            G_drive,
-                            start_stop["lon"],
-                            start_stop["lat"],
-                        )
-                        end_node = ox.nearest_nodes(
-                            G_drive,
-                            end_stop["lon"],
-                            end_stop["lat"],
-                        )
-
-                        route = nx.shortest_path(
-                            G_combined,
-                            start_node,
-                            end_node,
-                            weight="length",
-                        )
-
-                        route_coords = [
-                            [
-                                G_combined.nodes[node]["y"],
-                                G_combined.nodes[node]["x"],
-                            ]
-                            for node in route
-                        ]
-
-                        path_coordinates.extend(route_coords[1:])
-
-                    except (nx.NetworkXNoPath, ValueError):
-                        # fallback: linia prosta
-                        path_coordinates.append(
-                            [end_stop["lat"], end_stop["lon"]]
-                        )
-
-                direction["path"] = path_coordinates
-
-            # zapis po każdej linii (bezpieczne przy długim liczeniu)
-            save_routes(routes_data)
+    if fingerprint is None:
+        fingerprint = cache.fingerprint if cache is not None else graph_fingerprint(G_combined)
+    if stop_nodes is None:
+        stop_nodes = snap_stops(unique_stops(routes_data), {"drive": G_drive, "tram": G_tram})
+
+    done = load_journal(journal_path, fingerprint) if resume else {}
+    results = {}
+    pending = []
+    for line, data in routes_data.items():
+        entry = done.get(line)
+        if entry is not None and entry["input"] == line_input_hash(data):
+            results[line] = entry["paths"]
+        else:
+            pending.append((line, data))
+    if results:
+        print(f"[{ts()}] Resuming: {len(results)} lines already solved, {len(pending)} left")
+
+    router = make_engine(engine, G_combined)
+    if router.batched and cache is not None:
+        prefetch_pairs(router, [data for _, data in pending], stop_nodes, cache)
+
+    journal = open_journal(journal_path, fingerprint, resume and bool(done))
+    try:
+        def record(line, paths):
+            results[line] = paths
+            journal.write(json.dumps({
+                "line": line,
+                "input": line_input_hash(routes_data[line]),
+                "paths": paths,
+            }, ensure_ascii=False) + "\n")
+            journal.flush()
+            if cache is not None:
+                cache.flush()
+
+        if workers > 1 and len(pending) > 1:
+            if cache is not None:
+                cache.flush()
+            cache_path = cache.path if cache is not None else None
+            with multiprocessing.Pool(
+                workers,
+                initializer=_init_worker,
+                initargs=(G_combined, stop_nodes, cache_path, fingerprint, engine),
+            ) as pool, tqdm(total=len(pending), desc=f"Processing lines ({workers} workers)") as pbar:
+                for line, paths, entries, hits, misses in pool.imap_unordered(_solve_line_task, pending):
+                    if cache is not None:
+                        for start_node, end_node, route in entries:
+                            cache.put(start_node, end_node, route)
+                        cache.hits += hits
+                        cache.misses += misses
+                    record(line, paths)
+                    pbar.update()
+        else:
+            with tqdm(pending, desc="Processing lines") as pbar:
+                for line, data in pbar:
+                    pbar.set_description(f"Processing line ({line})")
+                    record(line, solve_line(G_combined, data, stop_nodes, cache, router))
+    finally:
+        journal.close()
+
+    for line, data in routes_data.items():
+        for direction, path in zip(data.get("directions", []), results[line]):
+            direction["path"] = path
+
+    # jednorazowy zapis wyniku; dziennik nie jest już potrzebny
+    save_routes(routes_data)
+    os.remove(journal_path)
 
     print(
         f"[{ts()}] Path calculation finished in "
         f"{time.perf_counter() - start_time:.1f}s"
     )
+    if cache is not None:
+        print(f"[{ts()}] Path cache: {cache.stats()}")
 
     return routes_data
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Liczy ścieżki tras MPK po sieci OSM")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_PATH,
+                        help=f"plik cache ścieżek (domyślnie {DEFAULT_CACHE_PATH})")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="licz wszystkie ścieżki od nowa, bez cache")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="liczba procesów (0 = wszystkie rdzenie)")
+    parser.add_argument("--journal", default=JOURNAL_PATH,
+                        help=f"dziennik postępu do wznawiania (domyślnie {JOURNAL_PATH})")
+    parser.add_argument("--stop-nodes", default=STOP_NODES_PATH,
+                        help=f"mapowanie przystanek -> węzeł (domyślnie {STOP_NODES_PATH})")
+    parser.add_argument("--engine", default="bidirectional", choices=sorted(ENGINES),
+                        help="silnik wyznaczania tras (domyślnie bidirectional, csr najszybszy)")
+    parser.add_argument("--drive-graph", default=DRIVE_GRAPH_PATH,
+                        help="sieć drogowa: GraphML lub wyciąg OSM XML")
+    parser.add_argument("--tram-graph", default=TRAM_GRAPH_PATH,
+                        help="sieć tramwajowa: GraphML lub wyciąg OSM XML")
+    parser.add_argument("--offline", action="store_true",
+                        help="nie pobieraj brakujących sieci z Overpass")
+    parser.add_argument("--fresh", action="store_true",
+                        help="ignoruj dziennik i licz wszystkie linie od nowa")
+    return parser.parse_args()
+
+
 def main():
+    args = parse_args()
     program_start = time.perf_counter()
     print(f"[{ts()}] Program started")
 
@@ -123,10 +384,42 @@ def main():
     with open("mpk_viewer/data/routes.json", "r", encoding="utf-8") as f:
         routes_data = json.load(f)
 
-    G_combined, G_drive = get_graph()
+    G_combined, G_drive, G_tram = get_graph(args.drive_graph, args.tram_graph, args.offline)
+    fingerprint = G_combined.graph.get("fingerprint") or graph_fingerprint(G_combined)
+
+    t0 = time.perf_counter()
+    stop_nodes = stop_nodes_for(
+        routes_data, {"drive": G_drive, "tram": G_tram}, fingerprint, args.stop_nodes
+    )
+    print(
+        f"[{ts()}] Snapped {sum(len(nodes) for nodes in stop_nodes.values())} stops "
+        f"in {time.perf_counter() - t0:.1f}s"
+    )
+
+    cache = None
+    if not args.no_cache:
+        t0 = time.perf_counter()
+        cache = PathCache(args.cache, fingerprint)
+        print(
+            f"[{ts()}] Path cache opened in {time.perf_counter() - t0:.1f}s "
+            f"({len(cache)} cached pairs)"
+        )
 
+    workers = args.workers or os.cpu_count() or 1
     print(f"[{ts()}] Calculating paths for all routes...")
-    calculate_paths(G_combined, G_drive, routes_data)
+    try:
+        calculate_paths(
+            G_combined, G_drive, routes_data, cache,
+            workers=workers,
+            journal_path=args.journal,
+            resume=not args.fresh,
+            fingerprint=fingerprint,
+            stop_nodes=stop_nodes,
+            engine=args.engine,
+        )
+    finally:
+        if cache is not None:
+            cache.close()
 
     print(
         f"[{ts()}] Done. Total time: "
@@ -0,0 +1,269 @@
+import argparse
+import json
+import math
+import os
+import random
+import time
+
+import networkx as nx
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from graph_store import DRIVE_GRAPH_PATH, TRAM_GRAPH_PATH, load_graphs
+from stop_snapping import STOP_NODES_PATH, line_mode, stop_key
+
+EARTH_RADIUS_M = 6_371_000.0
+
+# Długość zastępcza dla krawędzi o zerowej długości - csgraph traktuje 0 jak brak krawędzi
+MIN_EDGE_LENGTH = 1e-6
+
+
+class DijkstraEngine:
+    """Zwykły (jednokierunkowy) Dijkstra z NetworkX - implementacja referencyjna"""
+    name = "dijkstra"
+    batched = False
+
+    def __init__(self, G):
+        self.G = G
+
+    def path(self, start, end):
+        """Zwraca listę węzłów najkrótszej ścieżki albo None, gdy ścieżki nie ma"""
+        try:
+            return nx.dijkstra_path(self.G, start, end, weight="length")
+        except nx.NetworkXNoPath:
+            return None
+
+    def paths_from(self, start, ends):
+        """Ścieżki z jednego węzła do wielu: {węzeł końcowy: ścieżka albo None}"""
+        return {end: self.path(start, end) for end in ends}
+
+
+class AStarEngine(DijkstraEngine):
+    """
+    A* z heurystyką haversine. Długości krawędzi OSM nie są krótsze niż
+    odległość po kole wielkim, więc heurystyka jest dopuszczalna i wynik
+    ma tę samą długość co u Dijkstry.
+    """
+    name = "astar"
+
+    def __init__(self, G):
+        super().__init__(G)
+        self.coords = {
+            node: (math.radians(data["y"]), math.radians(data["x"]))
+            for node, data in G.nodes(data=True)
+        }
+
+    def _heuristic(self, u, v):
+        lat1, lon1 = self.coords[u]
+        lat2, lon2 = self.coords[v]
+        a = (math.sin((lat2 - lat1) / 2) ** 2
+             + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+        return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+    def path(self, start, end):
+        try:
+            return nx.astar_path(self.G, start, end, heuristic=self._heuristic, weight="length")
+        except nx.NetworkXNoPath:
+            return None
+
+
+class BidirectionalEngine(DijkstraEngine):
+    """
+    Dwukierunkowy Dijkstra (przeszukiwanie od startu i od celu naraz).
+    Tego samego algorytmu używa nx.shortest_path(..., weight=...).
+    """
+    name = "bidirectional"
+
+    def path(self, start, end):
+        try:
+            return nx.bidirectional_dijkstra(self.G, start, end, weight="length")[1]
+        except nx.NetworkXNoPath:
+            return None
+
+
+class CSREngine(DijkstraEngine):
+    """
+    Graf jako macierz rzadka CSR i Dijkstra z SciPy (w C).
+    Jedno przeszukiwanie z węzła startowego obsługuje wszystkie cele naraz,
+    więc do liczenia wielu par warto grupować je po starcie (paths_from).
+    """
+    name = "csr"
+    batched = True
+
+    def __init__(self, G):
+        super().__init__(G)
+        nodes = list(G.nodes)
+        self.nodes = nodes
+        self.index = {node: i for i, node in enumerate(nodes)}
+
+        edges = np.array(
+            [(self.index[u], self.index[v], length) for u, v, length in G.edges(data="length")],
+            dtype=np.float64,
+        ).reshape(-1, 3)
+        u, v, w = edges[:, 0].astype(np.int64), edges[:, 1].astype(np.int64), edges[:, 2]
+        # Z krawędzi równoległych (MultiDiGraph) zostaje najkrótsza
+        order = np.lexsort((w, v, u))
+        u, v, w = u[order], v[order], w[order]
+        first = np.ones(len(u), dtype=bool)
+        first[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+        u, v, w = u[first], v[first], np.maximum(w[first], MIN_EDGE_LENGTH)
+        self.matrix = csr_matrix((w, (u, v)), shape=(len(nodes), len(nodes)))
+
+    def paths_from(self, start, ends):
+        if start not in self.index:
+            raise nx.NodeNotFound(f"Node {start} not in graph")
+        source = self.index[start]
+        dist, predecessors = dijkstra(
+            self.matrix, indices=source, return_predecessors=True
+        )
+        result = {}
+        for end in ends:
+            target = self.index.get(end)
+            if target is None:
+                raise nx.NodeNotFound(f"Node {end} not in graph")
+            if math.isinf(dist[target]):
+                result[end] = None
+                continue
+            route = [target]
+            while route[-1] != source:
+                route.append(predecessors[route[-1]])
+            result[end] = [self.nodes[i] for i in reversed(route)]
+        return result
+
+    def path(self, start, end):
+        return self.paths_from(start, [end])[end]
+
+
+ENGINES = {
+    engine.name: engine
+    for engine in (DijkstraEngine, AStarEngine, BidirectionalEngine, CSREngine)
+}
+
+
+def make_engine(name, G):
+    """Tworzy silnik wyznaczania tras o podanej nazwie"""
+    if name not in ENGINES:
+        raise ValueError(f"Unknown routing engine {name!r} (choose from {', '.join(ENGINES)})")
+    return ENGINES[name](G)
+
+
+def route_length(G, route):
+    """Długość ścieżki [m] - po najkrótszej z krawędzi równoległych"""
+    return sum(
+        min(data["length"] for data in G[u][v].values())
+        for u, v in zip(route, route[1:])
+    )
+
+
+def benchmark_pairs(G, routes_path, stop_nodes_path, count, seed=0):
+    """
+    Pary do testu: kolejne przystanki z routes.json (gdy jest mapowanie
+    przystanek -> węzeł), w przeciwnym razie losowe pary węzłów.
+    """
+    rng = random.Random(seed)
+    pairs = []
+    if os.path.exists(routes_path) and os.path.exists(stop_nodes_path):
+        with open(routes_path, "r", encoding="utf-8") as f:
+            routes_data = json.load(f)
+        with open(stop_nodes_path, "r", encoding="utf-8") as f:
+            modes = json.load(f)["modes"]
+        unique = set()
+        for data in routes_data.values():
+            mode_nodes = modes.get(line_mode(data), {})
+            for direction in data.get("directions", []):
+                nodes = [
+                    mode_nodes.get(stop_key(stop.get("lat"), stop.get("lon")), [None])[0]
+                    for stop in direction.get("stops", [])
+                ]
+                unique.update(
+                    (a, b) for a, b in zip(nodes, nodes[1:])
+                    if a is not None and b is not None and a in G and b in G
+                )
+        pairs = sorted(unique)
+    if not pairs:
+        nodes = list(G.nodes)
+        pairs = [(rng.choice(nodes), rng.choice(nodes)) for _ in range(count)]
+    rng.shuffle(pairs)
+    return pairs[:count] if count else pairs
+
+
+def benchmark(G, pairs, engine_names):
+    """
+    Dla każdego silnika: opóźnienie pojedynczego zapytania (path) oraz łączny
+    czas policzenia wszystkich par (paths_from, pogrupowane po starcie).
+    Długości ścieżek są porównywane z Dijkstrą.
+    """
+    by_start = {}
+    for start, end in pairs:
+        by_start.setdefault(start, []).append(end)
+
+    results = {}
+    reference = None
+    for name in engine_names:
+        t0 = time.perf_counter()
+        engine = make_engine(name, G)
+        build_s = time.perf_counter() - t0
+
+        latencies = []
+        lengths = {}
+        for start, end in pairs:
+            t0 = time.perf_counter()
+            route = engine.path(start, end)
+            latencies.append(time.perf_counter() - t0)
+            lengths[(start, end)] = route_length(G, route) if route is not None else None
+
+        t0 = time.perf_counter()
+        for start, ends in by_start.items():
+            engine.paths_from(start, ends)
+        total_s = time.perf_counter() - t0
+
+        if reference is None:
+            reference = lengths
+        mismatches = sum(
+            1 for pair, length in lengths.items()
+            if (length is None) != (reference[pair] is None)
+            or (length is not None and abs(length - reference[pair]) > 1e-6 * max(1.0, length))
+        )
+        latencies_ms = np.array(latencies) * 1000
+        results[name] = {
+            "build_s": round(build_s, 3),
+            "query_ms_mean": round(float(latencies_ms.mean()), 3),
+            "query_ms_p50": round(float(np.percentile(latencies_ms, 50)), 3),
+            "query_ms_p95": round(float(np.percentile(latencies_ms, 95)), 3),
+            "all_pairs_s": round(total_s, 3),
+            "length_mismatches": mismatches,
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Porównanie silników wyznaczania tras")
+    parser.add_argument("--drive-graph", default=DRIVE_GRAPH_PATH)
+    parser.add_argument("--tram-graph", default=TRAM_GRAPH_PATH)
+    parser.add_argument("--routes", default="mpk_viewer/data/routes.json")
+    parser.add_argument("--stop-nodes", default=STOP_NODES_PATH)
+    parser.add_argument("--pairs", type=int, default=500, help="liczba par (0 = wszystkie)")
+    parser.add_argument("--engines", default=",".join(ENGINES),
+                        help="silniki oddzielone przecinkami; pierwszy jest wzorcem")
+    parser.add_argument("--json", help="zapisz wyniki do pliku JSON")
+    args = parser.parse_args()
+
+    G_combined, _, _ = load_graphs(args.drive_graph, args.tram_graph, offline=True)
+    pairs = benchmark_pairs(G_combined, args.routes, args.stop_nodes, args.pairs)
+    print(f"{G_combined.number_of_nodes()} nodes, {G_combined.number_of_edges()} edges, "
+          f"{len(pairs)} pairs from {len({start for start, _ in pairs})} starts")
+
+    results = benchmark(G_combined, pairs, args.engines.split(","))
+    print(f"{'engine':<14}{'build s':>9}{'mean ms':>10}{'p50 ms':>9}{'p95 ms':>9}"
+          f"{'all pairs s':>13}{'mismatches':>12}")
+    for name, r in results.items():
+        print(f"{name:<14}{r['build_s']:>9}{r['query_ms_mean']:>10}{r['query_ms_p50']:>9}"
+              f"{r['query_ms_p95']:>9}{r['all_pairs_s']:>13}{r['length_mismatches']:>12}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,157 @@
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from bs4 import BeautifulSoup, SoupStrainer
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
+import copy
+import email.utils
+import hashlib
 import json
+import threading
 import time
 import re
 import os
 
-BASE_URL = "https://www.wroclaw.pl"
-TIMETABLE_URL = f"{BASE_URL}/komunikacja/rozklady-jazdy"
+BASE_URL = os.environ.get("MPK_BASE_URL", "https://www.wroclaw.pl")
+TIMETABLE_PATH = "/komunikacja/rozklady-jazdy"
 
-def get_line_links():
+# Politeness defaults: at most REQUESTS_PER_SECOND requests to the host in total,
+# spread over WORKERS concurrent connections.
+WORKERS = 8
+REQUESTS_PER_SECOND = 10.0
+TIMEOUT = 15.0
+RETRIES = 3
+# Seconds before the first retry, doubled for every further one; a longer
+# Retry-After from the server wins, up to MAX_RETRY_AFTER.
+BACKOFF = 0.5
+MAX_RETRY_AFTER = 60.0
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+HTTP_CACHE_FILE = "scrape_cache.json"
+DIFF_FILE = "routes_diff.json"
+
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+# Returned by Fetcher.get_conditional() when the server answers 304.
+NOT_MODIFIED = object()
+
+
+class RateLimiter:
+    """Spaces requests at least 1/rate seconds apart across all threads."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def retry_after_seconds(response):
+    """Seconds asked for by a Retry-After header (delta or HTTP date), or 0."""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return 0.0
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return 0.0
+    return min(max(seconds, 0.0), MAX_RETRY_AFTER)
+
+
+class Fetcher:
+    """
+    Shared HTTP client: one pooled session, a global rate limit, timeouts and
+    retries with exponential backoff on connection errors and 429/5xx responses.
+    Retries are made here rather than in the connection pool, so every attempt
+    waits for the rate limiter and counts against it.
+    """
+
+    def __init__(self, base_url=BASE_URL, workers=WORKERS, rate=REQUESTS_PER_SECOND,
+                 timeout=TIMEOUT, retries=RETRIES, backoff=BACKOFF):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.limiter = RateLimiter(rate)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def url(self, path):
+        return f"{self.base_url}{path}" if path.startswith('/') else path
+
+    def request(self, url, headers=None):
+        """
+        GETs url, retrying connection errors, timeouts and RETRY_STATUSES.
+        Returns the last response; raises the last error if no response came.
+        """
+        for attempt in range(self.retries + 1):
+            delay = self.backoff * 2 ** attempt
+            self.limiter.wait()
+            try:
+                response = self.session.get(url, headers=headers, timeout=self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt == self.retries:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                    return response
+                delay = max(delay, retry_after_seconds(response))
+                response.close()
+            time.sleep(delay)
+
+    def get(self, url):
+        """Returns the body of url; raises requests.exceptions.RequestException on failure."""
+        response = self.request(url)
+        response.raise_for_status()
+        return response.content
+
+    def get_conditional(self, url, cached=None):
+        """
+        Conditional GET using the ETag/Last-Modified stored in `cached`.
+        Returns NOT_MODIFIED on 304, else (content, etag, last_modified).
+        """
+        headers = {}
+        if cached:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+        response = self.request(url, headers)
+        if response.status_code == 304:
+            return NOT_MODIFIED
+        response.raise_for_status()
+        return response.content, response.headers.get('ETag'), response.headers.get('Last-Modified')
+
+
+def get_line_links(fetcher):
     """
     Fetches the main timetable page and extracts links and types for all individual line pages.
     Returns a list of tuples: (line_url, line_type)
     """
     print("Fetching list of all lines...")
     try:
-        response = requests.get(TIMETABLE_URL)
-        response.raise_for_status()
-        time.sleep(1)  # Add a 1-second delay
+        content = fetcher.get(fetcher.url(TIMETABLE_PATH))
     except requests.exceptions.RequestException as e:
         print(f"Error fetching timetable page: {e}")
         return []
 
-    soup = BeautifulSoup(response.content, 'html.parser')
+    soup = BeautifulSoup(content, 'html.parser')
     lines = []
 
     def scrape_section(header_text, line_type):
@@ -33,7 +162,7 @@ def get_line_links():
                 links = list_container.find_all('a', href=re.compile(r"/komunikacja/linia-"))
                 for a in links:
                     if "linia-" in a['href']:
-                        full_url = f"{BASE_URL}{a['href']}" if a['href'].startswith('/') else a['href']
+                        full_url = fetcher.url(a['href'])
                         lines.append((full_url, line_type))
 
     scrape_section('Tramwaj', 'tram')
@@ -42,27 +171,18 @@ def get_line_links():
     print(f"Found {len(lines)} line links.")
     return sorted(list(set(lines)))
 
-def get_route_data_for_line(line_url, line_type):
-    """
-    Fetches a single line page and parses it to extract the routes (directions) and stops.
-    """
+def line_name_from_url(line_url):
     line_name_match = re.search(r'linia-([a-zA-Z0-9]+)-wroclaw', line_url)
-    if not line_name_match:
-        print(f"    Could not extract line name from URL: {line_url}")
-        return None
-    line_name = line_name_match.group(1)
-    
-    print(f"  Scraping line: {line_name} ({line_type}) from {line_url}")
+    return line_name_match.group(1) if line_name_match else None
 
-    try:
-        response = requests.get(line_url)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        print(f"    Error fetching line page: {e}")
-        return None
 
-    soup = BeautifulSoup(response.content, 'html.parser')
-    
+def parse_line_page(content, line_name):
+    """
+    Parses a line page to extract the routes (directions) and stops.
+    """
+    # Only the direction blocks are needed, so skip building the rest of the page tree.
+    soup = BeautifulSoup(content, HTML_PARSER, parse_only=SoupStrainer('div', class_='accordionContent'))
+
     print(f"    Parsing content for line {line_name}...")
     directions_data = []
     
@@ -117,19 +237,172 @@ def get_route_data_for_line(line_url, line_type):
     return {"line": line_name, "directions": directions_data}
 
 
+def fetch_line_pages(fetcher, line_links, workers, http_cache):
+    """
+    Downloads all line pages concurrently and yields (index, result) as they arrive,
+    where result is get_conditional()'s return value, or None if the page could not
+    be fetched. Only fetching happens in the pool - parsing is left to the caller's thread.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(fetcher.get_conditional, link, http_cache.get(link)): i
+            for i, (link, _) in enumerate(line_links)
+        }
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                yield i, future.result()
+            except requests.exceptions.RequestException as e:
+                print(f"    Error fetching line page {line_links[i][0]}: {e}")
+                yield i, None
+
+
+def load_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_json(path, data, indent=None):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent)
+    os.replace(tmp_path, path)
+
+
+def scraped_view(line_data):
+    """The part of a routes.json entry that comes from the scraper (no coordinates or paths)."""
+    return {
+        "type": line_data.get("type"),
+        "directions": [
+            {
+                "direction_name": direction.get("direction_name"),
+                "stops": [
+                    {"name": stop.get("name"), "street": stop.get("street")}
+                    for stop in direction.get("stops", [])
+                ]
+            }
+            for direction in line_data.get("directions", [])
+        ]
+    }
+
+
+def merge_with_previous(scraped, previous, failed_lines):
+    """
+    Builds the new routes.json and a diff against the previous one.
+
+    Unchanged lines keep their previous entry, including coordinates added by
+    add_coordinates.py. Changed lines take coordinates of stops (same name and
+    street) that were already geocoded, so only new stops have to be looked up.
+    Lines whose page failed to download keep their previous entry.
+    """
+    known_coords = {}
+    for line_data in previous.values():
+        for direction in line_data.get("directions", []):
+            for stop in direction.get("stops", []):
+                if "lat" in stop and "lon" in stop:
+                    known_coords[(stop.get("name"), stop.get("street"))] = (stop["lat"], stop["lon"])
+
+    routes = {}
+    diff = {"added": [], "changed": [], "removed": [], "failed": sorted(failed_lines), "unchanged": 0}
+    for line, line_data in scraped.items():
+        old = previous.get(line)
+        if old is not None and scraped_view(old) == line_data:
+            routes[line] = old
+            diff["unchanged"] += 1
+            continue
+        line_data = copy.deepcopy(line_data)
+        for direction in line_data["directions"]:
+            for stop in direction["stops"]:
+                coords = known_coords.get((stop["name"], stop["street"]))
+                if coords:
+                    stop["lat"], stop["lon"] = coords
+        routes[line] = line_data
+        diff["added" if old is None else "changed"].append(line)
+
+    for line in failed_lines:
+        if line in previous:
+            routes[line] = previous[line]
+    diff["removed"] = [line for line in previous if line not in routes]
+    return routes, diff
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Scrapes MPK Wroclaw line routes into routes.json")
+    parser.add_argument("--base-url", default=BASE_URL,
+                        help="site to scrape, e.g. a local fixture server (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="concurrent connections (default: %(default)s)")
+    parser.add_argument("--rate", type=float, default=REQUESTS_PER_SECOND,
+                        help="max requests per second to the host, 0 = unlimited (default: %(default)s)")
+    parser.add_argument("--timeout", type=float, default=TIMEOUT,
+                        help="per-request timeout in seconds (default: %(default)s)")
+    parser.add_argument("--output-dir", default="mpk_viewer/data")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="ignore the HTTP cache and re-download and re-parse every page")
+    return parser.parse_args()
+
+
 def main():
     """
     Main function to orchestrate the scraping process.
     """
+    args = parse_args()
+    start = time.perf_counter()
+    fetcher = Fetcher(args.base_url, workers=args.workers, rate=args.rate, timeout=args.timeout)
+
+    output_dir = args.output_dir
+    os.makedirs(output_dir, exist_ok=True)
+    routes_path = os.path.join(output_dir, "routes.json")
+    cache_path = os.path.join(output_dir, HTTP_CACHE_FILE)
+    http_cache = {} if args.no_cache else load_json(cache_path, {})
+
     all_routes = {}
-    line_links = get_line_links()
+    line_links = get_line_links(fetcher)
 
     if not line_links:
         print("No line links found. Exiting.")
         return
 
-    for link, line_type in line_links:
-        route_data = get_route_data_for_line(link, line_type)
+    print(f"Fetching {len(line_links)} line pages ({args.workers} workers, {args.rate:g} req/s)...")
+    parsed = [None] * len(line_links)
+    failed_lines = set()
+    not_modified = reparsed = 0
+    for i, result in fetch_line_pages(fetcher, line_links, args.workers, http_cache):
+        link, line_type = line_links[i]
+        line_name = line_name_from_url(link)
+        if not line_name:
+            print(f"    Could not extract line name from URL: {link}")
+            continue
+        if result is None:
+            failed_lines.add(line_name)
+            continue
+        cached = http_cache.get(link)
+        if result is NOT_MODIFIED:
+            parsed[i] = cached['route']
+            not_modified += 1
+            continue
+
+        content, etag, last_modified = result
+        digest = hashlib.sha256(content).hexdigest()
+        if cached is not None and cached['sha256'] == digest:
+            # Server without validators (or a new ETag for the same bytes): nothing to parse.
+            parsed[i] = cached['route']
+            not_modified += 1
+        else:
+            print(f"  Scraping line: {line_name} ({line_type}) from {link}")
+            parsed[i] = parse_line_page(content, line_name)
+            reparsed += 1
+        http_cache[link] = {
+            "etag": etag,
+            "last_modified": last_modified,
+            "sha256": digest,
+            "route": parsed[i],
+        }
+
+    # Keep the output in link order, independent of completion order.
+    for (link, line_type), route_data in zip(line_links, parsed):
         if route_data and route_data['directions']:
             all_routes[route_data['line']] = {
                 "type": line_type,
@@ -140,15 +413,19 @@ def main():
                 "type": line_type,
                 "directions": []
             }
-        
-        time.sleep(0.1) # A small delay to be polite
 
-    output_dir = "mpk_viewer/data"
-    os.makedirs(output_dir, exist_ok=True)
-    with open(os.path.join(output_dir, "routes.json"), 'w', encoding='utf-8') as f:
-        json.dump(all_routes, f, ensure_ascii=False, indent=2)
+    all_routes, diff = merge_with_previous(all_routes, load_json(routes_path, {}), failed_lines)
+    save_json(routes_path, all_routes, indent=2)
+    save_json(os.path.join(output_dir, DIFF_FILE), diff, indent=2)
+    save_json(cache_path, http_cache)
 
-    print(f"\nScraping complete. Data saved to {output_dir}/routes.json")
+    print(f"\n{reparsed} pages parsed, {not_modified} unchanged, {len(failed_lines)} failed.")
+    print(
+        f"Lines: {len(diff['added'])} added, {len(diff['changed'])} changed, "
+        f"{len(diff['removed'])} removed, {diff['unchanged']} unchanged "
+        f"(see {output_dir}/{DIFF_FILE})."
+    )
+    print(f"Scraping complete in {time.perf_counter() - start:.1f}s. Data saved to {routes_path}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,129 @@
+import json
+import math
+import os
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+STOP_NODES_PATH = "mpk_viewer/data/stop_nodes.json"
+
+# Promień Ziemi [m] - do rzutowania współrzędnych na płaszczyznę
+EARTH_RADIUS_M = 6_371_000.0
+
+
+def line_mode(data):
+    """Zwraca sieć, do której dociągamy przystanki linii: "tram" albo "drive" """
+    return "tram" if data.get("type") == "tram" else "drive"
+
+
+def stop_key(lat, lon):
+    """Klucz przystanku w mapowaniu (współrzędne jak w routes.json)"""
+    return f"{lat},{lon}"
+
+
+class NodeIndex:
+    """
+    KD-drzewo nad węzłami grafu, w lokalnym rzucie równoodległościowym [m].
+    Budowane raz, odpytywane całą tablicą punktów naraz.
+    """
+
+    def __init__(self, G):
+        nodes = list(G.nodes(data=True))
+        self.nodes = np.array([node for node, _ in nodes])
+        lats = np.array([data["y"] for _, data in nodes], dtype=np.float64)
+        lons = np.array([data["x"] for _, data in nodes], dtype=np.float64)
+        self.lat0 = math.radians(float(lats.mean())) if len(lats) else 0.0
+        self.tree = cKDTree(self._project(lats, lons)) if len(nodes) else None
+
+    def _project(self, lats, lons):
+        x = np.radians(lons) * math.cos(self.lat0) * EARTH_RADIUS_M
+        y = np.radians(lats) * EARTH_RADIUS_M
+        return np.column_stack([x, y])
+
+    def query(self, lats, lons):
+        """Zwraca (węzły, odległości w metrach) dla tablic współrzędnych"""
+        points = self._project(np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64))
+        dist, idx = self.tree.query(points)
+        return self.nodes[idx], dist
+
+
+def unique_stops(routes_data):
+    """Zbiera unikalne współrzędne przystanków w podziale na sieci"""
+    stops = {"drive": {}, "tram": {}}
+    for data in routes_data.values():
+        mode = line_mode(data)
+        for direction in data.get("directions", []):
+            for stop in direction.get("stops", []):
+                if "lat" in stop and "lon" in stop:
+                    stops[mode][stop_key(stop["lat"], stop["lon"])] = (stop["lat"], stop["lon"])
+    return stops
+
+
+def snap_stops(stops, graphs):
+    """
+    Dociąga przystanki do najbliższych węzłów - jednym zapytaniem
+    wsadowym na sieć.
+
+    stops  -- {sieć: {klucz przystanku: (lat, lon)}}, jak z unique_stops()
+    graphs -- {"drive": G_drive, "tram": G_tram}; przy pustej sieci tramwajowej
+              przystanki tramwajowe trafiają do sieci drogowej
+    Zwraca {sieć: {klucz przystanku: [węzeł, odległość_m]}}.
+    """
+    indexes = {}
+    mapping = {}
+    for mode, mode_stops in stops.items():
+        if not mode_stops:
+            mapping[mode] = {}
+            continue
+        G = graphs.get(mode)
+        if G is None or G.number_of_nodes() == 0:
+            G = graphs["drive"]
+        if id(G) not in indexes:
+            indexes[id(G)] = NodeIndex(G)
+        keys = list(mode_stops)
+        coords = np.array([mode_stops[key] for key in keys], dtype=np.float64)
+        nodes, dist = indexes[id(G)].query(coords[:, 0], coords[:, 1])
+        mapping[mode] = {
+            key: [node.item(), round(float(d), 1)]
+            for key, node, d in zip(keys, nodes, dist)
+        }
+    return mapping
+
+
+def load_stop_nodes(path, fingerprint):
+    """Wczytuje zapisane mapowanie; None, jeśli go nie ma lub dotyczy innego grafu"""
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        saved = json.load(f)
+    if saved.get("graph") != fingerprint:
+        return None
+    return saved["modes"]
+
+
+def save_stop_nodes(path, fingerprint, mapping):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"graph": fingerprint, "modes": mapping}, f)
+    os.replace(tmp_path, path)
+
+
+def stop_nodes_for(routes_data, graphs, fingerprint, path=STOP_NODES_PATH):
+    """
+    Zwraca mapowanie przystanek -> węzeł. Zapisane mapowanie jest używane
+    ponownie, a dociągane są tylko przystanki, których w nim brakuje.
+    """
+    mapping = load_stop_nodes(path, fingerprint) or {}
+    missing = {
+        mode: {key: coords for key, coords in mode_stops.items() if key not in mapping.get(mode, {})}
+        for mode, mode_stops in unique_stops(routes_data).items()
+    }
+
+    if any(missing.values()):
+        for mode, snapped in snap_stops(missing, graphs).items():
+            mapping.setdefault(mode, {}).update(snapped)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        save_stop_nodes(path, fingerprint, mapping)
+    return mapping
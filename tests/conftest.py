@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, "tests", "fixtures")
+
+# Skrypty leżą w katalogu głównym repozytorium i importują się nawzajem płasko,
+# moduły aplikacji tak samo w mpk_viewer/
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "mpk_viewer"))
+
+
+@pytest.fixture(scope="session")
+def graphs(tmp_path_factory):
+    """(G_combined, G_drive, G_tram) z małych sieci w tests/fixtures/graphs"""
+    from graph_store import load_graphs
+
+    return load_graphs(
+        os.path.join(FIXTURES, "graphs", "drive.graphml"),
+        os.path.join(FIXTURES, "graphs", "tram.graphml"),
+        cache_dir=str(tmp_path_factory.mktemp("graph_cache")),
+        offline=True,
+        log=lambda message: None,
+    )
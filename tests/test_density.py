@@ -0,0 +1,89 @@
+import math
+
+import numpy as np
+import pytest
+
+import vehicle_log_store
+from density import CELLS_PER_TILE, DensityGrid, _decode, _encode, _tile_key, cell_coords
+
+SCALE = vehicle_log_store.COORD_SCALE
+T0 = 1_790_000_000_000
+A = (51.10, 17.03)
+B = (51.101, 17.031)   # ~130 m from A, another cell at every zoom from 14 up
+
+
+def slippy_tile(lat, lon, zoom):
+    """Tile numbers of the usual web map scheme."""
+    n = 2 ** zoom
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return x, y
+
+
+def records(samples):
+    """Record array from (seconds, (lat, lon), course, line, kind) tuples."""
+    out = np.zeros(len(samples), dtype=vehicle_log_store.RECORD_DTYPE)
+    for i, (t, (lat, lon), course, line, kind) in enumerate(samples):
+        out[i]['ts'] = T0 + t * 1000
+        out[i]['lat'], out[i]['lon'] = round(lat * SCALE), round(lon * SCALE)
+        out[i]['course'], out[i]['line'], out[i]['kind'] = course, line, kind
+    return out
+
+
+@pytest.fixture
+def grid():
+    tram = [(t, A, 1, b"1", 1) for t in (0, 15, 30, 45)] + [(t, B, 1, b"1", 1) for t in (60, 75)]
+    # The bus is seen twice at A with a gap between: two visits, no known dwell
+    bus = [(0, A, 2, b"2", 0), (1000, A, 2, b"2", 0)]
+    return DensityGrid.build({"1": records(tram), "2": records(bus)})
+
+
+def around(*points, margin=0.002):
+    lats, lons = [p[0] for p in points], [p[1] for p in points]
+    return min(lats) - margin, min(lons) - margin, max(lats) + margin, max(lons) + margin
+
+
+def test_cells_are_keyed_by_slippy_tile_at_zoom_16():
+    gx, gy = cell_coords([A[0]], [A[1]], 16)
+    assert (int(gx[0]) // CELLS_PER_TILE, int(gy[0]) // CELLS_PER_TILE) == slippy_tile(*A, 16)
+
+    # The corners of the world fit the key at the finest zoom and decode back
+    last = (1 << (16 + 6)) - 1
+    gx = np.array([0, last, 0, last, 1234567], dtype=np.int64)
+    gy = np.array([0, 0, last, last, 2345678], dtype=np.int64)
+    line = np.array([0, 1, 2, (1 << 16) - 1, 7], dtype=np.int64)
+    keys = _encode(gx, gy, line)
+    assert (keys >= 0).all()
+    for decoded, expected in zip(_decode(keys), (gx, gy, line)):
+        assert decoded.tolist() == expected.tolist()
+
+    # All keys of a tile lie between its own and the next tile's smallest key
+    tx, ty = gx[4] // CELLS_PER_TILE, gy[4] // CELLS_PER_TILE
+    assert _tile_key(tx, ty) <= keys[4] < _tile_key(tx, ty + 1)
+
+
+def test_counts_and_dwell_per_cell(grid):
+    tiles = grid.query(16, around(A, B))
+    tile_a = "%d/%d" % slippy_tile(*A, 16)
+    cells = sorted(cell[2:] for cell in sum(tiles.values(), []))
+    # A: 6 positions, 60 s of tram time over 3 visits; B: 2 positions, 15 s in one visit
+    assert cells == [[2, 15.0], [6, 20.0]]
+    assert [cell[2:] for cell in tiles[tile_a]] == [[6, 20.0]]
+
+    by_line = sorted(cell[2:] for cell in grid.query(16, around(A), by="line")[tile_a])
+    assert by_line == [[2, 0.0, "2"], [4, 60.0, "1"]]
+    assert [cell[2:] for cell in grid.query(16, around(A), lines=["2"])[tile_a]] == [[2, 0.0]]
+    trams = grid.query(16, around(A, B), kind=vehicle_log_store.KINDS.index("tram"))
+    assert sum(cell[2] for cells in trams.values() for cell in cells) == 6
+
+
+@pytest.mark.parametrize("zoom", [10, 13, 16])
+def test_every_zoom_counts_every_position(grid, zoom):
+    tiles = grid.query(zoom, around(A, B))
+    assert sum(cell[2] for cells in tiles.values() for cell in cells) == 8
+
+
+def test_save_and_load(grid, tmp_path):
+    path = str(tmp_path / "grid.npz")
+    grid.save(path)
+    assert DensityGrid.load(path).query(16, around(A, B), by="type") == grid.query(16, around(A, B), by="type")
@@ -0,0 +1,75 @@
+from types import SimpleNamespace
+
+import pytest
+
+from map_matching import RouteMatcher
+
+
+def stop(name, lat, lon):
+    return {"name": name, "lat": lat, "lon": lon}
+
+
+# Line 1 runs east along 51.10 N and back; line 2 is a separate east-west street
+# to the north, with two directions that do not share their geometry.
+EAST = [stop("A", 51.10, 17.000), stop("B", 51.10, 17.005), stop("C", 51.10, 17.010)]
+ROUTES = {
+    "1": {"type": "tram", "directions": [
+        {"direction_name": "A -> C", "stops": EAST},
+        {"direction_name": "C -> A", "stops": EAST[::-1]},
+    ]},
+    "2": {"type": "bus", "directions": [
+        {"direction_name": "P -> Q", "stops": [stop("P", 51.11, 17.000), stop("Q", 51.11, 17.010)]},
+        {"direction_name": "R -> S", "stops": [stop("R", 51.12, 17.000), stop("S", 51.12, 17.010)]},
+    ]},
+}
+
+
+def vehicle(line, lat, lon, course=1):
+    return SimpleNamespace(line=line, lat=lat, lon=lon, course=course)
+
+
+@pytest.fixture
+def matcher():
+    return RouteMatcher(ROUTES)
+
+
+def test_direction_and_next_stop(matcher):
+    first, = matcher.match_positions([vehicle("1", 51.10002, 17.002)])
+    assert first["direction"] == "A -> C"
+    assert first["next_stop"] == "B"
+    assert first["lat"] == pytest.approx(51.10, abs=1e-6)
+    assert 0.15 < first["progress"] < 0.25
+
+    # Further east the heading confirms the direction; B is passed
+    moved, = matcher.match_positions([vehicle("1", 51.10, 17.007)])
+    assert moved["direction"] == "A -> C" and moved["next_stop"] == "C"
+
+
+def test_heading_picks_the_opposite_direction(matcher):
+    matcher.match_positions([vehicle("1", 51.10, 17.007)])
+    back, = matcher.match_positions([vehicle("1", 51.10, 17.004)])
+    assert back["direction"] == "C -> A"
+    assert back["next_stop"] == "A"
+
+
+def test_stop_counts_as_next_until_passed(matcher):
+    at_b, = matcher.match_positions([vehicle("1", 51.10, 17.00510)])  # ~7 m past B
+    assert at_b["next_stop"] == "B"
+    past_b, = matcher.match_positions([vehicle("1", 51.10, 17.00530)])  # ~21 m past B
+    assert past_b["next_stop"] == "C"
+
+
+def test_next_stop_stays_in_the_matched_direction(matcher):
+    # At the very start of R -> S the search key reaches back into P -> Q's stops.
+    start, = matcher.match_positions([vehicle("2", 51.12, 17.00005)])
+    assert start["direction"] == "R -> S"
+    assert start["next_stop"] == "R"
+
+
+def test_unmatched_vehicles(matcher):
+    off_route, unknown_line, other_line = matcher.match_positions([
+        vehicle("1", 51.101, 17.005, course=1),   # ~110 m off the street
+        vehicle("99", 51.10, 17.005, course=2),
+        vehicle("2", 51.10, 17.005, course=3),    # on line 1's street, not its own
+    ])
+    assert off_route is None and unknown_line is None and other_line is None
@@ -0,0 +1,189 @@
+import copy
+import json
+import os
+
+import pytest
+
+import path_solver
+from path_cache import MISSING, PathCache
+from path_solver import JOURNAL_PATH, calculate_paths, line_input_hash
+
+SOLVED_PATH = "mpk_viewer/data/routes_solved.json"
+
+
+def stop(G, node, name):
+    """Przystanek kilka metrów obok węzła, żeby dociąganie miało co robić"""
+    return {"name": name, "lat": round(G.nodes[node]["y"] + 0.00003, 7),
+            "lon": round(G.nodes[node]["x"] - 0.00002, 7)}
+
+
+@pytest.fixture
+def routes_data(graphs):
+    G = graphs[0]
+    bus_a = [stop(G, node, f"A{i}") for i, node in enumerate((100, 123, 155, 900))]
+    bus_b = [stop(G, node, f"B{i}") for i, node in enumerate((150, 133, 105))]
+    bus_b.insert(1, {"name": "bez współrzędnych"})
+    tram = [stop(G, node, f"T{i}") for i, node in enumerate((500, 502, 504, 507))]
+    return {
+        "100": {"type": "bus", "directions": [{"stops": bus_a}, {"stops": bus_a[::-1]}]},
+        "101": {"type": "bus", "directions": [{"stops": bus_b}, {"stops": bus_b[::-1]}]},
+        "1": {"type": "tram", "directions": [{"stops": tram}, {"stops": tram[::-1]}]},
+    }
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """calculate_paths zapisuje do mpk_viewer/data względem katalogu roboczego"""
+    os.makedirs(tmp_path / "mpk_viewer" / "data")
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def solve(graphs, routes_data, **kwargs):
+    G_combined, G_drive, G_tram = graphs
+    return calculate_paths(G_combined, G_drive, copy.deepcopy(routes_data), G_tram=G_tram, **kwargs)
+
+
+def paths_of(routes_data):
+    return {line: [d["path"] for d in data["directions"]] for line, data in routes_data.items()}
+
+
+def first_stop(data):
+    """Nazwa pierwszego przystanku - rozpoznaje linię po kopii danych"""
+    return data["directions"][0]["stops"][0]["name"]
+
+
+def open_cache(graphs):
+    return PathCache("mpk_viewer/data/path_cache.sqlite", graphs[0].graph["fingerprint"])
+
+
+def test_path_cache_roundtrip(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = PathCache(path, "graph-a", commit_every=0)
+    cache.put(1, 2, [1, 5, 2])
+    cache.put(1, 3, None)
+    assert cache.get(1, 2) == [1, 5, 2]
+    assert cache.get(2, 1) is MISSING
+    cache.close()
+
+    cache = PathCache(path, "graph-a")
+    assert len(cache) == 2
+    assert cache.get(1, 2) == [1, 5, 2]
+    assert cache.get(1, 3) is None
+    cache.close()
+
+    # Inny graf unieważnia zapisane ścieżki
+    cache = PathCache(path, "graph-b")
+    assert len(cache) == 0 and cache.get(1, 2) is MISSING
+    cache.close()
+
+
+def test_pop_pending_hands_over_unsaved_entries(tmp_path):
+    cache = PathCache(str(tmp_path / "cache.sqlite"), "graph", commit_every=0)
+    cache.put(1, 2, [1, 2])
+    assert cache.pop_pending() == [(1, 2, [1, 2])]
+    assert cache.pop_pending() == []
+    cache.close()
+
+
+def test_solve(graphs, routes_data, workdir):
+    result = paths_of(solve(graphs, routes_data))
+    assert not os.path.exists(JOURNAL_PATH)
+    with open(SOLVED_PATH, encoding="utf-8") as f:
+        assert paths_of(json.load(f)) == result
+
+    G = graphs[0]
+    first = result["100"][0]
+    assert first[0] == [routes_data["100"]["directions"][0]["stops"][0]["lat"],
+                        routes_data["100"]["directions"][0]["stops"][0]["lon"]]
+    assert [G.nodes[123]["y"], G.nodes[123]["x"]] in first
+    # Przystanek na wyspie jest nieosiągalny - ostatni odcinek to linia prosta
+    assert first[-1] == [routes_data["100"]["directions"][0]["stops"][-1]["lat"],
+                         routes_data["100"]["directions"][0]["stops"][-1]["lon"]]
+    # Linia tramwajowa jedzie po sieci tramwajowej
+    assert [G.nodes[502]["y"], G.nodes[502]["x"]] in result["1"][0]
+
+
+@pytest.mark.parametrize("engine", ["dijkstra", "astar", "csr"])
+def test_engines_give_the_same_routes(graphs, routes_data, workdir, engine):
+    expected = paths_of(solve(graphs, routes_data))
+    cache = open_cache(graphs)
+    try:
+        assert paths_of(solve(graphs, routes_data, cache=cache, engine=engine)) == expected
+    finally:
+        cache.close()
+
+
+def test_cached_rerun(graphs, routes_data, workdir):
+    cache = open_cache(graphs)
+    expected = paths_of(solve(graphs, routes_data, cache=cache))
+    assert cache.misses > 0
+    cache.close()
+
+    cache = open_cache(graphs)
+    assert len(cache) > 0
+    assert paths_of(solve(graphs, routes_data, cache=cache)) == expected
+    assert cache.misses == 0 and cache.hits > 0
+    cache.close()
+
+
+def test_resume_after_interruption(graphs, routes_data, workdir, monkeypatch):
+    expected = paths_of(solve(graphs, routes_data))
+
+    solve_line = path_solver.solve_line
+    solved = []
+
+    def interrupted(G_combined, data, *args):
+        if solved:
+            raise KeyboardInterrupt
+        solved.append(first_stop(data))
+        return solve_line(G_combined, data, *args)
+
+    monkeypatch.setattr(path_solver, "solve_line", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        solve(graphs, routes_data)
+    with open(JOURNAL_PATH, encoding="utf-8") as f:
+        assert len(f.readlines()) == 2  # nagłówek i jedna linia
+    # Urwany zapis na końcu dziennika jest pomijany
+    with open(JOURNAL_PATH, "a", encoding="utf-8") as f:
+        f.write('{"line": "101", "input": "')
+
+    resumed = []
+
+    def counting(G_combined, data, *args):
+        resumed.append(first_stop(data))
+        return solve_line(G_combined, data, *args)
+
+    monkeypatch.setattr(path_solver, "solve_line", counting)
+    assert paths_of(solve(graphs, routes_data)) == expected
+    assert len(resumed) == len(routes_data) - 1
+    assert solved[0] not in resumed
+    assert not os.path.exists(JOURNAL_PATH)
+
+
+def test_journal_entries_of_changed_lines_are_resolved(graphs, routes_data, workdir, monkeypatch):
+    solve(graphs, routes_data)
+    changed = copy.deepcopy(routes_data)
+    changed["101"]["directions"][0]["stops"].pop()
+    assert line_input_hash(changed["101"]) != line_input_hash(routes_data["101"])
+
+    # Dziennik przerwanego przebiegu ze starymi danymi wszystkich linii
+    fingerprint = graphs[0].graph["fingerprint"]
+    with open(JOURNAL_PATH, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"graph": fingerprint}) + "\n")
+        for line, data in routes_data.items():
+            f.write(json.dumps({"line": line, "input": line_input_hash(data),
+                                "paths": [[] for _ in data["directions"]]}) + "\n")
+
+    solve_line = path_solver.solve_line
+    resumed = []
+
+    def counting(G_combined, data, *args):
+        resumed.append(first_stop(data))
+        return solve_line(G_combined, data, *args)
+
+    monkeypatch.setattr(path_solver, "solve_line", counting)
+    result = paths_of(solve(graphs, changed))
+    assert resumed == ["B0"]
+    assert result["100"] == [[], []]
+    assert result["101"][0]
@@ -0,0 +1,69 @@
+import itertools
+
+import networkx as nx
+import pytest
+
+from routing import ENGINES, make_engine, route_length
+
+# Wyspa w sieci drogowej, bez połączenia z resztą grafu
+ISLAND = 900
+
+
+def all_pairs(G):
+    return [(u, v) for u, v in itertools.permutations(sorted(G.nodes), 2)]
+
+
+@pytest.fixture(scope="module")
+def reference(graphs):
+    """Ścieżki Dijkstry (implementacja referencyjna) dla wszystkich par węzłów"""
+    G = graphs[0]
+    engine = make_engine("dijkstra", G)
+    return {pair: engine.path(*pair) for pair in all_pairs(G)}
+
+
+def test_fixture_has_unreachable_pairs(graphs, reference):
+    island = set(nx.node_connected_component(graphs[0].to_undirected(), ISLAND))
+    unreachable = {pair for pair, route in reference.items() if route is None}
+    assert unreachable == {(u, v) for u, v in reference if (u in island) != (v in island)}
+
+
+@pytest.mark.parametrize("name", sorted(ENGINES))
+def test_engine_matches_dijkstra(graphs, reference, name):
+    G = graphs[0]
+    engine = make_engine(name, G)
+    for (start, end), expected in reference.items():
+        route = engine.path(start, end)
+        if expected is None:
+            assert route is None, (start, end)
+            continue
+        assert route[0] == start and route[-1] == end
+        assert route_length(G, route) == pytest.approx(route_length(G, expected)), (start, end)
+        assert route == expected, (start, end)
+
+
+@pytest.mark.parametrize("name", sorted(ENGINES))
+def test_paths_from_matches_path(graphs, reference, name):
+    G = graphs[0]
+    engine = make_engine(name, G)
+    for start in sorted(G.nodes):
+        ends = [end for end in sorted(G.nodes) if end != start]
+        assert engine.paths_from(start, ends) == {end: reference[(start, end)] for end in ends}
+
+
+def test_csr_uses_shortest_parallel_edge(graphs):
+    G = graphs[0]
+    u, v = next((u, v) for u, v in G.edges() if len(G[u][v]) > 1)
+    engine = make_engine("csr", G)
+    assert engine.path(u, v) == [u, v]
+    assert route_length(G, [u, v]) == min(data["length"] for data in G[u][v].values())
+
+
+def test_csr_unknown_node(graphs):
+    engine = make_engine("csr", graphs[0])
+    with pytest.raises(nx.NodeNotFound):
+        engine.paths_from(-1, [ISLAND])
+
+
+def test_unknown_engine(graphs):
+    with pytest.raises(ValueError):
+        make_engine("bellman-ford", graphs[0])
@@ -0,0 +1,231 @@
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import scraper
+from conftest import FIXTURES
+
+PAGES = os.path.join(FIXTURES, "scraper")
+
+
+class FixtureSite:
+    """
+    A local stand-in for the MPK site. `pages` maps URL paths to files in
+    tests/fixtures/scraper; paths in `failing` answer 404, and `flaky` maps
+    paths to the number of 503s (with Retry-After: 0) they answer first. Pages
+    carry an ETag and answer 304 to a matching If-None-Match. Every request is
+    logged as (path, status).
+    """
+
+    def __init__(self):
+        self.pages = {
+            scraper.TIMETABLE_PATH: "timetable.html",
+            "/komunikacja/linia-1-wroclaw": "linia-1.html",
+            "/komunikacja/linia-100-wroclaw": "linia-100.html",
+            "/komunikacja/linia-101-wroclaw": "linia-101.html",
+            "/komunikacja/linia-102-wroclaw": "linia-102.html",
+            "/komunikacja/linia-110-wroclaw": "linia-110.html",
+        }
+        self.failing = set()
+        self.flaky = {}
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def respond(self, handler):
+        name = self.pages.get(handler.path)
+        if name is None or handler.path in self.failing:
+            return 404, {}, b"not found"
+        with self._lock:
+            if self.flaky.get(handler.path):
+                self.flaky[handler.path] -= 1
+                return 503, {"Retry-After": "0"}, b"try again"
+        with open(os.path.join(PAGES, name), "rb") as f:
+            body = f.read()
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if handler.headers.get("If-None-Match") == etag:
+            return 304, {"ETag": etag}, b""
+        return 200, {"ETag": etag, "Content-Type": "text/html; charset=utf-8"}, body
+
+    def statuses(self, path):
+        with self._lock:
+            return [status for logged, status in self.requests if logged == path]
+
+    def handler(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                status, headers, body = site.respond(self)
+                with site._lock:
+                    site.requests.append((self.path, status))
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+@pytest.fixture
+def site():
+    site = FixtureSite()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), site.handler())
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    site.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield site
+    server.shutdown()
+    server.server_close()
+
+
+def scrape(site, output_dir, monkeypatch, *args):
+    """Runs scraper.main() against the fixture site; returns (routes, diff, cache)."""
+    monkeypatch.setattr(sys, "argv", [
+        "scraper.py", "--base-url", site.base_url, "--output-dir", str(output_dir),
+        "--rate", "0", "--workers", "4", *args,
+    ])
+    site.requests.clear()
+    scraper.main()
+
+    def read(name):
+        with open(os.path.join(output_dir, name), encoding="utf-8") as f:
+            return json.load(f)
+    return read("routes.json"), read(scraper.DIFF_FILE), read(scraper.HTTP_CACHE_FILE)
+
+
+def test_parse_line_page():
+    with open(os.path.join(PAGES, "linia-1.html"), "rb") as f:
+        route = scraper.parse_line_page(f.read(), "1")
+    assert route["line"] == "1"
+    assert [direction["direction_name"] for direction in route["directions"]] == [
+        "Kierunek: -> Plac Grunwaldzki", "Kierunek: -> Oporów"]
+    assert route["directions"][0]["stops"][0] == {"name": "Oporów", "street": "Hallera"}
+
+
+def test_line_links(site):
+    fetcher = scraper.Fetcher(site.base_url, rate=0)
+    links = scraper.get_line_links(fetcher)
+    assert links == sorted([
+        (f"{site.base_url}/komunikacja/linia-1-wroclaw", "tram"),
+        (f"{site.base_url}/komunikacja/linia-100-wroclaw", "bus"),
+        (f"{site.base_url}/komunikacja/linia-101-wroclaw", "bus"),
+        (f"{site.base_url}/komunikacja/linia-110-wroclaw", "bus"),
+    ])
+
+
+def test_rescrape_is_incremental(site, tmp_path, monkeypatch):
+    routes, diff, cache = scrape(site, tmp_path, monkeypatch)
+    assert sorted(routes) == ["1", "100", "101", "110"]
+    assert routes["1"]["type"] == "tram" and routes["100"]["type"] == "bus"
+    assert diff["added"] == ["1", "100", "101", "110"] and diff["unchanged"] == 0
+    assert all(entry["etag"] for entry in cache.values())
+
+    # add_coordinates.py geocodes the stops in between runs
+    for line_data in routes.values():
+        for direction in line_data["directions"]:
+            for stop in direction["stops"]:
+                stop["lat"], stop["lon"] = 51.1 + len(stop["name"]) / 1000, 17.0 + len(stop["street"]) / 1000
+    scraper.save_json(os.path.join(tmp_path, "routes.json"), routes, indent=2)
+
+    # Nothing changed: every line page answers 304 and keeps its coordinates
+    second, diff, _ = scrape(site, tmp_path, monkeypatch)
+    assert site.statuses("/komunikacja/linia-100-wroclaw") == [304]
+    assert [status for _, status in site.requests].count(304) == 4
+    assert second == routes
+    assert diff == {"added": [], "changed": [], "removed": [], "failed": [], "unchanged": 4}
+
+    # Line 100 gets a stop, 101 fails to download, 110 is dropped and 102 added
+    site.pages[scraper.TIMETABLE_PATH] = "timetable_v2.html"
+    site.pages["/komunikacja/linia-100-wroclaw"] = "linia-100_v2.html"
+    site.failing.add("/komunikacja/linia-101-wroclaw")
+    third, diff, cache = scrape(site, tmp_path, monkeypatch)
+    assert diff == {"added": ["102"], "changed": ["100"], "removed": ["110"], "failed": ["101"],
+                    "unchanged": 1}
+    assert site.statuses("/komunikacja/linia-1-wroclaw") == [304]
+    assert site.statuses("/komunikacja/linia-100-wroclaw") == [200]
+    assert sorted(third) == ["1", "100", "101", "102"]
+
+    # The failed line keeps its previous data, coordinates included
+    assert third["101"] == routes["101"]
+    assert f"{site.base_url}/komunikacja/linia-101-wroclaw" in cache
+
+    # The changed line reuses coordinates of stops it already had; only the new stop has none
+    new_stops = third["100"]["directions"][0]["stops"]
+    assert [stop["name"] for stop in new_stops if "lat" not in stop] == ["Poczta Główna"]
+    old_stops = {stop["name"]: stop for stop in routes["100"]["directions"][0]["stops"]}
+    assert all(stop == old_stops[stop["name"]] for stop in new_stops if "lat" in stop)
+    assert third["102"]["directions"] and "lat" in third["102"]["directions"][0]["stops"][-1]
+
+
+def test_no_cache_refetches_everything(site, tmp_path, monkeypatch):
+    scrape(site, tmp_path, monkeypatch)
+    _, diff, _ = scrape(site, tmp_path, monkeypatch, "--no-cache")
+    assert 304 not in [status for _, status in site.requests]
+    assert diff["unchanged"] == 4
+
+
+def test_merge_with_previous_without_previous_entry_for_failed_line():
+    scraped = {"1": {"type": "tram", "directions": []}}
+    routes, diff = scraper.merge_with_previous(scraped, {}, {"2"})
+    assert routes == scraped
+    assert diff == {"added": ["1"], "changed": [], "removed": [], "failed": ["2"], "unchanged": 0}
+
+
+def test_retries_go_through_the_rate_limiter(site):
+    fetcher = scraper.Fetcher(site.base_url, rate=0, retries=2, backoff=0)
+    waits = []
+    wait = fetcher.limiter.wait
+    fetcher.limiter.wait = lambda: waits.append(1) or wait()
+
+    site.flaky["/komunikacja/linia-1-wroclaw"] = 2
+    assert fetcher.get_conditional(f"{site.base_url}/komunikacja/linia-1-wroclaw") is not scraper.NOT_MODIFIED
+    assert site.statuses("/komunikacja/linia-1-wroclaw") == [503, 503, 200]
+    assert len(waits) == 3
+
+    # Out of retries: the last error is raised
+    site.flaky["/komunikacja/linia-100-wroclaw"] = 3
+    with pytest.raises(scraper.requests.exceptions.HTTPError):
+        fetcher.get(f"{site.base_url}/komunikacja/linia-100-wroclaw")
+    assert site.statuses("/komunikacja/linia-100-wroclaw") == [503, 503, 503]
+
+
+def test_rate_limiter_spaces_requests_across_threads():
+    limiter = scraper.RateLimiter(50)
+    times = []
+    lock = threading.Lock()
+
+    def worker():
+        for _ in range(5):
+            limiter.wait()
+            with lock:
+                times.append(time.monotonic())
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    times.sort()
+    assert len(times) == 20
+    assert times[-1] - times[0] >= 19 / 50 * 0.95
+    assert min(b - a for a, b in zip(times, times[1:])) >= 1 / 50 * 0.5
+
+
+def test_rate_limiter_unlimited():
+    limiter = scraper.RateLimiter(0)
+    t0 = time.monotonic()
+    for _ in range(1000):
+        limiter.wait()
+    assert time.monotonic() - t0 < 0.5
@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+
+import vehicle_log_store
+from segmentation import SegmentationParams, segment_open_records, segment_records
+
+SCALE = vehicle_log_store.COORD_SCALE
+T0 = 1_790_000_000_000
+
+
+def records(samples):
+    """Record array from (seconds, lat, lon, course) tuples."""
+    out = np.zeros(len(samples), dtype=vehicle_log_store.RECORD_DTYPE)
+    for i, (t, lat, lon, course) in enumerate(samples):
+        out[i]['ts'] = T0 + int(t * 1000)
+        out[i]['lat'] = round(lat * SCALE)
+        out[i]['lon'] = round(lon * SCALE)
+        out[i]['course'] = course
+        out[i]['line'] = b"10"
+    return out
+
+
+def day(seed=0, vehicles=4, polls=600):
+    """Polls every 15 s of vehicles that drive, crawl, park and disappear."""
+    rng = np.random.default_rng(seed)
+    samples = []
+    state = [[51.1 + rng.random() / 50, 17.0 + rng.random() / 50, "drive", 0] for _ in range(vehicles)]
+    for k in range(polls):
+        t = k * 15
+        for course, vehicle in enumerate(state):
+            if t >= vehicle[3]:
+                vehicle[2] = rng.choice(["drive", "drive", "crawl", "park", "gone"])
+                vehicle[3] = t + rng.integers(60, 1500)
+            if vehicle[2] == "gone":
+                continue
+            if vehicle[2] == "drive":
+                vehicle[0] += rng.normal(0, 4e-4)
+                vehicle[1] += rng.normal(0, 6e-4)
+            elif vehicle[2] == "crawl":
+                vehicle[0] += rng.normal(0, 3e-5)
+            samples.append((t, vehicle[0], vehicle[1], course))
+    return records(samples)
+
+
+@pytest.mark.parametrize("params", [
+    SegmentationParams(),
+    SegmentationParams(dwell_s=120, max_gap_s=60, min_step_m=50),
+    SegmentationParams(dwell_s=60, dwell_radius_m=40, min_points=1),
+])
+def test_open_records_resume_like_a_full_segmentation(params):
+    recs = day()
+    settled, pending = {}, recs[:0]
+    previous = 0
+    for cut in list(range(0, len(recs), 397)[1:]) + [len(recs)]:
+        routes, counts, pending = segment_open_records(
+            np.concatenate([pending, recs[previous:cut]]), params, SCALE)
+        previous = cut
+        for course, count in counts.items():
+            settled.setdefault(course, []).extend(routes[course][:count])
+        resumed = []
+        for course in sorted(set(settled) | set(routes)):
+            resumed += settled.get(course, []) + routes.get(course, [])[counts.get(course, 0):]
+        assert resumed == segment_records(recs[:cut], params, SCALE)
+    # Finished trips are not segmented again
+    assert len(pending) < len(recs)
+
+
+def track(*legs, course=1, start=0):
+    """Samples every 15 s along legs of (polls, dlat, dlon per poll) from 51.1, 17.0."""
+    samples, t, lat, lon = [], start, 51.1, 17.0
+    for polls, dlat, dlon in legs:
+        for _ in range(polls):
+            samples.append((t, lat, lon, course))
+            t += 15
+            lat += dlat
+            lon += dlon
+    return samples
+
+
+DRIVE = 0.002      # ~220 m per poll
+CRAWL = 0.00005    # ~5.5 m per poll, under the 15 m dwell radius
+
+
+def test_parked_vehicle_ends_the_trip_at_the_anchor():
+    # Drive, park for 15 minutes with GPS jitter around one spot, drive on
+    samples = track((10, DRIVE, 0))
+    parked_at = samples[-1][0] + 15, samples[-1][1] + DRIVE
+    for k in range(60):
+        samples.append((parked_at[0] + 15 * k, parked_at[1] + (k % 3) * 0.00003, 17.0, 1))
+    samples += track((10, DRIVE, 0), start=samples[-1][0] + 15)
+    first, second = segment_records(records(samples), SegmentationParams(), SCALE)
+    # The first trip ends at the anchor of the stop, the second starts at its last sample
+    assert len(first) == 11 and len(second) == 11
+    assert first[-1] == pytest.approx([parked_at[1], 17.0])
+
+
+def test_crawling_vehicle_is_not_parked():
+    # Every step stays within the dwell radius, but the anchor moves along with the queue
+    samples = track((10, DRIVE, 0), (60, CRAWL, 0), (10, DRIVE, 0))
+    trips = segment_records(records(samples), SegmentationParams(), SCALE)
+    assert len(trips) == 1 and len(trips[0]) == 80
+
+
+def test_short_stop_is_kept():
+    samples = track((10, DRIVE, 0), (20, 0, 0), (10, DRIVE, 0))   # 5 minutes in one spot
+    trips = segment_records(records(samples), SegmentationParams(), SCALE)
+    # One trip; exact repeats of the standing vehicle are dropped
+    assert len(trips) == 1 and len(trips[0]) == 20
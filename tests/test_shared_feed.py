@@ -0,0 +1,65 @@
+from types import SimpleNamespace
+
+from shared_feed import OwnerLock
+from vehicle_feed import VehiclePoller
+
+
+class StubClient:
+    def __init__(self, positions):
+        self.positions = positions
+        self.calls = 0
+
+    def get_all_positions(self):
+        self.calls += 1
+        return self.positions
+
+
+class StubMatcher:
+    def match_positions(self, positions):
+        return [{"direction": "A -> B", "next_stop": "B"} for _ in positions]
+
+
+POSITIONS = [SimpleNamespace(kind="bus", line="100", course=7, lat=51.1, lon=17.0)]
+
+
+def poller(tmp_path, client, started):
+    # flock locks belong to the open file, so two pollers in one process exclude each other like two workers
+    return VehiclePoller(client, matcher=StubMatcher(), owner_lock=OwnerLock(str(tmp_path / "background.lock")),
+                         shared_path=str(tmp_path / "snapshot.json"), on_owner=lambda: started.append(client))
+
+
+def test_one_owner_polls_and_the_others_follow(tmp_path):
+    started = []
+    owner_client, follower_client = StubClient(POSITIONS), StubClient([])
+    owner, follower = poller(tmp_path, owner_client, started), poller(tmp_path, follower_client, started)
+    logged = []
+    owner.add_listener(lambda snapshot, previous: logged.append("owner"), owner_only=True)
+    follower.add_listener(lambda snapshot, previous: logged.append("follower"), owner_only=True)
+    streamed = []
+    follower.add_listener(lambda snapshot, previous: streamed.append(snapshot.seq))
+
+    first = owner.refresh()   # the first to try takes the lock
+    shared = follower.refresh()
+    assert owner.is_owner and not follower.is_owner
+    assert started == [owner_client] and follower_client.calls == 0
+    assert logged == ["owner"] and streamed == [1]
+
+    # The follower serves the owner's positions and map matches
+    assert shared.fetched_at == first.fetched_at
+    assert shared.vehicles == first.vehicles and shared.vehicles[0]["match"]["next_stop"] == "B"
+    assert follower.refresh() is shared   # no new poll, no new snapshot
+
+
+def test_follower_takes_over_a_released_lock(tmp_path):
+    started = []
+    lock_path = str(tmp_path / "background.lock")
+    held = OwnerLock(lock_path)
+    assert held.try_acquire()
+    follower = poller(tmp_path, StubClient(POSITIONS), started)
+    follower.refresh()
+    assert not follower.is_owner and not started
+
+    held._file.close()   # what exiting does to the owner's lock
+    snapshot = follower.refresh()
+    assert follower.is_owner and len(started) == 1
+    assert snapshot.vehicles[0]["line"] == "100"
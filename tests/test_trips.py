@@ -0,0 +1,62 @@
+from datetime import datetime
+
+import numpy as np
+from mpyk import MpykTransLoc
+
+import trips
+from log_writer import VehicleLogWriter
+from segmentation import SegmentationParams
+from trips import OnlineTripSegmenter, TripStore
+
+DATE = "2026-10-09"
+
+
+def simulate(log_root, segmenter, vehicles=12, hours=3, seed=3):
+    """Polls every 15 s of vehicles that drive, crawl, park and disappear; logged and fed online."""
+    rng = np.random.default_rng(seed)
+    state = [[51.1 + rng.random() / 20, 17.0 + rng.random() / 20, "drive", 0] for _ in range(vehicles)]
+    base = datetime(2026, 10, 9, 7, 0).timestamp()
+    writer = VehicleLogWriter(str(log_root), log_format="binary", max_queue=100_000)
+    for k in range(hours * 240):
+        t = base + k * 15
+        positions = []
+        for course, vehicle in enumerate(state):
+            if t >= vehicle[3]:
+                vehicle[2] = rng.choice(["drive", "drive", "crawl", "park", "gone"])
+                vehicle[3] = t + rng.integers(60, 1500)
+            if vehicle[2] == "gone":
+                continue
+            if vehicle[2] == "drive":
+                vehicle[0] += rng.normal(0, 4e-4)
+                vehicle[1] += rng.normal(0, 6e-4)
+            elif vehicle[2] == "crawl":
+                vehicle[0] += rng.normal(0, 3e-5)
+            positions.append(MpykTransLoc(kind="bus", line=str(100 + course % 3), course=course,
+                                          timestamp=datetime.fromtimestamp(t), lat=vehicle[0], lon=vehicle[1]))
+        writer.submit(t, positions)
+        segmenter._ingest_positions(t, positions)
+    writer.stop(timeout=60)
+
+
+def test_online_trips_equal_backfilled_trips(tmp_path):
+    params = SegmentationParams()
+    online_store = TripStore(str(tmp_path / "online"), params)
+    segmenter = OnlineTripSegmenter(online_store, params)
+    segmenter.ready = True
+    simulate(tmp_path / "logs", segmenter)
+
+    trips.main(["backfill", DATE, "--log-root", str(tmp_path / "logs"), "--root", str(tmp_path / "backfill")])
+    backfill_store = TripStore(str(tmp_path / "backfill"), params)
+    assert backfill_store.is_complete(DATE)
+
+    lines = backfill_store.lines(DATE)
+    assert lines == ["100", "101", "102"]
+    total = 0
+    for line in lines:
+        online = online_store.load(DATE, line) + segmenter.open_trips(DATE, line)
+        online.sort(key=lambda trip: (trip["course"], trip["start"]))
+        backfilled = backfill_store.load(DATE, line)
+        assert online == backfilled
+        total += len(backfilled)
+    # Parking and gaps split the vehicles' days into several trips
+    assert total > 12
@@ -0,0 +1,75 @@
+import os
+import shutil
+from datetime import datetime
+
+import numpy as np
+import pytest
+from mpyk import MpykTransLoc
+
+import vehicle_log_store as store
+from log_writer import VehicleLogWriter
+
+DATE = "2026-10-09"
+
+
+def write_text_day(root, polls=120):
+    """Two lines of text logs, one poll every 15 s, in the original line format."""
+    base = datetime(2026, 10, 9, 8, 0).timestamp()
+    writer = VehicleLogWriter(str(root), log_format="text")
+    for k in range(polls):
+        t = base + k * 15
+        writer.submit(t, [
+            MpykTransLoc(kind="tram" if course < 3 else "bus", line="1" if course < 3 else "100",
+                         course=course, timestamp=datetime.fromtimestamp(t),
+                         lat=round(51.1 + course / 100 + k * 1e-4, 6), lon=round(17.0 + k * 2e-4, 6))
+            for course in range(5)
+        ])
+    writer.stop()
+
+
+def canonical(records):
+    """Records as comparable tuples, in (ts, course) order."""
+    return sorted(zip(*(records[name].tolist() for name in ("ts", "course", "lat", "lon", "kind", "line"))))
+
+
+def test_text_to_binary_to_archive_round_trip(tmp_path):
+    write_text_day(tmp_path)
+    logged = store.load_day(DATE, str(tmp_path))
+    assert sorted(logged) == ["1", "100"] and len(logged["1"]) == 3 * 120
+
+    # Text -> binary: same records, text kept aside as .converted
+    assert store.convert_day(DATE, str(tmp_path)) == 5 * 120
+    converted = store.load_day(DATE, str(tmp_path))
+    for line in logged:
+        assert canonical(converted[line]) == canonical(logged[line])
+    assert all(path.endswith(store.BINARY_SUFFIX) for paths in store.line_files(DATE, str(tmp_path)).values()
+               for path in paths)
+
+    # An interrupted earlier run left the text log next to the binary one: the records are doubled
+    day_dir = os.path.join(tmp_path, DATE)
+    shutil.copy(os.path.join(day_dir, "line_1.log.converted"), os.path.join(day_dir, "line_1.log"))
+    assert len(store.load_day(DATE, str(tmp_path))["1"]) == 2 * 3 * 120
+
+    before, after = store.compact_day(DATE, str(tmp_path))
+    assert after < before
+    assert sorted(os.listdir(day_dir)) == ["line_1.arc", "line_100.arc"]
+    archived = store.load_day(DATE, str(tmp_path))
+    for line in logged:
+        assert canonical(archived[line]) == canonical(logged[line])
+
+
+@pytest.mark.parametrize("resample_s", [60, 45])
+def test_compaction_downsamples_per_vehicle(tmp_path, resample_s):
+    write_text_day(tmp_path)
+    logged = store.load_day(DATE, str(tmp_path))
+    store.compact_day(DATE, str(tmp_path), resample_s=resample_s)
+
+    archive = os.path.join(tmp_path, DATE, "line_1.arc")
+    assert store.archive_resample_s(archive) == resample_s
+    archived = store.load_day(DATE, str(tmp_path))["1"]
+    assert canonical(archived) == canonical(store.downsample(logged["1"], resample_s))
+
+    # One record per vehicle and bucket, the first one of the bucket
+    buckets = archived["ts"] // (resample_s * 1000)
+    assert len(set(zip(archived["course"].tolist(), buckets.tolist()))) == len(archived) == 3 * 120 * 15 // resample_s
+    assert not store.needs_compaction(DATE, str(tmp_path), resample_s)
@@ -0,0 +1,95 @@
+import json
+from types import SimpleNamespace
+
+from vehicle_stream import COORD_QUANTUM, DeltaBroadcaster, StreamView
+
+
+def position(course, line, lat, lon, kind="bus"):
+    return SimpleNamespace(course=course, line=line, kind=kind, lat=lat, lon=lon)
+
+
+def snapshot(seq, positions):
+    # vehicles[i] is the served form of positions[i]; unmatched here
+    return SimpleNamespace(seq=seq, last_update=f"t{seq}", positions=positions,
+                           vehicles=[{} for _ in positions])
+
+
+def q(value):
+    return int(round(value * COORD_QUANTUM))
+
+
+def parse(message):
+    """(event, id, payload) of one SSE message."""
+    fields = dict(line.split(": ", 1) for line in message.decode("utf-8").strip().split("\n"))
+    return fields["event"], fields["id"], json.loads(fields["data"])
+
+
+def connect(broadcaster, last_event_id=None, view=None):
+    """Opens a stream and returns it with its first message."""
+    stream = broadcaster.stream(broadcaster.parse_event_id(last_event_id), view)
+    assert next(stream) == b"retry: 5000\n\n"
+    return stream, parse(next(stream))
+
+
+FIRST = [position(1, "1", 51.10, 17.00), position(2, "2", 51.11, 17.01), position(3, "3", 51.12, 17.02)]
+# 1 stays put, 2 moves, 3 is gone and 4 appears
+SECOND = [position(1, "1", 51.10, 17.00), position(2, "2", 51.11, 17.02), position(4, "4", 51.13, 17.03)]
+
+
+def test_delta_between_two_snapshots():
+    broadcaster = DeltaBroadcaster()
+    broadcaster.on_snapshot(snapshot(1, FIRST), None)
+    stream, (event, event_id, keyframe) = connect(broadcaster)
+    assert event == "keyframe" and keyframe["seq"] == 1
+    assert sorted(row[0] for row in keyframe["vehicles"]) == [1, 2, 3]
+
+    broadcaster.on_snapshot(snapshot(2, SECOND), None)
+    event, event_id, delta = parse(next(stream))
+    assert event == "delta" and event_id == f"{broadcaster.epoch}:2"
+    assert delta["seq"] == 2 and delta["base"] == 1 and delta["last_update"] == "t2"
+    assert delta["added"] == [[4, "4", "bus", q(51.13), q(17.03), None]]
+    assert delta["moved"] == [[2, q(51.11), q(17.02), None]]
+    assert delta["removed"] == [3]
+
+
+def test_reconnect_replays_missed_deltas():
+    broadcaster = DeltaBroadcaster()
+    broadcaster.on_snapshot(snapshot(1, FIRST), None)
+    _, (_, event_id, _) = connect(broadcaster)
+    broadcaster.on_snapshot(snapshot(2, SECOND), None)
+
+    _, (event, _, delta) = connect(broadcaster, event_id)
+    assert event == "delta" and delta["base"] == 1 and delta["removed"] == [3]
+
+
+def test_reconnect_outside_history_gets_a_keyframe():
+    broadcaster = DeltaBroadcaster(history=1)
+    broadcaster.on_snapshot(snapshot(1, FIRST), None)
+    _, (_, event_id, _) = connect(broadcaster)
+    broadcaster.on_snapshot(snapshot(2, SECOND), None)
+    broadcaster.on_snapshot(snapshot(3, FIRST), None)
+
+    for last_event_id in (event_id, "0:1", None):   # too old, another process, none
+        _, (event, _, keyframe) = connect(broadcaster, last_event_id)
+        assert event == "keyframe" and keyframe["seq"] == 3
+        assert sorted(row[0] for row in keyframe["vehicles"]) == [1, 2, 3]
+
+
+def test_view_stream_only_sends_vehicles_in_view():
+    broadcaster = DeltaBroadcaster()
+    broadcaster.on_snapshot(snapshot(1, FIRST), None)
+    # south, west, north, east: covers vehicles 1 and 2 of the first snapshot only
+    view = StreamView(bbox=(51.09, 16.99, 51.115, 17.015))
+    stream, (event, _, keyframe) = connect(broadcaster, view=view)
+    assert event == "keyframe"
+    assert sorted(row[0] for row in keyframe["vehicles"]) == [1, 2]
+
+    # Vehicle 2 leaves the box: removed for this view; 3 and 4 were never in it
+    broadcaster.on_snapshot(snapshot(2, SECOND), None)
+    _, _, delta = parse(next(stream))
+    assert delta["base"] == 1
+    assert delta["added"] == [] and delta["moved"] == [] and delta["removed"] == [2]
+
+    line_view = StreamView(line="4")
+    _, (_, _, keyframe) = connect(broadcaster, view=line_view)
+    assert [row[0] for row in keyframe["vehicles"]] == [4]